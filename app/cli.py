@@ -0,0 +1,57 @@
+import argparse
+import json
+from datetime import timedelta
+from .database import SessionLocal, init_db
+from .services.finance import backfill_base_amounts, backfill_history_participants
+from .services.archive import RETENTION_DAYS, SEGMENT_ROWS, compact_history
+from .services.idempotency import purge_keys
+from .services.reconcile import reconcile
+
+def cmd_backfill_base_amounts(args):
+    with SessionLocal() as db:
+        return backfill_base_amounts(db, batch_size=args.batch_size)
+
+def cmd_backfill_history_participants(args):
+    with SessionLocal() as db:
+        return backfill_history_participants(db, batch_size=args.batch_size)
+
+def cmd_reconcile(args):
+    with SessionLocal() as db:
+        return reconcile(db, args.group_id, repair=args.repair, full=args.full)
+
+def cmd_purge_idempotency_keys(args):
+    with SessionLocal() as db:
+        return purge_keys(db, timedelta(hours=args.older_than_hours))
+
+def cmd_compact_history(args):
+    with SessionLocal() as db:
+        return compact_history(db, timedelta(days=args.older_than_days), group_id=args.group_id, segment_rows=args.segment_rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description="Maintenance commands for the Expense Split Tracker database.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("backfill-base-amounts", help="Store base-currency amounts and FX rates on expenses written before they were persisted.")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=cmd_backfill_base_amounts)
+    p = sub.add_parser("backfill-history-participants", help="Index the users involved in history rows written before the participant index existed.")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=cmd_backfill_history_participants)
+    p = sub.add_parser("reconcile", help="Recompute balances from expenses and settlements and report (or repair) drift.")
+    p.add_argument("--group-id", type=int, help="Only this group (default: all groups).")
+    p.add_argument("--repair", action="store_true", help="Overwrite drifted balances with the recomputed values.")
+    p.add_argument("--full", action="store_true", help="Ignore checkpoints and replay every entry.")
+    p.set_defaults(func=cmd_reconcile)
+    p = sub.add_parser("purge-idempotency-keys", help="Delete stored Idempotency-Key responses older than the retry window.")
+    p.add_argument("--older-than-hours", type=float, default=24)
+    p.set_defaults(func=cmd_purge_idempotency_keys)
+    p = sub.add_parser("compact-history", help="Move history older than the retention horizon into compressed archive segments.")
+    p.add_argument("--older-than-days", type=float, default=RETENTION_DAYS)
+    p.add_argument("--group-id", type=int, help="Only this group (default: all groups).")
+    p.add_argument("--segment-rows", type=int, default=SEGMENT_ROWS)
+    p.set_defaults(func=cmd_compact_history)
+    args = parser.parse_args(argv)
+    init_db()
+    print(json.dumps(args.func(args), default=str))
+
+if __name__ == "__main__":
+    main()
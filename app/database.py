@@ -1,12 +1,31 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///expense.db")
 
 connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
 
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
 engine = create_engine(DATABASE_URL, echo=False, future=True, connect_args=connect_args)
+
+def configure_sqlite(engine, journal_mode: str = SQLITE_JOURNAL_MODE, synchronous: str = SQLITE_SYNCHRONOUS, busy_timeout_ms: int = SQLITE_BUSY_TIMEOUT_MS):
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_conn, connection_record):
+        cur = dbapi_conn.cursor()
+        if journal_mode:
+            cur.execute(f"PRAGMA journal_mode={journal_mode}")
+        if synchronous:
+            cur.execute(f"PRAGMA synchronous={synchronous}")
+        cur.execute(f"PRAGMA busy_timeout={busy_timeout_ms}")
+        cur.close()
+
+if engine.dialect.name == "sqlite":
+    configure_sqlite(engine)
+
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 
 class Base(DeclarativeBase):
@@ -14,4 +33,6 @@ class Base(DeclarativeBase):
 
 def init_db():
     from . import models                              
+    from .migrations import migrate
     Base.metadata.create_all(bind=engine)
+    migrate(engine)
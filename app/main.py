@@ -1,10 +1,20 @@
 from fastapi import FastAPI
-from .database import init_db
-from .routers import users, groups, rates, expenses, balances, settlements, history, simplify
+from fastapi.responses import PlainTextResponse
+from .database import init_db, engine, SessionLocal
+from . import metrics
+from .services.fx import rate_cache
+from .services.membership import membership_cache
+from .services import writer
+from .services.events import broker
+from .routers import users, groups, rates, expenses, balances, settlements, history, simplify, admin, export, events
 
 app = FastAPI(title="Expense Split Tracker API", version="1.0.0")
 
 init_db()
+metrics.install(engine)
+app.add_middleware(metrics.MetricsMiddleware)
+if writer.WRITE_COALESCE:
+    writer.enable(SessionLocal)
 
 app.include_router(users.router, prefix="/users", tags=["users"])
 app.include_router(groups.router, prefix="/groups", tags=["groups"])
@@ -14,7 +24,22 @@ app.include_router(balances.router, prefix="/groups/{group_id}/balances", tags=[
 app.include_router(settlements.router, prefix="/groups/{group_id}/settlements", tags=["settlements"])
 app.include_router(history.router, prefix="/groups/{group_id}/history", tags=["history"])
 app.include_router(simplify.router, prefix="/groups/{group_id}/simplify", tags=["simplify"])
+app.include_router(export.router, prefix="/groups/{group_id}/export", tags=["export"])
+app.include_router(events.router, prefix="/groups/{group_id}/events", tags=["events"])
+app.include_router(admin.router, prefix="/admin", tags=["admin"])
 
 @app.get("/")
 def health():
     return {"status": "ok"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    caches = {"fx": rate_cache.stats(), "membership": membership_cache.stats(), "simplify_preview": simplify.preview_cache.stats()}
+    return metrics.registry.render([
+        ("cache_hits_total", "counter", "cache", {name: s["hits"] for name, s in caches.items()}),
+        ("cache_misses_total", "counter", "cache", {name: s["misses"] for name, s in caches.items()}),
+        ("fx_rates_version", "gauge", "cache", {"fx": rate_cache.version}),
+        ("event_subscribers", "gauge", "scope", {"open": broker.stats()["subscribers"]}),
+        ("events_published_total", "counter", "scope", {"all": broker.published}),
+        *([("write_coalescer_total", "counter", "kind", {"batches": writer.coalescer.batches, "mutations": writer.coalescer.mutations})] if writer.coalescer else []),
+    ])
@@ -0,0 +1,142 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250, 1000)
+
+@dataclass
+class RequestStats:
+    statements: int = 0
+    db_seconds: float = 0.0
+    rows: int = 0
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += 1
+        self.sum += value
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests: Dict[Tuple[str, str, int], int] = {}
+            self.latency: Dict[Tuple[str, str], Histogram] = {}
+            self.statements: Dict[Tuple[str, str], Histogram] = {}
+            self.db_seconds: Dict[Tuple[str, str], float] = {}
+            self.rows: Dict[Tuple[str, str], int] = {}
+
+    def record(self, method: str, route: str, status: int, seconds: float, stats: RequestStats):
+        key = (method, route)
+        with self._lock:
+            self.requests[(method, route, status)] = self.requests.get((method, route, status), 0) + 1
+            self.latency.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            self.statements.setdefault(key, Histogram(STATEMENT_BUCKETS)).observe(stats.statements)
+            self.db_seconds[key] = self.db_seconds.get(key, 0.0) + stats.db_seconds
+            self.rows[key] = self.rows.get(key, 0) + stats.rows
+
+    def render(self, extra: List[Tuple[str, str, str, Dict[str, float]]] = ()) -> str:
+        out: List[str] = []
+        with self._lock:
+            out += ["# HELP http_requests_total Requests by route and status.", "# TYPE http_requests_total counter"]
+            out += [f'http_requests_total{{method="{m}",route="{r}",status="{s}"}} {n}' for (m, r, s), n in sorted(self.requests.items())]
+            _histogram(out, "http_request_duration_seconds", "Request latency by route.", self.latency)
+            _histogram(out, "db_statements_per_request", "SQL statements issued per request.", self.statements)
+            out += ["# HELP db_seconds_total Time spent executing SQL by route.", "# TYPE db_seconds_total counter"]
+            out += [f'db_seconds_total{{method="{m}",route="{r}"}} {v:.6f}' for (m, r), v in sorted(self.db_seconds.items())]
+            out += ["# HELP db_rows_returned_total Rows returned by ORM queries by route.", "# TYPE db_rows_returned_total counter"]
+            out += [f'db_rows_returned_total{{method="{m}",route="{r}"}} {v}' for (m, r), v in sorted(self.rows.items())]
+        for name, type_, label, values in extra:
+            out += [f"# TYPE {name} {type_}"]
+            out += [f'{name}{{{label}="{key}"}} {value}' for key, value in sorted(values.items())]
+        return "\n".join(out) + "\n"
+
+def _histogram(out: List[str], name: str, help_: str, data: Dict[Tuple[str, str], Histogram]):
+    out += [f"# HELP {name} {help_}", f"# TYPE {name} histogram"]
+    for (m, r), h in sorted(data.items()):
+        labels = f'method="{m}",route="{r}"'
+        out += [f'{name}_bucket{{{labels},le="{b}"}} {c}' for b, c in zip(h.buckets, h.counts)]
+        out += [f'{name}_bucket{{{labels},le="+Inf"}} {h.total}', f"{name}_sum{{{labels}}} {h.sum:.6f}", f"{name}_count{{{labels}}} {h.total}"]
+
+registry = Registry()
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    starts = conn.info.get("query_start")
+    if stats is not None and starts:
+        stats.statements += 1
+        stats.db_seconds += time.perf_counter() - starts.pop()
+
+def _count_rows(orm_execute_state):
+    stats = _current.get()
+    if stats is None or not orm_execute_state.is_select or orm_execute_state.execution_options.get("yield_per"):
+        return None
+    frozen = orm_execute_state.invoke_statement().freeze()
+    stats.rows += len(frozen.data)
+    return frozen()
+
+def install(engine: Engine):
+    if not event.contains(engine, "before_cursor_execute", _before_execute):
+        event.listen(engine, "before_cursor_execute", _before_execute)
+        event.listen(engine, "after_cursor_execute", _after_execute)
+    if not event.contains(Session, "do_orm_execute", _count_rows):
+        event.listen(Session, "do_orm_execute", _count_rows)
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats, status = RequestStats(), [500]
+        token = _current.set(stats)
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            route = scope.get("route")
+            registry.record(scope["method"], getattr(route, "path", "unmatched"), status[0], time.perf_counter() - started, stats)
+
+@contextmanager
+def query_budget(engine: Engine, max_statements: int):
+    statements: List[str] = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    if len(statements) > max_statements:
+        raise AssertionError(f"{len(statements)} SQL statements issued, budget was {max_statements}:\n" + "\n".join(statements))
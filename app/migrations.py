@@ -0,0 +1,84 @@
+from datetime import datetime
+from sqlalchemy import DateTime, bindparam, inspect, text
+from sqlalchemy.engine import Engine
+from . import models
+from .services.money import CURRENCY_EXPONENTS, DEFAULT_EXPONENT
+
+ADDED_COLUMNS = [
+    ("expenses", "fx_rate", "FLOAT"),
+    ("expenses", "fx_path", "VARCHAR(64)"),
+    ("groups", "ledger_version", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+# single-column indexes superseded by a composite index or unique constraint with the same leading column
+SUPERSEDED_INDEXES = [
+    ("group_members", "ix_group_members_group_id"),
+    ("balances", "ix_balances_group_id"),
+    ("expense_splits", "ix_expense_splits_expense_id"),
+]
+
+EPOCH_PARAM = bindparam("epoch", datetime(1970, 1, 1), type_=DateTime)
+
+GROUP_BASE = "(SELECT base_currency FROM groups WHERE groups.id = {table}.group_id)"
+SPLIT_CURRENCY = "(SELECT currency FROM expenses WHERE expenses.id = expense_splits.expense_id)"
+SPLIT_BASE = "(SELECT g.base_currency FROM expenses e JOIN groups g ON g.id = e.group_id WHERE e.id = expense_splits.expense_id)"
+
+# (table, float column, minor-unit column, ddl, sql expression for the currency the float is in)
+MINOR_UNIT_COLUMNS = [
+    ("expenses", "amount", "amount_minor", "INTEGER NOT NULL DEFAULT 0", "currency"),
+    ("expenses", "amount_base", "amount_base_minor", "INTEGER", GROUP_BASE),
+    ("expense_splits", "amount_expense_ccy", "amount_minor", "INTEGER NOT NULL DEFAULT 0", SPLIT_CURRENCY),
+    ("expense_splits", "amount_base_ccy", "amount_base_minor", "INTEGER NOT NULL DEFAULT 0", SPLIT_BASE),
+    ("balances", "balance_base", "balance_minor", "INTEGER NOT NULL DEFAULT 0", GROUP_BASE),
+    ("settlements", "amount_base", "amount_base_minor", "INTEGER NOT NULL DEFAULT 0", GROUP_BASE),
+]
+
+def scale_sql(currency_sql: str) -> str:
+    by_exp = {}
+    for ccy, exp in sorted(CURRENCY_EXPONENTS.items()):
+        by_exp.setdefault(exp, []).append(f"'{ccy}'")
+    cases = " ".join(f"WHEN {currency_sql} IN ({', '.join(codes)}) THEN {10 ** exp}" for exp, codes in sorted(by_exp.items()))
+    return f"CASE {cases} ELSE {10 ** DEFAULT_EXPONENT} END"
+
+def rebuild_currency_rates(conn, insp):
+    # one row per pair becomes a rate history; existing rates apply from the epoch so old expenses still convert
+    if "uq_fx_pair" not in {u["name"] for u in insp.get_unique_constraints("currency_rates")}:
+        return
+    if conn.dialect.name == "sqlite":
+        for ix in insp.get_indexes("currency_rates"):
+            conn.execute(text(f"DROP INDEX IF EXISTS {ix['name']}"))
+        conn.execute(text("ALTER TABLE currency_rates RENAME TO currency_rates_old"))
+        models.CurrencyRate.__table__.create(conn)
+        conn.execute(text("INSERT INTO currency_rates (id, base, target, rate, as_of) SELECT id, base, target, rate, :epoch FROM currency_rates_old").bindparams(EPOCH_PARAM))
+        conn.execute(text("DROP TABLE currency_rates_old"))
+    else:
+        conn.execute(text("ALTER TABLE currency_rates DROP CONSTRAINT uq_fx_pair"))
+        conn.execute(text("UPDATE currency_rates SET as_of = :epoch").bindparams(EPOCH_PARAM))
+        conn.execute(text("ALTER TABLE currency_rates ADD CONSTRAINT uq_fx_pair_as_of UNIQUE (base, target, as_of)"))
+
+def migrate(engine: Engine):
+    insp = inspect(engine)
+    tables = set(insp.get_table_names())
+    with engine.begin() as conn:
+        for table, column, ddl in ADDED_COLUMNS:
+            if table in tables and column not in {c["name"] for c in insp.get_columns(table)}:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        for table, old, new, ddl, currency_sql in MINOR_UNIT_COLUMNS:
+            if table not in tables:
+                continue
+            columns = {c["name"] for c in insp.get_columns(table)}
+            if new not in columns:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {new} {ddl}"))
+            if old in columns:
+                scale = scale_sql(currency_sql.format(table=table))
+                conn.execute(text(f"UPDATE {table} SET {new} = CAST(ROUND({old} * {scale}) AS INTEGER) WHERE {old} IS NOT NULL"))
+                conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {old}"))
+        if "currency_rates" in tables:
+            rebuild_currency_rates(conn, insp)
+        for table, name in SUPERSEDED_INDEXES:
+            if table in tables and name in {ix["name"] for ix in insp.get_indexes(table)}:
+                conn.execute(text(f"DROP INDEX {name}"))
+        for table in models.Base.metadata.sorted_tables:
+            if table.name in tables:
+                for index in table.indexes:
+                    index.create(conn, checkfirst=True)
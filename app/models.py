@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, DateTime, UniqueConstraint, CheckConstraint, JSON
+from sqlalchemy import Column, Integer, String, ForeignKey, Float, DateTime, UniqueConstraint, CheckConstraint, JSON, Index, LargeBinary
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from datetime import datetime
 from .database import Base
+from .services.money import to_major
 
 class User(Base):
     __tablename__ = "users"
@@ -14,11 +15,12 @@ class Group(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     name: Mapped[str] = mapped_column(String(200), nullable=False)
     base_currency: Mapped[str] = mapped_column(String(3), nullable=False)                              
+    ledger_version: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
 
 class GroupMember(Base):
     __tablename__ = "group_members"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id", ondelete="CASCADE"), index=True)
+    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id", ondelete="CASCADE"))
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
     __table_args__ = (UniqueConstraint("group_id", "user_id", name="uq_member"),)
 
@@ -28,34 +30,48 @@ class CurrencyRate(Base):
     base: Mapped[str] = mapped_column(String(3), index=True)
     target: Mapped[str] = mapped_column(String(3), index=True)
     rate: Mapped[float] = mapped_column(Float, nullable=False)                          
-    as_of: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-    __table_args__ = (UniqueConstraint("base", "target", name="uq_fx_pair"),)
+    as_of: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (UniqueConstraint("base", "target", "as_of", name="uq_fx_pair_as_of"),)
+
+class CacheVersion(Base):
+    __tablename__ = "cache_versions"
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
 
 class Expense(Base):
     __tablename__ = "expenses"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     group_id: Mapped[int] = mapped_column(ForeignKey("groups.id", ondelete="CASCADE"), index=True)
     payer_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    amount: Mapped[float] = mapped_column(Float, nullable=False)                    
+    amount_minor: Mapped[int] = mapped_column(Integer, nullable=False)
     currency: Mapped[str] = mapped_column(String(3), nullable=False)
+    amount_base_minor: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    fx_rate: Mapped[float | None] = mapped_column(Float, nullable=True)
+    fx_path: Mapped[str | None] = mapped_column(String(64), nullable=True)
     split_type: Mapped[str] = mapped_column(String(20), nullable=False)                            
     description: Mapped[str] = mapped_column(String(500), default="")
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index("ix_expenses_group_created", "group_id", "created_at"),)
+
+    @property
+    def amount(self) -> float:
+        return to_major(self.amount_minor, self.currency)
 
 class ExpenseSplit(Base):
     __tablename__ = "expense_splits"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    expense_id: Mapped[int] = mapped_column(ForeignKey("expenses.id", ondelete="CASCADE"), index=True)
+    expense_id: Mapped[int] = mapped_column(ForeignKey("expenses.id", ondelete="CASCADE"))
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    amount_expense_ccy: Mapped[float] = mapped_column(Float, nullable=False)
-    amount_base_ccy: Mapped[float] = mapped_column(Float, nullable=False)
+    amount_minor: Mapped[int] = mapped_column(Integer, nullable=False)
+    amount_base_minor: Mapped[int] = mapped_column(Integer, nullable=False)
+    __table_args__ = (Index("ix_expense_splits_expense_user", "expense_id", "user_id"),)
 
 class Balance(Base):
     __tablename__ = "balances"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id", ondelete="CASCADE"), index=True)
+    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id", ondelete="CASCADE"))
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
-    balance_base: Mapped[float] = mapped_column(Float, default=0.0)                                     
+    balance_minor: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
     __table_args__ = (UniqueConstraint("group_id", "user_id", name="uq_balance"),)
 
 class Settlement(Base):
@@ -64,7 +80,7 @@ class Settlement(Base):
     group_id: Mapped[int] = mapped_column(ForeignKey("groups.id", ondelete="CASCADE"), index=True)
     debtor_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
     creditor_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    amount_base: Mapped[float] = mapped_column(Float, nullable=False)
+    amount_base_minor: Mapped[int] = mapped_column(Integer, nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
 class History(Base):
@@ -74,3 +90,45 @@ class History(Base):
     type: Mapped[str] = mapped_column(String(20), nullable=False)                      
     payload: Mapped[dict] = mapped_column(JSON, nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index("ix_history_group_created", "group_id", "created_at", "id"),)
+
+class HistoryParticipant(Base):
+    __tablename__ = "history_participants"
+    history_id: Mapped[int] = mapped_column(ForeignKey("history.id", ondelete="CASCADE"), primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True)
+    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id", ondelete="CASCADE"))
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    __table_args__ = (Index("ix_history_participants_group_user", "group_id", "user_id", "created_at"),)
+
+class HistoryArchive(Base):
+    __tablename__ = "history_archives"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id", ondelete="CASCADE"))
+    first_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    last_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    start_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    end_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    row_count: Mapped[int] = mapped_column(Integer, nullable=False)
+    type_counts: Mapped[dict] = mapped_column(JSON, nullable=False)
+    codec: Mapped[str] = mapped_column(String(16), nullable=False, default="zlib")
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index("ix_history_archives_group_end", "group_id", "end_at"),)
+
+class LedgerCheckpoint(Base):
+    __tablename__ = "ledger_checkpoints"
+    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id", ondelete="CASCADE"), primary_key=True)
+    expense_id: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    expense_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    settlement_id: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    settlement_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    history_id: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    balances: Mapped[dict] = mapped_column(JSON, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    request_hash: Mapped[str] = mapped_column(String(64), nullable=False)
+    response: Mapped[dict] = mapped_column(JSON, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
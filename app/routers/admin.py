@@ -0,0 +1,18 @@
+from typing import Optional
+from fastapi import APIRouter, Depends
+from sqlalchemy.orm import Session
+from ..database import SessionLocal
+from ..services.reconcile import reconcile
+
+router = APIRouter()
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+@router.post("/reconcile")
+def reconcile_ledger(group_id: Optional[int] = None, repair: bool = False, full: bool = False, db: Session = Depends(get_db)):
+    return reconcile(db, group_id, repair=repair, full=full)
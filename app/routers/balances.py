@@ -1,8 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import Annotated
+from fastapi import APIRouter, Depends, Header, Query, Response
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from ..database import SessionLocal
 from .. import models, schemas
-from ..services.finance import convert
+from ..services.ledger import not_modified, require_ledger_version
+from ..services.membership import membership_cache
+from ..services.money import to_major
 
 router = APIRouter()
 
@@ -14,47 +18,33 @@ def get_db():
         db.close()
 
 @router.get("", response_model=list[schemas.BalanceOut])
-def get_balances(group_id: int, db: Session = Depends(get_db)):
-    if not db.query(models.Group).get(group_id):
-        raise HTTPException(status_code=404, detail="Group not found")
+def get_balances(group_id: int, if_none_match: Annotated[str | None, Header()] = None, response: Response = None, db: Session = Depends(get_db)):
+    if (cached := not_modified(group_id, require_ledger_version(db, group_id), if_none_match, response)) is not None:
+        return cached
+    group = db.query(models.Group).get(group_id)
     rows = db.query(models.Balance).filter_by(group_id=group_id).all()
-    return [schemas.BalanceOut(user_id=r.user_id, balance_base=round(r.balance_base, 2)) for r in rows]
+    return [schemas.BalanceOut(user_id=r.user_id, balance_base=to_major(r.balance_minor, group.base_currency)) for r in rows]
 
 @router.get("/summary")
-def get_balance_summary(group_id: int, db: Session = Depends(get_db)):
+def get_balance_summary(group_id: int, if_none_match: Annotated[str | None, Header()] = None, response: Response = None, db: Session = Depends(get_db)):
+    if (cached := not_modified(group_id, require_ledger_version(db, group_id), if_none_match, response)) is not None:
+        return cached
     group = db.query(models.Group).get(group_id)
-    if not group:
-        raise HTTPException(status_code=404, detail="Group not found")
-                        
-    members = [m.user_id for m in db.query(models.GroupMember).filter_by(group_id=group_id).all()]
-    paid_total: dict[int, float] = {uid: 0.0 for uid in members}
-    owed_total: dict[int, float] = {uid: 0.0 for uid in members}
-
-    \
-    exps = db.query(models.Expense).filter_by(group_id=group_id).all()
-    if exps:
-        exp_id_to_exp = {e.id: e for e in exps}
-                      
-        for e in exps:
-            paid_total[e.payer_id] = round(paid_total.get(e.payer_id, 0.0) + convert(db, e.amount, e.currency, group.base_currency), 10)
-                                
-        splits = db.query(models.ExpenseSplit).filter(models.ExpenseSplit.expense_id.in_(list(exp_id_to_exp.keys()))).all()
-        for s in splits:
-            e = exp_id_to_exp.get(s.expense_id)
-            if e is None:
-                continue
-            base = convert(db, s.amount_expense_ccy, e.currency, group.base_currency)
-            owed_total[s.user_id] = round(owed_total.get(s.user_id, 0.0) + base, 10)
+    paid_total = dict(db.query(models.Expense.payer_id, func.sum(models.Expense.amount_base_minor))
+                      .filter(models.Expense.group_id == group_id).group_by(models.Expense.payer_id).all())
+    owed_total = dict(db.query(models.ExpenseSplit.user_id, func.sum(models.ExpenseSplit.amount_base_minor))
+                      .join(models.Expense, models.Expense.id == models.ExpenseSplit.expense_id)
+                      .filter(models.Expense.group_id == group_id).group_by(models.ExpenseSplit.user_id).all())
+    nets = dict(db.query(models.Balance.user_id, models.Balance.balance_minor).filter(models.Balance.group_id == group_id).all())
+    members = membership_cache.members(db, group_id)
 
     summary = []
-    for uid in set(list(paid_total.keys()) + list(owed_total.keys()) + members):
-        net_row = db.query(models.Balance).filter_by(group_id=group_id, user_id=uid).first()
-        net = round(net_row.balance_base, 2) if net_row else 0.0
+    for uid in sorted(set(paid_total) | set(owed_total) | set(nets) | members):
         summary.append({
             "user_id": uid,
-            "paid_total": round(paid_total.get(uid, 0.0), 2),
-            "owed_total": round(owed_total.get(uid, 0.0), 2),
-            "net": net,
+            "paid_total": to_major(paid_total.get(uid) or 0, group.base_currency),
+            "owed_total": to_major(owed_total.get(uid) or 0, group.base_currency),
+            "net": to_major(nets.get(uid) or 0, group.base_currency),
             "currency": group.base_currency,
         })
     return {"group_id": group_id, "base_currency": group.base_currency, "users": summary}
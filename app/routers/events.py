@@ -0,0 +1,110 @@
+import asyncio
+import heapq
+import json
+import os
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from ..database import SessionLocal
+from .. import models
+from ..services.events import LedgerEvent, broker
+from ..services.money import to_major
+
+router = APIRouter()
+
+KEEPALIVE_SECONDS = float(os.getenv("EVENTS_KEEPALIVE_SECONDS", "15"))
+REPLAY_LIMIT = int(os.getenv("EVENTS_REPLAY_LIMIT", "1000"))
+DELIVERED_WINDOW = int(os.getenv("EVENTS_DELIVERED_WINDOW", "1024"))
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def sse(event: str, data: dict, id: int | None = None) -> str:
+    head = f"id: {id}\n" if id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+def history_message(history_id: int, type_: str, created_at, payload: dict) -> str:
+    return sse(type_, {"history_id": history_id, "type": type_, "created_at": created_at, "payload": payload}, history_id)
+
+def render(event: LedgerEvent, currency: str) -> str:
+    # every subscriber of a group gets the same event object, so it is serialized once
+    if currency not in event.rendered:
+        if event.kind == "history":
+            message = history_message(event.history_id, event.data["type"], event.data["created_at"], event.data["payload"])
+        else:
+            message = sse("balances", {"history_id": event.history_id, "deltas": {uid: to_major(d, currency) for uid, d in event.data.items()}})
+        event.rendered[currency] = message
+    return event.rendered[currency]
+
+def catch_up(bind, group_id: int, currency: str, last_id: int | None, skip: frozenset = frozenset()) -> tuple[list[str], int]:
+    H, B = models.History, models.Balance
+    with Session(bind=bind) as db:
+        # one statement, so the balances and the history id they include come from the same snapshot
+        head_q = select(func.coalesce(func.max(H.id), 0)).where(H.group_id == group_id).scalar_subquery()
+        rows = db.execute(select(B.user_id, B.balance_minor, head_q).where(B.group_id == group_id)).all()
+        head = rows[0][2] if rows else db.execute(select(head_q)).scalar()
+        messages, missed = [], 0
+        if last_id is not None and head > last_id:
+            replay = (db.query(H.id, H.type, H.created_at, H.payload).filter(H.group_id == group_id, H.id > last_id, H.id <= head)
+                      .order_by(H.id).limit(REPLAY_LIMIT + 1).all())
+            if len(replay) <= REPLAY_LIMIT:
+                messages = [history_message(hid, type_, created_at.isoformat(), payload) for hid, type_, created_at, payload in replay if hid not in skip]
+            else:
+                missed = db.query(func.count(H.id)).filter(H.group_id == group_id, H.id > last_id, H.id <= head).scalar()
+    balances = {uid: to_major(amount, currency) for uid, amount, _ in rows}
+    messages.append(sse("snapshot", {"history_id": head, "balances": balances, "missed": missed}, head))
+    return messages, head
+
+async def event_stream(bind, group_id: int, currency: str, last_id: int | None):
+    sub = broker.subscribe(group_id)
+    try:
+        messages, synced = await run_in_threadpool(catch_up, bind, group_id, currency, last_id)
+        # requests publish after their own commit on different threads, so history ids can arrive out of order:
+        # everything up to floor is covered, and ids above it are checked against the ones already sent
+        floor, delivered, recent = synced, set(), []
+        for m in messages:
+            yield m
+        while True:
+            try:
+                async with asyncio.timeout(KEEPALIVE_SECONDS):
+                    events = [await sub.queue.get()]
+            except TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            # everything already queued goes out in one write
+            while not sub.queue.empty():
+                events.append(sub.queue.get_nowait())
+            out = []
+            for event in events:
+                if event.kind == "resync":
+                    messages, synced = await run_in_threadpool(catch_up, bind, group_id, currency, floor, frozenset(delivered))
+                    floor, delivered, recent = max(floor, synced), set(), []
+                    out += messages
+                elif event.kind == "history" and event.history_id > floor and event.history_id not in delivered:
+                    delivered.add(event.history_id)
+                    heapq.heappush(recent, event.history_id)
+                    if len(recent) > DELIVERED_WINDOW:
+                        floor = heapq.heappop(recent)
+                        delivered.discard(floor)
+                    out.append(render(event, currency))
+                elif event.kind == "balances" and (event.history_id is None or event.history_id > synced):
+                    out.append(render(event, currency))
+            if out:
+                yield "".join(out)
+    finally:
+        broker.unsubscribe(sub)
+
+@router.get("")
+def group_events(group_id: int, last_event_id: Annotated[int | None, Header()] = None, db: Session = Depends(get_db)):
+    group = db.query(models.Group).get(group_id)
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    return StreamingResponse(event_stream(db.get_bind(), group_id, group.base_currency, last_event_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,11 +1,33 @@
-from fastapi import APIRouter, Depends, HTTPException
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from decimal import InvalidOperation
+from typing import Annotated, Literal
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, UploadFile
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 from ..database import SessionLocal
 from .. import models, schemas
-from ..services.finance import split_equal, validate_exact, validate_percent, apply_expense, add_history
+from ..services.ledger import bump_ledger_version
+from ..services.writer import run_write
+from ..services.idempotency import IdempotencyKeyHeader, run_idempotent
+from ..services.allocation import split_rows
+from ..services.money import to_minor
+from ..services.fx import naive_utc
+from ..services.importer import chunked, error_detail, guess_format, records, to_item
+from ..services.membership import membership_cache
+from .history import NDJSON
+from ..services.finance import apply_expense, add_history, add_history_bulk, compute_shares, price_expense, ensure_members, apply_balance_deltas
 
 router = APIRouter()
 
+IMPORT_CHUNK = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
+MAX_IMPORT_ERRORS = 1000
+
 def get_db():
     db = SessionLocal()
     try:
@@ -19,44 +41,189 @@ def get_group(db: Session, group_id: int) -> models.Group:
         raise HTTPException(status_code=404, detail="Group not found")
     return g
 
+SPLIT_FIELDS = {"equal": ("participants", "user_ids"), "exact": ("amounts", "amounts"), "percentage": ("percentages", "percentages"), "shares": ("shares", "shares")}
+
+def history_payload(expense_id: int, split_type: str, data) -> dict:
+    key, field = SPLIT_FIELDS[split_type]
+    return {"expense_id": expense_id, "split_type": split_type, "amount": data.amount, "currency": data.currency.upper(), "payer_id": data.payer_id, key: getattr(data, field), "description": data.description}
+
+def create_expense(db: Session, group_id: int, split_type: str, data, idempotency_key: str | None = None) -> schemas.ExpenseOut:
+    def mutation(db: Session) -> schemas.ExpenseOut:
+        group = get_group(db, group_id)
+        shares = compute_shares(split_type, data)
+        currency = data.currency.upper()
+        amount = to_minor(data.amount, currency)
+        at = naive_utc(data.created_at) or datetime.utcnow()
+        priced = apply_expense(db, group, data.payer_id, amount, currency, shares, at)
+        exp = models.Expense(group_id=group.id, payer_id=data.payer_id, amount_minor=amount, currency=currency, amount_base_minor=priced.amount_base, fx_rate=priced.rate, fx_path=priced.fx_path, split_type=split_type, description=data.description or "", created_at=at)
+        db.add(exp); db.flush()
+        if len(shares):
+            db.execute(insert(models.ExpenseSplit), split_rows(exp.id, shares, priced.shares_base))
+        add_history(db, group.id, "expense", history_payload(exp.id, split_type, data))
+        bump_ledger_version(db, group.id)
+        return schemas.ExpenseOut.model_validate(exp)
+    return run_idempotent(db, idempotency_key, f"POST /groups/{group_id}/expenses/{split_type}", data, mutation)
+
 @router.post("/equal", response_model=schemas.ExpenseOut)
-def add_equal(group_id: int, data: schemas.ExpenseEqualIn, db: Session = Depends(get_db)):
-    group = get_group(db, group_id)
-    splits = split_equal(data.amount, data.user_ids)
-    exp = models.Expense(group_id=group.id, payer_id=data.payer_id, amount=data.amount, currency=data.currency.upper(), split_type="equal", description=data.description or "")
-    db.add(exp); db.flush()
-                    
-    for uid, share in splits.items():
-        db.add(models.ExpenseSplit(expense_id=exp.id, user_id=uid, amount_expense_ccy=share, amount_base_ccy=0.0))                        
-                     
-    apply_expense(db, group, data.payer_id, data.amount, data.currency.upper(), splits)
-    add_history(db, group.id, "expense", {"expense_id": exp.id, "split_type": "equal", "amount": data.amount, "currency": data.currency.upper(), "payer_id": data.payer_id, "participants": data.user_ids, "description": data.description})
-    db.commit(); db.refresh(exp)
-    return exp
+def add_equal(group_id: int, data: schemas.ExpenseEqualIn, idempotency_key: IdempotencyKeyHeader = None, db: Session = Depends(get_db)):
+    return create_expense(db, group_id, "equal", data, idempotency_key)
 
 @router.post("/exact", response_model=schemas.ExpenseOut)
-def add_exact(group_id: int, data: schemas.ExpenseExactIn, db: Session = Depends(get_db)):
-    group = get_group(db, group_id)
-    validate_exact(data.amount, data.amounts)
-    exp = models.Expense(group_id=group.id, payer_id=data.payer_id, amount=data.amount, currency=data.currency.upper(), split_type="exact", description=data.description or "")
-    db.add(exp); db.flush()
-    for uid, share in data.amounts.items():
-        db.add(models.ExpenseSplit(expense_id=exp.id, user_id=uid, amount_expense_ccy=share, amount_base_ccy=0.0))
-    apply_expense(db, group, data.payer_id, data.amount, data.currency.upper(), data.amounts)
-    add_history(db, group.id, "expense", {"expense_id": exp.id, "split_type": "exact", "amount": data.amount, "currency": data.currency.upper(), "payer_id": data.payer_id, "amounts": data.amounts, "description": data.description})
-    db.commit(); db.refresh(exp)
-    return exp
+def add_exact(group_id: int, data: schemas.ExpenseExactIn, idempotency_key: IdempotencyKeyHeader = None, db: Session = Depends(get_db)):
+    return create_expense(db, group_id, "exact", data, idempotency_key)
 
 @router.post("/percentage", response_model=schemas.ExpenseOut)
-def add_percentage(group_id: int, data: schemas.ExpensePercentIn, db: Session = Depends(get_db)):
-    group = get_group(db, group_id)
-    validate_percent(data.amount, data.percentages)
-    splits = {uid: round(data.amount * pct / 100.0, 10) for uid, pct in data.percentages.items()}
-    exp = models.Expense(group_id=group.id, payer_id=data.payer_id, amount=data.amount, currency=data.currency.upper(), split_type="percentage", description=data.description or "")
-    db.add(exp); db.flush()
-    for uid, share in splits.items():
-        db.add(models.ExpenseSplit(expense_id=exp.id, user_id=uid, amount_expense_ccy=share, amount_base_ccy=0.0))
-    apply_expense(db, group, data.payer_id, data.amount, data.currency.upper(), splits)
-    add_history(db, group.id, "expense", {"expense_id": exp.id, "split_type": "percentage", "amount": data.amount, "currency": data.currency.upper(), "payer_id": data.payer_id, "percentages": data.percentages, "description": data.description})
-    db.commit(); db.refresh(exp)
+def add_percentage(group_id: int, data: schemas.ExpensePercentIn, idempotency_key: IdempotencyKeyHeader = None, db: Session = Depends(get_db)):
+    return create_expense(db, group_id, "percentage", data, idempotency_key)
+
+@router.post("/shares", response_model=schemas.ExpenseOut)
+def add_shares(group_id: int, data: schemas.ExpenseSharesIn, idempotency_key: IdempotencyKeyHeader = None, db: Session = Depends(get_db)):
+    return create_expense(db, group_id, "shares", data, idempotency_key)
+
+def get_expense(db: Session, group_id: int, expense_id: int) -> models.Expense:
+    # the row lock makes a concurrent edit or delete wait and then see this one's splits, so an old contribution is never reversed twice
+    exp = db.query(models.Expense).filter_by(id=expense_id, group_id=group_id).with_for_update().populate_existing().first()
+    if not exp:
+        raise HTTPException(status_code=404, detail="Expense not found")
+    if exp.amount_base_minor is None:
+        raise HTTPException(status_code=409, detail="Expense has no base amount; run backfill-base-amounts before changing it.")
     return exp
+
+def expense_contribution(db: Session, exp: models.Expense) -> dict[int, int]:
+    contribution = {exp.payer_id: exp.amount_base_minor}
+    for uid, base in db.query(models.ExpenseSplit.user_id, models.ExpenseSplit.amount_base_minor).filter_by(expense_id=exp.id):
+        contribution[uid] = contribution.get(uid, 0) - base
+    return contribution
+
+def invalidate_checkpoint(db: Session, group_id: int, expense_id: int):
+    # a checkpoint past this expense has its old amounts baked in; the next reconcile replays in full and writes a new one
+    db.query(models.LedgerCheckpoint).filter(models.LedgerCheckpoint.group_id == group_id, models.LedgerCheckpoint.expense_id >= expense_id).delete(synchronize_session=False)
+
+@router.put("/{expense_id}", response_model=schemas.ExpenseOut)
+def update_expense(group_id: int, expense_id: int, data: schemas.ExpenseBatchItem, db: Session = Depends(get_db)):
+    def mutation(db: Session) -> schemas.ExpenseOut:
+        group = get_group(db, group_id)
+        exp = get_expense(db, group_id, expense_id)
+        old = expense_contribution(db, exp)
+        item = data if data.created_at else data.model_copy(update={"created_at": exp.created_at})
+        _, amount, shares, priced, at = prepare_expense(db, group, item)
+        deltas = dict(priced.deltas)
+        for uid, amt in old.items():
+            deltas[uid] = deltas.get(uid, 0) - amt
+        exp.payer_id, exp.amount_minor, exp.currency, exp.split_type = item.payer_id, amount, item.currency.upper(), item.split_type
+        exp.amount_base_minor, exp.fx_rate, exp.fx_path = priced.amount_base, priced.rate, priced.fx_path
+        exp.description, exp.created_at = item.description or "", at
+        db.query(models.ExpenseSplit).filter_by(expense_id=exp.id).delete(synchronize_session=False)
+        if len(shares):
+            db.execute(insert(models.ExpenseSplit), split_rows(exp.id, shares, priced.shares_base))
+        apply_balance_deltas(db, group.id, deltas)
+        add_history(db, group.id, "expense", {**history_payload(exp.id, item.split_type, item), "action": "updated", "previous_participants": sorted(old)})
+        invalidate_checkpoint(db, group.id, exp.id)
+        bump_ledger_version(db, group.id)
+        db.flush()
+        return schemas.ExpenseOut.model_validate(exp)
+    return run_write(db, mutation)
+
+@router.delete("/{expense_id}")
+def delete_expense(group_id: int, expense_id: int, db: Session = Depends(get_db)):
+    def mutation(db: Session) -> dict:
+        group = get_group(db, group_id)
+        exp = get_expense(db, group_id, expense_id)
+        old = expense_contribution(db, exp)
+        apply_balance_deltas(db, group.id, {uid: -amt for uid, amt in old.items()})
+        add_history(db, group.id, "expense", {"expense_id": exp.id, "action": "deleted", "amount": exp.amount, "currency": exp.currency, "payer_id": exp.payer_id,
+                                             "previous_participants": sorted(old), "description": exp.description})
+        db.query(models.ExpenseSplit).filter_by(expense_id=exp.id).delete(synchronize_session=False)
+        db.delete(exp)
+        invalidate_checkpoint(db, group.id, expense_id)
+        bump_ledger_version(db, group.id)
+        return {"message": "Expense deleted", "expense_id": expense_id}
+    return run_write(db, mutation)
+
+def prepare_expense(db: Session, group: models.Group, item) -> tuple:
+    shares = compute_shares(item.split_type, item)
+    ensure_members(db, group.id, [*shares.user_ids.tolist(), item.payer_id])
+    amount = to_minor(item.amount, item.currency)
+    at = naive_utc(item.created_at) or datetime.utcnow()
+    priced = price_expense(db, group, item.payer_id, amount, item.currency.upper(), shares, at)
+    return item, amount, shares, priced, at
+
+def insert_expenses(db: Session, group: models.Group, prepared: list) -> list[models.Expense]:
+    exps = db.scalars(insert(models.Expense).returning(models.Expense, sort_by_parameter_order=True), [
+        {"group_id": group.id, "payer_id": item.payer_id, "amount_minor": amount, "currency": item.currency.upper(), "amount_base_minor": priced.amount_base, "fx_rate": priced.rate, "fx_path": priced.fx_path, "split_type": item.split_type, "description": item.description or "", "created_at": at}
+        for item, amount, _, priced, at in prepared
+    ]).all()
+    rows, history_rows, totals = [], [], {}
+    for exp, (item, _, shares, priced, _) in zip(exps, prepared):
+        rows.extend(split_rows(exp.id, shares, priced.shares_base))
+        history_rows.append(("expense", history_payload(exp.id, item.split_type, item)))
+        for uid, delta in priced.deltas.items():
+            totals[uid] = totals.get(uid, 0) + delta
+    if rows:
+        db.execute(insert(models.ExpenseSplit), rows)
+    add_history_bulk(db, group.id, history_rows)
+    apply_balance_deltas(db, group.id, totals)
+    bump_ledger_version(db, group.id)
+    return exps
+
+@router.post("/batch", response_model=schemas.ExpenseBatchOut)
+def add_batch(group_id: int, data: schemas.ExpenseBatchIn, idempotency_key: IdempotencyKeyHeader = None, db: Session = Depends(get_db)):
+    # items are validated and priced inside the write, so a retried key replays its stored response without re-pricing
+    def mutation(db: Session) -> dict:
+        group = get_group(db, group_id)
+        errors, prepared = [], []
+        for i, item in enumerate(data.expenses):
+            try:
+                prepared.append(prepare_expense(db, group, item))
+            except HTTPException as e:
+                errors.append({"index": i, "status_code": e.status_code, "detail": e.detail})
+        if errors:
+            raise HTTPException(status_code=400, detail={"message": f"{len(errors)} of {len(data.expenses)} expenses rejected; nothing was saved.", "errors": errors})
+        out = [schemas.ExpenseOut.model_validate(e) for e in insert_expenses(db, group, prepared)]
+        return {"count": len(out), "expenses": out}
+    return run_idempotent(db, idempotency_key, f"POST /groups/{group_id}/expenses/batch", data, mutation)
+
+def import_events(bind, group_id: int, rows, fmt: str, chunk_size: int):
+    with Session(bind=bind) as db:
+        group = get_group(db, group_id)
+        members = membership_cache.members(db, group_id)
+        stats = {"rows": 0, "imported": 0, "failed": 0, "chunks": 0}
+        errors = []
+
+        def prepared():
+            for line, raw in rows:
+                stats["rows"] += 1
+                try:
+                    yield prepare_expense(db, group, to_item(fmt, raw, group.base_currency, members))
+                except (HTTPException, ValidationError, ValueError, InvalidOperation) as e:
+                    stats["failed"] += 1
+                    if len(errors) < MAX_IMPORT_ERRORS:
+                        errors.append({"line": line, "detail": error_detail(e)})
+
+        for chunk in chunked(prepared(), chunk_size):
+            run_write(db, lambda s: insert_expenses(s, group, chunk))
+            stats["imported"] += len(chunk)
+            stats["chunks"] += 1
+            yield {"event": "progress", **stats}
+        yield {"event": "done", **stats, "errors": errors}
+
+@router.post("/import")
+def import_expenses(group_id: int, file: UploadFile, format: Literal["csv", "jsonl"] | None = None,
+                    chunk_size: Annotated[int, Query(ge=1, le=10000)] = IMPORT_CHUNK,
+                    accept: Annotated[str | None, Header()] = None, db: Session = Depends(get_db)):
+    get_group(db, group_id)
+    fmt = format or guess_format(file.filename)
+    if accept and NDJSON in accept:
+        # the upload is closed as soon as this handler returns, so the stream reads from its own copy
+        upload = tempfile.TemporaryFile()
+        shutil.copyfileobj(file.file, upload)
+        upload.seek(0)
+
+        def stream():
+            with upload:
+                for e in import_events(db.get_bind(), group_id, records(upload, fmt), fmt, chunk_size):
+                    yield json.dumps(e, default=str) + "\n"
+        return StreamingResponse(stream(), media_type=NDJSON)
+    for done in import_events(db.get_bind(), group_id, records(file.file, fmt), fmt, chunk_size):
+        pass
+    return done
@@ -0,0 +1,38 @@
+from typing import Annotated, Literal
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from ..database import SessionLocal
+from .. import models
+from ..services.export import decode_watermark, encode, encode_watermark, gzipped, high_water, ledger_records
+
+router = APIRouter()
+
+MEDIA_TYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def export_chunks(bind, group_id: int, fmt: str, since: tuple[int, int], until: tuple[int, int]):
+    with Session(bind=bind) as db:
+        group = db.query(models.Group).get(group_id)
+        yield from encode(ledger_records(db, group, since, until), fmt)
+
+@router.get("")
+def export_ledger(group_id: int, format: Literal["csv", "jsonl"] = "csv", since: str | None = None,
+                  gzip: Annotated[bool, Query()] = False, db: Session = Depends(get_db)):
+    if not db.query(models.Group).get(group_id):
+        raise HTTPException(status_code=404, detail="Group not found")
+    start = decode_watermark(since) if since else (0, 0)
+    until = high_water(db, group_id)
+    chunks = export_chunks(db.get_bind(), group_id, format, start, until)
+    filename = f"group-{group_id}-ledger.{format}"
+    media_type = MEDIA_TYPES[format]
+    if gzip:
+        chunks, filename, media_type = gzipped(chunks), filename + ".gz", "application/gzip"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"', "X-Export-Watermark": encode_watermark(*until)}
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
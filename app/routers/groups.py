@@ -2,6 +2,8 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from ..database import SessionLocal
 from .. import models, schemas
+from ..services.ledger import bump_ledger_version
+from ..services.membership import membership_cache
 
 router = APIRouter()
 
@@ -32,6 +34,8 @@ def add_member(group_id: int, member: schemas.AddMember, db: Session = Depends(g
     db.add(m)
                                     
     if not db.query(models.Balance).filter_by(group_id=group_id, user_id=member.user_id).first():
-        db.add(models.Balance(group_id=group_id, user_id=member.user_id, balance_base=0.0))
+        db.add(models.Balance(group_id=group_id, user_id=member.user_id, balance_minor=0))
+    bump_ledger_version(db, group_id)
     db.commit()
+    membership_cache.add(group_id, member.user_id)
     return {"message": "Member added"}
@@ -1,11 +1,21 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+import base64
+import json
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException, Query, Header, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import Session
 from datetime import datetime
 from ..database import SessionLocal
 from .. import models, schemas
+from ..services.archive import archived_history
+from ..services.ledger import not_modified, require_ledger_version
 
 router = APIRouter()
 
+NDJSON = "application/x-ndjson"
+STREAM_BATCH = 500
+
 def get_db():
     db = SessionLocal()
     try:
@@ -13,25 +23,88 @@ def get_db():
     finally:
         db.close()
 
-@router.get("", response_model=list[schemas.HistoryOut])
-def get_history(group_id: int, user_id: int | None = None, type: str | None = Query(default=None, pattern="^(expense|settlement)$"),
-                start: datetime | None = None, end: datetime | None = None, db: Session = Depends(get_db)):
-    if not db.query(models.Group).get(group_id):
-        raise HTTPException(status_code=404, detail="Group not found")
-    q = db.query(models.History).filter_by(group_id=group_id)
+def encode_cursor(row: models.History) -> str:
+    return base64.urlsafe_b64encode(json.dumps([row.created_at.isoformat(), row.id]).encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, id_ = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(id_)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def history_query(db: Session, group_id: int, user_id: int | None, type: str | None, start: datetime | None, end: datetime | None, cursor: str | None):
+    H = models.History
+    q = db.query(H).filter(H.group_id == group_id)
     if type:
-        q = q.filter(models.History.type == type)
+        q = q.filter(H.type == type)
     if start:
-        q = q.filter(models.History.created_at >= start)
+        q = q.filter(H.created_at >= start)
     if end:
-        q = q.filter(models.History.created_at <= end)
-    rows = q.order_by(models.History.created_at.desc()).all()
-                                                            
+        q = q.filter(H.created_at <= end)
     if user_id is not None:
-        filtered = []
-        for r in rows:
-            p = r.payload or {}
-            if (p.get("payer_id") == user_id) or (user_id in p.get("participants", [])) or (user_id in p.get("amounts", {}).keys()) or (p.get("from") == user_id) or (p.get("to") == user_id):
-                filtered.append(r)
-        rows = filtered
+        q = q.join(models.HistoryParticipant, models.HistoryParticipant.history_id == H.id).filter(models.HistoryParticipant.user_id == user_id)
+    if cursor:
+        created_at, id_ = decode_cursor(cursor)
+        q = q.filter(or_(H.created_at < created_at, and_(H.created_at == created_at, H.id < id_)))
+    return q.order_by(H.created_at.desc(), H.id.desc())
+
+def archived(db: Session, cursor: str | None, **filters):
+    return archived_history(db, cursor=decode_cursor(cursor) if cursor else None, **filters)
+
+def with_archived(db: Session, rows: list, limit: int | None, filters: dict) -> list:
+    # archived rows are all older than live ones, so segments are only opened when the live rows do not fill the page;
+    # ids are checked because a concurrent compaction can move a row between the two reads
+    seen = {row.id for row in rows}
+    for row in archived(db, **filters):
+        if row.id not in seen:
+            rows.append(row)
+            if limit is not None and len(rows) > limit:
+                break
+    return rows
+
+def stream_history(bind, limit: int | None, **filters):
+    with Session(bind=bind) as db:
+        q = history_query(db, **filters)
+        if limit:
+            q = q.limit(limit)
+        seen = set()
+        for row in q.yield_per(STREAM_BATCH):
+            seen.add(row.id)
+            yield schemas.HistoryOut.model_validate(row).model_dump_json() + "\n"
+        remaining = limit - len(seen) if limit else None
+        if remaining == 0:
+            return
+        for row in archived(db, **filters):
+            if row.id not in seen:
+                yield row.model_dump_json() + "\n"
+                if remaining is not None:
+                    remaining -= 1
+                    if remaining == 0:
+                        return
+
+@router.get("", response_model=list[schemas.HistoryOut])
+def get_history(group_id: int, user_id: int | None = None, type: str | None = Query(default=None, pattern="^(expense|settlement)$"),
+                start: datetime | None = None, end: datetime | None = None,
+                limit: Annotated[int | None, Query(ge=1, le=1000)] = None, cursor: str | None = None,
+                accept: Annotated[str | None, Header()] = None, if_none_match: Annotated[str | None, Header()] = None,
+                response: Response = None, db: Session = Depends(get_db)):
+    filters = dict(group_id=group_id, user_id=user_id, type=type, start=start, end=end, cursor=cursor)
+    if accept and NDJSON in accept:
+        require_ledger_version(db, group_id)
+        if cursor:
+            decode_cursor(cursor)
+        return StreamingResponse(stream_history(db.get_bind(), limit, **filters), media_type=NDJSON)
+    if (cached := not_modified(group_id, require_ledger_version(db, group_id), if_none_match, response)) is not None:
+        return cached
+    q = history_query(db, **filters)
+    if limit is None:
+        return with_archived(db, q.all(), None, filters)
+    rows = q.limit(limit + 1).all()
+    if len(rows) <= limit:
+        rows = with_archived(db, rows, limit, filters)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        if response is not None:
+            response.headers["X-Next-Cursor"] = encode_cursor(rows[-1])
     return rows
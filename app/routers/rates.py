@@ -1,7 +1,11 @@
+from typing import Optional
 from fastapi import APIRouter, Depends
 from sqlalchemy.orm import Session
+from datetime import datetime
 from ..database import SessionLocal
 from .. import models, schemas
+from ..services.finance import quote_rate
+from ..services.fx import rate_cache, bump_version, default_as_of, naive_utc, upsert_rates, FX_VERSION_KEY
 
 router = APIRouter()
 
@@ -16,11 +20,34 @@ def get_db():
 def upsert_rate(rate: schemas.RateUpsert, db: Session = Depends(get_db)):
     base = rate.base.upper()
     target = rate.target.upper()
-    fx = db.query(models.CurrencyRate).filter_by(base=base, target=target).first()
-    if fx:
-        fx.rate = rate.rate
-    else:
-        fx = models.CurrencyRate(base=base, target=target, rate=rate.rate)
-        db.add(fx)
+    as_of = naive_utc(rate.as_of) or default_as_of(db, [(base, target)])[(base, target)]
+    upsert_rates(db, [{"base": base, "target": target, "rate": rate.rate, "as_of": as_of}])
+    version = bump_version(db, FX_VERSION_KEY)
     db.commit()
-    return {"message": "Rate upserted", "base": base, "target": target, "rate": rate.rate}
+    rate_cache.put(base, target, rate.rate, as_of, version)
+    return {"message": "Rate upserted", "base": base, "target": target, "rate": rate.rate, "as_of": as_of, "version": version}
+
+@router.post("/bulk")
+def load_rates(data: schemas.RateBulkIn, db: Session = Depends(get_db)):
+    as_of = naive_utc(data.as_of)
+    undated = {} if as_of else default_as_of(db, [(r.base.upper(), r.target.upper()) for r in data.rates if r.as_of is None])
+    rows = {}
+    for r in data.rates:
+        base, target = r.base.upper(), r.target.upper()
+        row = {"base": base, "target": target, "rate": r.rate, "as_of": naive_utc(r.as_of) or as_of or undated[(base, target)]}
+        rows[(row["base"], row["target"], row["as_of"])] = row
+    upsert_rates(db, list(rows.values()))
+    version = bump_version(db, FX_VERSION_KEY)
+    db.commit()
+    rate_cache.invalidate()
+    return {"message": "Rates loaded", "count": len(rows), "pairs": len({(b, t) for b, t, _ in rows}), "version": version}
+
+@router.get("/quote")
+def quote(base: str, target: str, at: Optional[datetime] = None, db: Session = Depends(get_db)):
+    base, target, at = base.upper(), target.upper(), naive_utc(at)
+    rate, path = quote_rate(db, base, target, at)
+    return {"base": base, "target": target, "at": at, "rate": rate, "path": path.split(">")}
+
+@router.get("/cache")
+def cache_stats():
+    return rate_cache.stats()
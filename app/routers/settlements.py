@@ -2,7 +2,10 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from ..database import SessionLocal
 from .. import models, schemas
-from ..services.finance import ensure_member, upsert_balance, add_history
+from ..services.ledger import bump_ledger_version
+from ..services.idempotency import IdempotencyKeyHeader, run_idempotent
+from ..services.finance import ensure_members, apply_balance_deltas, add_history, read_balances
+from ..services.money import to_major, to_minor
 
 router = APIRouter()
 
@@ -20,30 +23,30 @@ def get_group(db: Session, group_id: int) -> models.Group:
     return g
 
 @router.post("", response_model=schemas.SettlementOut)
-def settle(group_id: int, data: schemas.SettlementIn, db: Session = Depends(get_db)):
-    group = get_group(db, group_id)
-    ensure_member(db, group.id, data.debtor_id)
-    ensure_member(db, group.id, data.creditor_id)
-    if data.debtor_id == data.creditor_id:
-        raise HTTPException(status_code=400, detail="Cannot settle with self.")
-                    
-    deb = db.query(models.Balance).filter_by(group_id=group_id, user_id=data.debtor_id).first()
-    cred = db.query(models.Balance).filter_by(group_id=group_id, user_id=data.creditor_id).first()
-    deb_amt = deb.balance_base if deb else 0.0
-    cred_amt = cred.balance_base if cred else 0.0
-    if deb_amt >= 0:
-        raise HTTPException(status_code=400, detail="Debtor does not owe.")
-    if cred_amt <= 0:
-        raise HTTPException(status_code=400, detail="Creditor is not owed.")
-    max_pay = min(-deb_amt, cred_amt)
-    if data.amount_base - max_pay > 1e-9:
-        raise HTTPException(status_code=400, detail=f"Cannot settle more than outstanding ({max_pay}).")
+def settle(group_id: int, data: schemas.SettlementIn, idempotency_key: IdempotencyKeyHeader = None, db: Session = Depends(get_db)):
+    def mutation(db: Session) -> schemas.SettlementOut:
+        group = get_group(db, group_id)
+        ensure_members(db, group.id, [data.debtor_id, data.creditor_id])
+        if data.debtor_id == data.creditor_id:
+            raise HTTPException(status_code=400, detail="Cannot settle with self.")
+        amount = to_minor(data.amount_base, group.base_currency)
+        if amount <= 0:
+            raise HTTPException(status_code=400, detail="Settlement amount must be positive.")
+        bals = read_balances(db, group_id, [data.debtor_id, data.creditor_id])
+        deb_amt = bals.get(data.debtor_id, 0)
+        cred_amt = bals.get(data.creditor_id, 0)
+        if deb_amt >= 0:
+            raise HTTPException(status_code=400, detail="Debtor does not owe.")
+        if cred_amt <= 0:
+            raise HTTPException(status_code=400, detail="Creditor is not owed.")
+        max_pay = min(-deb_amt, cred_amt)
+        if amount > max_pay:
+            raise HTTPException(status_code=400, detail=f"Cannot settle more than outstanding ({to_major(max_pay, group.base_currency)}).")
 
-    s = models.Settlement(group_id=group_id, debtor_id=data.debtor_id, creditor_id=data.creditor_id, amount_base=data.amount_base)
-    db.add(s)
-                   
-    upsert_balance(db, group_id, data.debtor_id, +data.amount_base)                    
-    upsert_balance(db, group_id, data.creditor_id, -data.amount_base)                         
-    add_history(db, group_id, "settlement", {"settlement_id": None, "from": data.debtor_id, "to": data.creditor_id, "amount_base": data.amount_base})
-    db.commit(); db.refresh(s)
-    return s
+        s = models.Settlement(group_id=group_id, debtor_id=data.debtor_id, creditor_id=data.creditor_id, amount_base_minor=amount)
+        db.add(s); db.flush()
+        apply_balance_deltas(db, group_id, {data.debtor_id: +amount, data.creditor_id: -amount})
+        add_history(db, group_id, "settlement", {"settlement_id": s.id, "from": data.debtor_id, "to": data.creditor_id, "amount_base": to_major(amount, group.base_currency)})
+        bump_ledger_version(db, group_id)
+        return schemas.SettlementOut(id=s.id, group_id=s.group_id, debtor_id=s.debtor_id, creditor_id=s.creditor_id, amount_base=to_major(s.amount_base_minor, group.base_currency), created_at=s.created_at)
+    return run_idempotent(db, idempotency_key, f"POST /groups/{group_id}/settlements", data, mutation)
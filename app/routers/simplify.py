@@ -1,11 +1,23 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+import os
+from typing import Annotated, Literal
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 from ..database import SessionLocal
 from .. import models, schemas
-from ..services.finance import min_cash_flow, upsert_balance, add_history
+from ..services.finance import apply_balance_deltas, add_history, read_balances
+from ..services.simplification import SimplifyResult, simplify
+from ..services.ledger import require_ledger_version, bump_ledger_version, not_modified
+from ..services.lru import LRUCache
+from ..services.money import to_major
+from ..services.idempotency import IdempotencyKeyHeader, run_idempotent
 
 router = APIRouter()
 
+Strategy = Literal["auto", "greedy", "exact"]
+
+preview_cache = LRUCache(maxsize=int(os.getenv("SIMPLIFY_CACHE_SIZE", "1024")))
+
 def get_db():
     db = SessionLocal()
     try:
@@ -13,24 +25,43 @@ def get_db():
     finally:
         db.close()
 
-@router.post("/preview", response_model=schemas.SimplifyPreviewOut)
-def preview(group_id: int, db: Session = Depends(get_db)):
-    if not db.query(models.Group).get(group_id):
+def plan(db: Session, group_id: int, strategy: str) -> tuple[SimplifyResult, dict]:
+    group = db.query(models.Group).get(group_id)
+    if not group:
         raise HTTPException(status_code=404, detail="Group not found")
-    bals = {b.user_id: b.balance_base for b in db.query(models.Balance).filter_by(group_id=group_id).all()}
-    transfers = [{"from": d, "to": c, "amount": round(a, 2)} for (d, c, a) in min_cash_flow(bals)]
-    return {"transfers": transfers}
+    result = simplify(read_balances(db, group_id), strategy)
+    transfers = [{"from": d, "to": c, "amount": to_major(a, group.base_currency)} for (d, c, a) in result.transfers]
+    return result, {"transfers": transfers, "strategy": result.strategy, "engine": result.engine, "elapsed_ms": result.elapsed_ms}
+
+@router.get("/preview", response_model=schemas.SimplifyPreviewOut)
+@router.post("/preview", response_model=schemas.SimplifyPreviewOut)
+def preview(group_id: int, strategy: Strategy = "auto", if_none_match: Annotated[str | None, Header()] = None,
+            response: Response = None, db: Session = Depends(get_db)):
+    version = require_ledger_version(db, group_id)
+    if (cached := not_modified(group_id, version, if_none_match, response)) is not None:
+        return cached
+    key = (group_id, version, strategy)
+    cached = preview_cache.get(key)
+    if cached is None:
+        cached = plan(db, group_id, strategy)[1]
+        preview_cache.put(key, cached)
+    return cached
 
 @router.post("/apply")
-def apply(group_id: int, db: Session = Depends(get_db)):
-    if not db.query(models.Group).get(group_id):
-        raise HTTPException(status_code=404, detail="Group not found")
-    bals = {b.user_id: b.balance_base for b in db.query(models.Balance).filter_by(group_id=group_id).all()}
-    transfers = [{"from": d, "to": c, "amount": round(a, 2)} for (d, c, a) in min_cash_flow(bals)]
-                          
-    for t in transfers:
-        upsert_balance(db, group_id, t["from"], +t["amount"])
-        upsert_balance(db, group_id, t["to"], -t["amount"])
-    add_history(db, group_id, "settlement", {"auto_simplify": True, "transfers": transfers})
-    db.commit()
-    return {"message": "Simplification applied", "transfers": transfers}
+def apply(group_id: int, strategy: Strategy = "auto", idempotency_key: IdempotencyKeyHeader = None, db: Session = Depends(get_db)):
+    def mutation(db: Session) -> dict:
+        result, out = plan(db, group_id, strategy)
+        deltas: dict[int, int] = {}
+        for d, c, amt in result.transfers:
+            deltas[d] = deltas.get(d, 0) + amt
+            deltas[c] = deltas.get(c, 0) - amt
+        ids = []
+        if result.transfers:
+            ids = db.scalars(insert(models.Settlement).returning(models.Settlement.id, sort_by_parameter_order=True), [
+                {"group_id": group_id, "debtor_id": d, "creditor_id": c, "amount_base_minor": amt} for d, c, amt in result.transfers
+            ]).all()
+        apply_balance_deltas(db, group_id, deltas)
+        add_history(db, group_id, "settlement", {"auto_simplify": True, "transfers": out["transfers"], "engine": out["engine"], "settlement_ids": ids})
+        bump_ledger_version(db, group_id)
+        return {"message": "Simplification applied", **out}
+    return run_idempotent(db, idempotency_key, f"POST /groups/{group_id}/simplify/apply", {"strategy": strategy}, mutation)
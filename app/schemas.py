@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Literal, Union, Annotated
 from datetime import datetime
 
 class UserCreate(BaseModel):
@@ -28,13 +28,19 @@ class AddMember(BaseModel):
 class RateUpsert(BaseModel):
     base: str
     target: str
-    rate: float
+    rate: float = Field(gt=0)
+    as_of: Optional[datetime] = None
+
+class RateBulkIn(BaseModel):
+    as_of: Optional[datetime] = None
+    rates: List[RateUpsert] = Field(min_length=1, max_length=50000)
 
 class ExpenseEqualIn(BaseModel):
     payer_id: int
     amount: float
     currency: str
     description: Optional[str] = "" 
+    created_at: Optional[datetime] = None
     user_ids: List[int]
 
 class ExpenseExactIn(BaseModel):
@@ -42,6 +48,7 @@ class ExpenseExactIn(BaseModel):
     amount: float
     currency: str
     description: Optional[str] = "" 
+    created_at: Optional[datetime] = None
     amounts: Dict[int, float]                     
 
 class ExpensePercentIn(BaseModel):
@@ -49,8 +56,34 @@ class ExpensePercentIn(BaseModel):
     amount: float
     currency: str
     description: Optional[str] = "" 
+    created_at: Optional[datetime] = None
     percentages: Dict[int, float]                      
 
+class ExpenseSharesIn(BaseModel):
+    payer_id: int
+    amount: float
+    currency: str
+    description: Optional[str] = ""
+    created_at: Optional[datetime] = None
+    shares: Dict[int, float]
+
+class ExpenseEqualItem(ExpenseEqualIn):
+    split_type: Literal["equal"]
+
+class ExpenseExactItem(ExpenseExactIn):
+    split_type: Literal["exact"]
+
+class ExpensePercentItem(ExpensePercentIn):
+    split_type: Literal["percentage"]
+
+class ExpenseSharesItem(ExpenseSharesIn):
+    split_type: Literal["shares"]
+
+ExpenseBatchItem = Annotated[Union[ExpenseEqualItem, ExpenseExactItem, ExpensePercentItem, ExpenseSharesItem], Field(discriminator="split_type")]
+
+class ExpenseBatchIn(BaseModel):
+    expenses: List[ExpenseBatchItem] = Field(min_length=1, max_length=1000)
+
 class ExpenseOut(BaseModel):
     id: int
     group_id: int
@@ -59,9 +92,15 @@ class ExpenseOut(BaseModel):
     currency: str
     split_type: str
     description: str
+    fx_rate: Optional[float] = None
+    fx_path: Optional[str] = None
     created_at: datetime
     model_config = ConfigDict(from_attributes=True)
 
+class ExpenseBatchOut(BaseModel):
+    count: int
+    expenses: List[ExpenseOut]
+
 class BalanceOut(BaseModel):
     user_id: int
     balance_base: float
@@ -89,3 +128,6 @@ class HistoryOut(BaseModel):
 
 class SimplifyPreviewOut(BaseModel):
     transfers: List[dict]                      
+    strategy: str
+    engine: str
+    elapsed_ms: float
@@ -0,0 +1,122 @@
+from dataclasses import dataclass
+from decimal import Decimal, localcontext
+from itertools import islice
+from typing import Dict, List, Mapping, Sequence, Tuple
+import numpy as np
+from fastapi import HTTPException
+from .money import to_major
+
+INT64_MAX = np.iinfo(np.int64).max
+WEIGHT_PLACES = 10
+
+@dataclass
+class Allocation:
+    user_ids: np.ndarray
+    amounts: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def total(self) -> int:
+        return int(self.amounts.sum())
+
+    def as_dict(self) -> Dict[int, int]:
+        return dict(zip(self.user_ids.tolist(), self.amounts.tolist()))
+
+    @classmethod
+    def from_dict(cls, shares: Mapping[int, int]) -> "Allocation":
+        return cls(np.fromiter(shares.keys(), dtype=np.int64, count=len(shares)), np.fromiter(shares.values(), dtype=np.int64, count=len(shares)))
+
+def decimals(values: Sequence) -> List[Decimal]:
+    return [Decimal(repr(v)) if isinstance(v, float) else Decimal(v) for v in values]
+
+def scaled_weights(values: Sequence) -> Tuple[np.ndarray, int]:
+    # decimal inputs (percentages, 1.5 shares) become exact integers scaled by a common power of ten, at most WEIGHT_PLACES
+    if all(isinstance(v, (int, np.integer)) for v in values):
+        return np.asarray(values, dtype=np.int64), 0
+    values = decimals(values)
+    if max(map(abs, values)) > INT64_MAX:
+        raise HTTPException(status_code=400, detail="Split weights are too large.")
+    with localcontext(prec=40):
+        quantized = [round(d, WEIGHT_PLACES).normalize() for d in values]
+        shift = max(0, max(-d.as_tuple().exponent for d in quantized))
+        scaled = [int(d.scaleb(shift)) for d in quantized]
+    if max(map(abs, scaled)) > INT64_MAX:
+        raise HTTPException(status_code=400, detail="Split weights are too large.")
+    return np.array(scaled, dtype=np.int64), shift
+
+def largest_remainder(total: int, weights: np.ndarray) -> np.ndarray:
+    if not len(weights):
+        raise HTTPException(status_code=400, detail="Participants cannot be empty.")
+    wsum = int(weights.sum(dtype=object))
+    if wsum <= 0:
+        raise HTTPException(status_code=400, detail="Split weights must be positive.")
+    sign, total = (-1 if total < 0 else 1), abs(int(total))
+    if total and int(np.abs(weights).max()) > INT64_MAX // total:
+        weights = weights.astype(object)
+    product = weights * total
+    floors = product // wsum
+    rems = product - floors * wsum
+    left = total - int(floors.sum())
+    if left:
+        # stable sort on the remainder so ties go to the earlier participant
+        floors[np.argsort(-rems, kind="stable")[:left]] += 1
+    return (floors * sign).astype(np.int64)
+
+def _ids(user_ids: Sequence[int]) -> np.ndarray:
+    return np.fromiter(user_ids, dtype=np.int64, count=len(user_ids))
+
+def equal_shares(total: int, user_ids: Sequence[int]) -> Dict[int, int]:
+    # equal weights leave every remainder tied, so the largest-remainder result is the quotient plus one unit for the first participants
+    if not len(user_ids):
+        raise HTTPException(status_code=400, detail="Participants cannot be empty.")
+    sign, total = (-1, -int(total)) if total < 0 else (1, int(total))
+    per, left = divmod(total, len(user_ids))
+    shares = dict.fromkeys(user_ids, sign * per)
+    if len(shares) != len(user_ids):
+        per, left = divmod(total, len(shares))
+        shares = dict.fromkeys(shares, sign * per)
+    for u in islice(shares, left):
+        shares[u] += sign
+    return shares
+
+def allocate_equal(total: int, user_ids: Sequence[int]) -> Allocation:
+    return Allocation.from_dict(equal_shares(total, user_ids))
+
+def allocate_exact(total: int, amounts: Mapping[int, int], currency: str = "USD") -> Allocation:
+    alloc = Allocation.from_dict(amounts)
+    s = alloc.total()
+    if s != total:
+        raise HTTPException(status_code=400, detail=f"Exact amounts sum ({to_major(s, currency)}) must equal total ({to_major(total, currency)}).")
+    return alloc
+
+def allocate_percentage(total: int, percentages: Mapping[int, float]) -> Allocation:
+    s = round(sum(decimals(list(percentages.values())), Decimal(0)), WEIGHT_PLACES)
+    if s != 100:
+        raise HTTPException(status_code=400, detail=f"Percentages must sum to 100, got {float(s)}.")
+    weights, _ = scaled_weights(list(percentages.values()))
+    return Allocation(_ids(list(percentages)), largest_remainder(total, weights))
+
+def allocate_weighted(total: int, shares: Mapping[int, float]) -> Allocation:
+    weights, _ = scaled_weights(list(shares.values()))
+    if len(weights) and (weights < 0).any():
+        raise HTTPException(status_code=400, detail="Shares cannot be negative.")
+    return Allocation(_ids(list(shares)), largest_remainder(total, weights))
+
+def rebase(alloc: Allocation, total: int, gross: int = 0) -> np.ndarray:
+    # base shares keep the sign of the original ones and always sum to total, so refunds still net to zero
+    s = alloc.total()
+    out = np.zeros(len(alloc), dtype=np.int64)
+    if not len(alloc) or not alloc.amounts.any():
+        return out
+    if s == 0:
+        # zero-sum shares give nothing to scale by; each side gets the converted gross amount instead
+        pos, neg = alloc.amounts > 0, alloc.amounts < 0
+        out[pos] = largest_remainder(gross, alloc.amounts[pos])
+        out[neg] = largest_remainder(-gross, -alloc.amounts[neg])
+        return out
+    return largest_remainder(total, alloc.amounts if s > 0 else -alloc.amounts)
+
+def split_rows(expense_id: int, alloc: Allocation, base: np.ndarray) -> List[dict]:
+    return [{"expense_id": expense_id, "user_id": u, "amount_minor": a, "amount_base_minor": b}
+            for u, a, b in zip(alloc.user_ids.tolist(), alloc.amounts.tolist(), base.tolist())]
@@ -0,0 +1,93 @@
+import json
+import os
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from .. import models, schemas
+from .finance import history_user_ids
+from .lru import LRUCache
+
+SEGMENT_ROWS = int(os.getenv("HISTORY_SEGMENT_ROWS", "5000"))
+RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "365"))
+
+segment_cache = LRUCache(maxsize=int(os.getenv("HISTORY_SEGMENT_CACHE_SIZE", "32")))
+
+def encode_segment(rows: Iterable[models.History]) -> bytes:
+    lines = (json.dumps({"id": r.id, "type": r.type, "created_at": r.created_at.isoformat(), "payload": r.payload}, separators=(",", ":")) for r in rows)
+    return zlib.compress("\n".join(lines).encode(), 6)
+
+def decode_segment(data: bytes) -> List[schemas.HistoryOut]:
+    rows = [schemas.HistoryOut(**json.loads(line)) for line in zlib.decompress(data).decode().splitlines()]
+    rows.sort(key=lambda r: (r.created_at, r.id), reverse=True)
+    return rows
+
+def segment_rows(db: Session, archive_id: int) -> List[schemas.HistoryOut]:
+    # segments never change once written, so decoded ones are cached by id, newest row first
+    rows = segment_cache.get(archive_id)
+    if rows is None:
+        rows = decode_segment(db.query(models.HistoryArchive.data).filter(models.HistoryArchive.id == archive_id).scalar())
+        segment_cache.put(archive_id, rows)
+    return rows
+
+def compact_history(db: Session, older_than: timedelta = timedelta(days=RETENTION_DAYS), group_id: Optional[int] = None, segment_rows: int = SEGMENT_ROWS) -> Dict[str, int]:
+    H, P = models.History, models.HistoryParticipant
+    cutoff = datetime.utcnow() - older_than
+    if group_id is not None:
+        group_ids = [group_id]
+    else:
+        group_ids = [gid for (gid,) in db.query(H.group_id).filter(H.created_at < cutoff).distinct().order_by(H.group_id)]
+    segments = moved = raw = stored = 0
+    for gid in group_ids:
+        # the newest row always stays live so max(History.id) is still the group's head for checkpoints and event replay
+        head = db.query(func.max(H.id)).filter(H.group_id == gid).scalar() or 0
+        while True:
+            rows = db.query(H).filter(H.group_id == gid, H.created_at < cutoff, H.id < head).order_by(H.id).limit(segment_rows).all()
+            if not rows:
+                break
+            data = encode_segment(rows)
+            raw += sum(len(json.dumps(r.payload)) for r in rows)
+            counts: Dict[str, int] = {}
+            for r in rows:
+                counts[r.type] = counts.get(r.type, 0) + 1
+            first, last = rows[0].id, rows[-1].id
+            db.add(models.HistoryArchive(group_id=gid, first_id=first, last_id=last, start_at=min(r.created_at for r in rows), end_at=max(r.created_at for r in rows),
+                                         row_count=len(rows), type_counts=counts, data=data))
+            db.query(P).filter(P.group_id == gid, P.history_id.between(first, last), P.created_at < cutoff).delete(synchronize_session=False)
+            db.query(H).filter(H.group_id == gid, H.id.between(first, last), H.created_at < cutoff).delete(synchronize_session=False)
+            db.commit()
+            segments += 1
+            moved += len(rows)
+            stored += len(data)
+    return {"segments": segments, "rows": moved, "payload_bytes": raw, "archived_bytes": stored}
+
+def archived_history(db: Session, group_id: int, user_id: Optional[int] = None, type: Optional[str] = None, start: Optional[datetime] = None,
+                     end: Optional[datetime] = None, cursor: Optional[tuple] = None) -> Iterator[schemas.HistoryOut]:
+    # newest segment first; a segment is only fetched and decompressed once the caller iterates into its time range
+    A = models.HistoryArchive
+    q = db.query(A.id).filter(A.group_id == group_id)
+    if start:
+        q = q.filter(A.end_at >= start)
+    if end:
+        q = q.filter(A.start_at <= end)
+    if cursor:
+        q = q.filter(A.start_at <= cursor[0])
+    for (archive_id,) in q.order_by(A.end_at.desc(), A.id.desc()).all():
+        for row in segment_rows(db, archive_id):
+            if type and row.type != type:
+                continue
+            if (start and row.created_at < start) or (end and row.created_at > end):
+                continue
+            if cursor and (row.created_at, row.id) >= cursor:
+                continue
+            if user_id is not None and user_id not in history_user_ids(row.payload):
+                continue
+            yield row
+
+def archived_payloads(db: Session, group_id: int, after_id: int, type: str) -> Iterator[dict]:
+    A = models.HistoryArchive
+    for (archive_id,) in db.query(A.id).filter(A.group_id == group_id, A.last_id > after_id).order_by(A.end_at, A.id).all():
+        for row in sorted(segment_rows(db, archive_id), key=lambda r: r.id):
+            if row.id > after_id and row.type == type:
+                yield row.payload
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from sqlalchemy.orm import Session
+
+SUBSCRIBER_QUEUE = int(os.getenv("EVENTS_QUEUE_SIZE", "256"))
+PENDING_EVENTS = "pending_ledger_events"
+
+@dataclass
+class LedgerEvent:
+    group_id: int
+    kind: str  # "history", "balances" or "resync"
+    history_id: Optional[int] = None
+    data: dict = field(default_factory=dict)
+    rendered: dict = field(default_factory=dict, repr=False, compare=False)
+
+def queue_event(db: Session, event: LedgerEvent):
+    db.info.setdefault(PENDING_EVENTS, []).append(event)
+
+def take_events(db: Session) -> List[LedgerEvent]:
+    # history rows first, then one merged balance delta per group, marked with the commit's last history id
+    events = db.info.pop(PENDING_EVENTS, None) or []
+    out, deltas, marks = [], {}, {}
+    for e in events:
+        if e.kind == "balances":
+            merged = deltas.setdefault(e.group_id, {})
+            for uid, delta in e.data.items():
+                merged[uid] = merged.get(uid, 0) + delta
+        else:
+            out.append(e)
+            if e.history_id is not None:
+                marks[e.group_id] = max(marks.get(e.group_id, 0), e.history_id)
+    for gid, merged in deltas.items():
+        merged = {uid: d for uid, d in merged.items() if d}
+        if merged:
+            out.append(LedgerEvent(gid, "balances", marks.get(gid), merged))
+    return out
+
+class Subscription:
+    def __init__(self, group_id: int, loop: asyncio.AbstractEventLoop, maxsize: int):
+        self.group_id = group_id
+        self.loop = loop
+        self.queue: "asyncio.Queue[LedgerEvent]" = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def offer(self, events: List[LedgerEvent]):
+        for e in events:
+            if self.queue.full():
+                # a slow reader loses its backlog and rebuilds from a snapshot instead of holding writers back
+                self.dropped += self.queue.qsize()
+                while not self.queue.empty():
+                    self.queue.get_nowait()
+                self.queue.put_nowait(LedgerEvent(self.group_id, "resync"))
+                return
+            self.queue.put_nowait(e)
+
+class EventBroker:
+    def __init__(self, queue_size: int = SUBSCRIBER_QUEUE):
+        self.queue_size = queue_size
+        self._subs: Dict[int, Dict[Subscription, None]] = {}
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def subscribe(self, group_id: int) -> Subscription:
+        sub = Subscription(group_id, asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            self._subs.setdefault(group_id, {})[sub] = None
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self._lock:
+            subs = self._subs.get(sub.group_id)
+            if subs is not None:
+                subs.pop(sub, None)
+                if not subs:
+                    del self._subs[sub.group_id]
+
+    def publish(self, events: List[LedgerEvent]):
+        by_group: Dict[int, List[LedgerEvent]] = {}
+        for e in events:
+            by_group.setdefault(e.group_id, []).append(e)
+        for gid, group_events in by_group.items():
+            with self._lock:
+                subs = list(self._subs.get(gid, ()))
+            loops: Dict[asyncio.AbstractEventLoop, List[Subscription]] = {}
+            for sub in subs:
+                loops.setdefault(sub.loop, []).append(sub)
+            for loop, loop_subs in loops.items():
+                try:
+                    loop.call_soon_threadsafe(self._deliver, loop_subs, group_events)
+                except RuntimeError:
+                    for sub in loop_subs:
+                        self.unsubscribe(sub)
+            self.published += len(group_events)
+
+    def _deliver(self, subs: List[Subscription], events: List[LedgerEvent]):
+        for sub in subs:
+            sub.offer(events)
+
+    def resync(self, group_id: int):
+        self.publish([LedgerEvent(group_id, "resync")])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"groups": len(self._subs), "subscribers": sum(len(s) for s in self._subs.values()), "published": self.published}
+
+broker = EventBroker()
+
+def publish_pending(db: Session):
+    events = take_events(db)
+    if events:
+        broker.publish(events)
@@ -0,0 +1,82 @@
+import base64
+import csv
+import io
+import json
+import zlib
+from typing import Iterable, Iterator, Tuple
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from fastapi import HTTPException
+from .. import models
+from .money import to_major
+
+EXPORT_BATCH = 1000
+CSV_COLUMNS = ["record", "id", "expense_id", "created_at", "payer_id", "user_id", "debtor_id", "creditor_id",
+               "amount", "currency", "amount_base", "base_currency", "fx_rate", "fx_path", "split_type", "description"]
+
+def encode_watermark(expense_id: int, settlement_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([expense_id, settlement_id]).encode()).decode()
+
+def decode_watermark(token: str) -> Tuple[int, int]:
+    try:
+        expense_id, settlement_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return int(expense_id), int(settlement_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid export watermark")
+
+def high_water(db: Session, group_id: int) -> Tuple[int, int]:
+    # rows above the mark are left to the next incremental export so the watermark never skips anything
+    E, S = models.Expense, models.Settlement
+    return (db.query(func.max(E.id)).filter(E.group_id == group_id).scalar() or 0,
+            db.query(func.max(S.id)).filter(S.group_id == group_id).scalar() or 0)
+
+def ledger_records(db: Session, group: models.Group, since: Tuple[int, int], until: Tuple[int, int]) -> Iterator[dict]:
+    E, X, S = models.Expense, models.ExpenseSplit, models.Settlement
+    base = group.base_currency
+    rows = (select(E.id, E.created_at, E.payer_id, E.amount_minor, E.currency, E.amount_base_minor, E.fx_rate, E.fx_path, E.split_type, E.description,
+                   X.id, X.user_id, X.amount_minor, X.amount_base_minor)
+            .outerjoin(X, X.expense_id == E.id)
+            .where(E.group_id == group.id, E.id > since[0], E.id <= until[0])
+            .order_by(E.id, X.id)
+            .execution_options(yield_per=EXPORT_BATCH))
+    current = None
+    for eid, created_at, payer_id, amount, ccy, amount_base, fx_rate, fx_path, split_type, description, sid, user_id, split_amount, split_base in db.execute(rows):
+        if eid != current:
+            current = eid
+            yield {"record": "expense", "id": eid, "created_at": created_at.isoformat(), "payer_id": payer_id, "amount": to_major(amount, ccy), "currency": ccy,
+                   "amount_base": None if amount_base is None else to_major(amount_base, base), "base_currency": base,
+                   "fx_rate": fx_rate, "fx_path": fx_path, "split_type": split_type, "description": description}
+        if sid is not None:
+            yield {"record": "split", "id": sid, "expense_id": eid, "user_id": user_id, "amount": to_major(split_amount, ccy), "currency": ccy,
+                   "amount_base": to_major(split_base, base), "base_currency": base}
+    settlements = (select(S.id, S.created_at, S.debtor_id, S.creditor_id, S.amount_base_minor)
+                   .where(S.group_id == group.id, S.id > since[1], S.id <= until[1])
+                   .order_by(S.id)
+                   .execution_options(yield_per=EXPORT_BATCH))
+    for sid, created_at, debtor_id, creditor_id, amount in db.execute(settlements):
+        yield {"record": "settlement", "id": sid, "created_at": created_at.isoformat(), "debtor_id": debtor_id, "creditor_id": creditor_id,
+               "amount": to_major(amount, base), "currency": base, "amount_base": to_major(amount, base), "base_currency": base}
+
+def encode(records: Iterable[dict], fmt: str, batch: int = EXPORT_BATCH) -> Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=CSV_COLUMNS, lineterminator="\n") if fmt == "csv" else None
+    if writer:
+        writer.writeheader()
+    for n, rec in enumerate(records, start=1):
+        if writer:
+            writer.writerow(rec)
+        else:
+            buf.write(json.dumps(rec) + "\n")
+        if n % batch == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+def gzipped(chunks: Iterable[str]) -> Iterator[bytes]:
+    z = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        # sync-flush each batch so the client receives data while the export is still running
+        yield z.compress(chunk.encode()) + z.flush(zlib.Z_SYNC_FLUSH)
+    yield z.flush()
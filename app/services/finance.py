@@ -1,99 +1,246 @@
-from typing import Dict, List, Tuple
+import heapq
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import numpy as np
+from sqlalchemy import inspect, insert, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 from fastapi import HTTPException
 from .. import models
+from .fx import rate_cache
+from .events import LedgerEvent, queue_event
+from .ledger import bump_ledger_version
+from .membership import membership_cache
+from .allocation import Allocation, allocate_equal, equal_shares, allocate_exact, allocate_percentage, allocate_weighted, rebase
+from .money import convert_minor, to_minor
 
-def get_rate(db: Session, base: str, target: str) -> float:
+def get_rate(db: Session, base: str, target: str, at: Optional[datetime] = None) -> float:
     if base == target:
         return 1.0
-    fx = db.query(models.CurrencyRate).filter_by(base=base, target=target).first()
-    if not fx:
-        raise HTTPException(status_code=400, detail=f"Missing FX rate {base}->{target}. Add via /rates.")
-    return fx.rate
+    return rate_cache.get(db, base, target, at)
 
-def convert(db: Session, amount: float, src: str, dst: str) -> float:
-    rate = get_rate(db, base=src, target=dst)
+def quote_rate(db: Session, base: str, target: str, at: Optional[datetime] = None) -> Tuple[float, str]:
+    if base == target:
+        return 1.0, base
+    rate, path = rate_cache.quote(db, base, target, at)
+    return rate, ">".join(path)
+
+def convert(db: Session, amount: float, src: str, dst: str, at: Optional[datetime] = None) -> float:
+    rate = get_rate(db, base=src, target=dst, at=at)
     return amount * rate
 
+def ensure_members(db: Session, group_id: int, user_ids: Iterable[int]):
+    missing = membership_cache.missing(db, group_id, user_ids)
+    if len(missing) == 1:
+        raise HTTPException(status_code=404, detail=f"User {missing[0]} is not a member of group {group_id}")
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Users {missing} are not members of group {group_id}")
+
 def ensure_member(db: Session, group_id: int, user_id: int):
-    if not db.query(models.GroupMember).filter_by(group_id=group_id, user_id=user_id).first():
-        raise HTTPException(status_code=404, detail=f"User {user_id} is not a member of group {group_id}")
-
-def upsert_balance(db: Session, group_id: int, user_id: int, delta: float):
-    bal = db.query(models.Balance).filter_by(group_id=group_id, user_id=user_id).first()
-    if not bal:
-        bal = models.Balance(group_id=group_id, user_id=user_id, balance_base=0.0)
-        db.add(bal)
-        db.flush()
-    bal.balance_base = round(bal.balance_base + delta, 10)                      
-    return bal
+    ensure_members(db, group_id, [user_id])
+
+BALANCE_CHUNK = 500
+PENDING_DELTAS = "pending_balance_deltas"
+
+def _upsert_statement(dialect: str, rows: List[dict]):
+    ins = (sqlite_insert if dialect == "sqlite" else pg_insert)(models.Balance).values(rows)
+    return ins.on_conflict_do_update(index_elements=["group_id", "user_id"], set_={"balance_minor": models.Balance.balance_minor + ins.excluded.balance_minor})
+
+def apply_balance_deltas(db: Session, group_id: int, deltas: Dict[int, int]):
+    deltas = {uid: delta for uid, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    queue_event(db, LedgerEvent(group_id, "balances", data=deltas))
+    pending = db.info.get(PENDING_DELTAS)
+    if pending is not None:
+        for uid, delta in deltas.items():
+            pending[(group_id, uid)] = pending.get((group_id, uid), 0) + delta
+        return
+    write_balance_deltas(db, group_id, deltas)
+
+def write_balance_deltas(db: Session, group_id: int, deltas: Dict[int, int]):
+    db.flush()
+    rows = [{"group_id": group_id, "user_id": uid, "balance_minor": delta} for uid, delta in sorted(deltas.items())]
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        for i in range(0, len(rows), BALANCE_CHUNK):
+            db.execute(_upsert_statement(dialect, rows[i:i + BALANCE_CHUNK]))
+    else:
+        bal = models.Balance.__table__
+        for row in rows:
+            res = db.execute(update(bal).where(bal.c.group_id == row["group_id"], bal.c.user_id == row["user_id"]).values(balance_minor=bal.c.balance_minor + row["balance_minor"]))
+            if res.rowcount == 0:
+                db.execute(insert(bal).values(**row))
+    for obj in list(db.identity_map.values()):
+        state = inspect(obj)
+        if isinstance(obj, models.Balance) and state.dict.get("group_id") == group_id and state.dict.get("user_id") in deltas:
+            db.expire(obj)
+
+def read_balances(db: Session, group_id: int, user_ids: Iterable[int] = None) -> Dict[int, int]:
+    q = db.query(models.Balance.user_id, models.Balance.balance_minor).filter(models.Balance.group_id == group_id)
+    if user_ids is not None:
+        q = q.filter(models.Balance.user_id.in_(list(user_ids)))
+    bals = dict(q.all())
+    for (gid, uid), delta in (db.info.get(PENDING_DELTAS) or {}).items():
+        if gid == group_id and (user_ids is None or uid in user_ids):
+            bals[uid] = bals.get(uid, 0) + delta
+    return bals
+
+def upsert_balance(db: Session, group_id: int, user_id: int, delta: int):
+    apply_balance_deltas(db, group_id, {user_id: delta})
+
+def history_user_ids(payload: dict) -> List[int]:
+    p = payload or {}
+    ids = {p.get("payer_id"), p.get("from"), p.get("to")}
+    ids.update(p.get("participants") or [])
+    ids.update(p.get("previous_participants") or [])
+    ids.update(p.get("amounts") or {})
+    ids.update(p.get("percentages") or {})
+    ids.update(p.get("shares") or {})
+    for t in p.get("transfers") or []:
+        ids.update((t.get("from"), t.get("to")))
+    return sorted({int(u) for u in ids if u is not None})
+
+def _participant_rows(group_id: int, history_id: int, created_at, payload: dict) -> List[dict]:
+    return [{"history_id": history_id, "user_id": uid, "group_id": group_id, "created_at": created_at} for uid in history_user_ids(payload)]
+
+def history_event(group_id: int, history_id: int, type_: str, created_at: datetime, payload: dict) -> LedgerEvent:
+    return LedgerEvent(group_id, "history", history_id, {"type": type_, "created_at": created_at.isoformat(), "payload": payload})
 
 def add_history(db: Session, group_id: int, type_: str, payload: dict):
     h = models.History(group_id=group_id, type=type_, payload=payload)
     db.add(h)
+    db.flush()
+    rows = _participant_rows(group_id, h.id, h.created_at, payload)
+    if rows:
+        db.execute(insert(models.HistoryParticipant), rows)
+    queue_event(db, history_event(group_id, h.id, type_, h.created_at, payload))
     return h
 
-def split_equal(amount: float, participants: List[int]) -> Dict[int, float]:
-    if not participants:
-        raise HTTPException(status_code=400, detail="Participants cannot be empty.")
-    per = round(amount / len(participants), 10)
-                                             
-    shares = {u: per for u in participants}
-    total_assigned = per * len(participants)
-    residue = round(amount - total_assigned, 10)
-    if residue != 0:
-        last = participants[-1]
-        shares[last] = round(shares[last] + residue, 10)
-    return shares
-
-def validate_exact(amount: float, amounts: Dict[int, float]):
-    s = round(sum(amounts.values()), 10)
-    if s != round(amount, 10):
-        raise HTTPException(status_code=400, detail=f"Exact amounts sum ({s}) must equal total ({amount}).")    
-
-def validate_percent(amount: float, percentages: Dict[int, float]):
-    s = round(sum(percentages.values()), 10)
-    if s != 100.0:
-        raise HTTPException(status_code=400, detail=f"Percentages must sum to 100, got {s}.")
-
-def apply_expense(db: Session, group: models.Group, payer_id: int, amount: float, currency: str, shares: Dict[int, float]):
-                                      
-    for uid in shares.keys():
-        ensure_member(db, group.id, uid)
-    ensure_member(db, group.id, payer_id)
-
-    \
-    total_in_base = convert(db, amount, currency, group.base_currency)
-
-    \
-    for uid, share in shares.items():
-        share_base = convert(db, share, currency, group.base_currency)
-        upsert_balance(db, group.id, uid, -share_base)
-
-    upsert_balance(db, group.id, payer_id, total_in_base)
-
-def min_cash_flow(balances: Dict[int, float]) -> List[Tuple[int, int, float]]:
-                                                                                 
-    creditors = [(u, amt) for u, amt in balances.items() if amt > 1e-9]
-    debtors = [(u, -amt) for u, amt in balances.items() if amt < -1e-9]
-    creditors.sort(key=lambda x: x[1], reverse=True)
-    debtors.sort(key=lambda x: x[1], reverse=True)
-
-    i = j = 0
+def add_history_bulk(db: Session, group_id: int, entries: List[Tuple[str, dict]]):
+    if not entries:
+        return []
+    rows = db.execute(insert(models.History).returning(models.History.id, models.History.created_at, sort_by_parameter_order=True),
+                      [{"group_id": group_id, "type": type_, "payload": payload} for type_, payload in entries]).all()
+    participants = [r for (hid, created_at), (_, payload) in zip(rows, entries) for r in _participant_rows(group_id, hid, created_at, payload)]
+    if participants:
+        db.execute(insert(models.HistoryParticipant), participants)
+    for (hid, created_at), (type_, payload) in zip(rows, entries):
+        queue_event(db, history_event(group_id, hid, type_, created_at, payload))
+    return [hid for hid, _ in rows]
+
+def split_equal(amount_minor: int, participants: List[int]) -> Dict[int, int]:
+    return equal_shares(amount_minor, participants)
+
+def validate_exact(amount_minor: int, amounts: Dict[int, int], currency: str = "USD"):
+    allocate_exact(amount_minor, amounts, currency)
+
+def validate_percent(amount_minor: int, percentages: Dict[int, float]):
+    allocate_percentage(amount_minor, percentages)
+
+def compute_shares(split_type: str, data) -> Allocation:
+    currency = data.currency.upper()
+    total = to_minor(data.amount, currency)
+    if split_type == "equal":
+        return allocate_equal(total, data.user_ids)
+    if split_type == "exact":
+        return allocate_exact(total, {uid: to_minor(a, currency) for uid, a in data.amounts.items()}, currency)
+    if split_type == "percentage":
+        return allocate_percentage(total, data.percentages)
+    if split_type == "shares":
+        return allocate_weighted(total, data.shares)
+    raise HTTPException(status_code=400, detail=f"Unknown split type {split_type}.")
+
+@dataclass
+class PricedExpense:
+    rate: float
+    fx_path: str
+    amount_base: int
+    shares_base: np.ndarray
+    deltas: Dict[int, int]
+
+def price_expense(db: Session, group: models.Group, payer_id: int, amount_minor: int, currency: str, shares: Union[Allocation, Dict[int, int]], at: Optional[datetime] = None) -> PricedExpense:
+    if not isinstance(shares, Allocation):
+        shares = Allocation.from_dict(shares)
+    rate, fx_path = quote_rate(db, currency, group.base_currency, at)
+    amount_base = convert_minor(amount_minor, rate, currency, group.base_currency)
+    gross = convert_minor(int(shares.amounts[shares.amounts > 0].sum()), rate, currency, group.base_currency) if len(shares) and not shares.total() else 0
+    shares_base = rebase(shares, amount_base, gross)
+    deltas: Dict[int, int] = dict(zip(shares.user_ids.tolist(), (-shares_base).tolist()))
+    deltas[payer_id] = deltas.get(payer_id, 0) + amount_base
+    return PricedExpense(rate, fx_path, amount_base, shares_base, deltas)
+
+def apply_expense(db: Session, group: models.Group, payer_id: int, amount_minor: int, currency: str, shares: Union[Allocation, Dict[int, int]], at: Optional[datetime] = None) -> PricedExpense:
+    if not isinstance(shares, Allocation):
+        shares = Allocation.from_dict(shares)
+    ensure_members(db, group.id, [*shares.user_ids.tolist(), payer_id])
+    priced = price_expense(db, group, payer_id, amount_minor, currency, shares, at)
+    apply_balance_deltas(db, group.id, priced.deltas)
+    return priced
+
+def min_cash_flow(balances: Dict[int, int]) -> List[Tuple[int, int, int]]:
+    debtors = [(amt, u) for u, amt in balances.items() if amt < 0]
+    creditors = [(-amt, u) for u, amt in balances.items() if amt > 0]
+    heapq.heapify(debtors)
+    heapq.heapify(creditors)
+
     transfers = []
-    while i < len(debtors) and j < len(creditors):
-        d_id, d_amt = debtors[i]
-        c_id, c_amt = creditors[j]
-        pay = round(min(d_amt, c_amt), 10)
+    while debtors and creditors:
+        d_amt, d_id = heapq.heappop(debtors)
+        c_amt, c_id = heapq.heappop(creditors)
+        d_amt, c_amt = -d_amt, -c_amt
+        pay = min(d_amt, c_amt)
         transfers.append((d_id, c_id, pay))
-        d_amt = round(d_amt - pay, 10)
-        c_amt = round(c_amt - pay, 10)
-        if d_amt <= 1e-9:
-            i += 1
-        else:
-            debtors[i] = (d_id, d_amt)
-        if c_amt <= 1e-9:
-            j += 1
-        else:
-            creditors[j] = (c_id, c_amt)
+        if d_amt > pay:
+            heapq.heappush(debtors, (pay - d_amt, d_id))
+        if c_amt > pay:
+            heapq.heappush(creditors, (pay - c_amt, c_id))
     return transfers
+
+def backfill_base_amounts(db: Session, batch_size: int = 1000) -> Dict[str, int]:
+    done, skipped, last_id = 0, [], 0
+    while True:
+        rows = (db.query(models.Expense, models.Group)
+                .join(models.Group, models.Group.id == models.Expense.group_id)
+                .filter(models.Expense.amount_base_minor.is_(None), models.Expense.id > last_id)
+                .order_by(models.Expense.id).limit(batch_size).all())
+        if not rows:
+            break
+        for exp, group in rows:
+            last_id = exp.id
+            splits = db.query(models.ExpenseSplit).filter_by(expense_id=exp.id).all()
+            try:
+                priced = price_expense(db, group, exp.payer_id, exp.amount_minor, exp.currency, {s.user_id: s.amount_minor for s in splits}, exp.created_at)
+            except HTTPException:
+                skipped.append(exp.id)
+                continue
+            exp.amount_base_minor, exp.fx_rate, exp.fx_path = priced.amount_base, priced.rate, priced.fx_path
+            for split, base in zip(splits, priced.shares_base.tolist()):
+                split.amount_base_minor = base
+            done += 1
+        for group_id in {group.id for _, group in rows}:
+            bump_ledger_version(db, group_id)
+        db.commit()
+    return {"backfilled": done, "skipped": len(skipped), "skipped_expense_ids": skipped}
+
+def backfill_history_participants(db: Session, batch_size: int = 1000) -> Dict[str, int]:
+    done, last_id = 0, 0
+    hp = models.HistoryParticipant
+    while True:
+        rows = (db.query(models.History)
+                .outerjoin(hp, hp.history_id == models.History.id)
+                .filter(hp.history_id.is_(None), models.History.id > last_id)
+                .order_by(models.History.id).limit(batch_size).all())
+        if not rows:
+            break
+        participants = []
+        for h in rows:
+            last_id = h.id
+            participants.extend(_participant_rows(h.group_id, h.id, h.created_at, h.payload))
+        if participants:
+            db.execute(insert(hp), participants)
+        done += len(rows)
+        db.commit()
+    return {"history_rows": done}
@@ -0,0 +1,229 @@
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import func, insert, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from fastapi import HTTPException
+from .. import models
+from .lru import LRUCache
+
+FX_VERSION_KEY = "fx"
+FX_CACHE_TTL = float(os.getenv("FX_CACHE_TTL", "5"))
+RATE_CHUNK = 500
+FX_SPAN_CACHE = int(os.getenv("FX_SPAN_CACHE_SIZE", "1024"))
+
+def read_version(db: Session, name: str) -> int:
+    row = db.get(models.CacheVersion, name)
+    return row.version if row else 0
+
+def bump_version(db: Session, name: str) -> int:
+    res = db.execute(update(models.CacheVersion).where(models.CacheVersion.name == name).values(version=models.CacheVersion.version + 1))
+    if res.rowcount == 0:
+        db.add(models.CacheVersion(name=name, version=1))
+        db.flush()
+    return db.query(models.CacheVersion.version).filter_by(name=name).scalar()
+
+def naive_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    if dt is not None and dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+def default_as_of(db: Session, pairs: List[Tuple[str, str]], now: Optional[datetime] = None) -> Dict[Tuple[str, str], datetime]:
+    # a rate posted without as_of applies from the start of the UTC day, or replaces the pair's current rate if one was set later that day,
+    # so a feed that re-posts rates during the day keeps updating one point instead of opening a new span each time
+    now = now or datetime.utcnow()
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    R, out = models.CurrencyRate, {}
+    for base, target in dict.fromkeys(pairs):
+        latest = db.query(func.max(R.as_of)).filter(R.base == base, R.target == target, R.as_of >= day, R.as_of <= now).scalar()
+        out[(base, target)] = latest or day
+    return out
+
+# per pair: as_of timestamps ascending and the rates effective from each of them
+Series = Tuple[List[datetime], List[float]]
+
+INVERSE_COST = 1.001  # a quoted rate in either direction beats its derived inverse; both beat any two-hop path
+
+# pairwise rates between every currency; each span between rate changes gets its own n x n closure, computed on first use
+class RateClosure:
+    def __init__(self, series: Dict[Tuple[str, str], Series], previous: Optional["RateClosure"] = None, changed_from: Optional[datetime] = None):
+        self.series = series
+        self.currencies = sorted({c for pair in series for c in pair})
+        self.index = {c: i for i, c in enumerate(self.currencies)}
+        self.times = sorted({t for times, _ in series.values() for t in times})
+        self.spans = LRUCache(maxsize=FX_SPAN_CACHE)
+        if previous is not None and previous.currencies == self.currencies:
+            # a rate change at changed_from leaves every span that starts before it untouched
+            for start, matrices in previous.spans.items():
+                if changed_from is None or start < changed_from:
+                    self.spans.put(start, matrices)
+        n, first_span = len(self.currencies), {t: k for k, t in enumerate(self.times)}
+        # the first span in which each pair is connected: a minimax closure over the span index each direct pair first appears in
+        reach = np.full((n, n), len(self.times), dtype=np.int64)
+        reach[np.arange(n), np.arange(n)] = 0
+        for (base, target), (times, _) in series.items():
+            i, j = self.index[base], self.index[target]
+            reach[i, j] = reach[j, i] = min(reach[i, j], first_span[times[0]])
+        for k in range(n):
+            reach = np.minimum(reach, np.maximum(reach[:, k:k + 1], reach[k:k + 1, :]))
+        self.reach = reach
+
+    def span(self, at: Optional[datetime]) -> int:
+        return len(self.times) - 1 if at is None else bisect_right(self.times, at) - 1
+
+    def matrices(self, s: int) -> Tuple[np.ndarray, np.ndarray]:
+        start = self.times[s]
+        found = self.spans.get(start)
+        if found is None:
+            found = self._close(start)
+            self.spans.put(start, found)
+        return found
+
+    def _close(self, start: datetime) -> Tuple[np.ndarray, np.ndarray]:
+        n = len(self.currencies)
+        rates, cost = np.full((n, n), np.nan), np.full((n, n), np.inf)
+        nxt = np.full((n, n), -1, dtype=np.int32)
+        diag = np.arange(n)
+        rates[diag, diag], cost[diag, diag], nxt[diag, diag] = 1.0, 0.0, diag
+        effective = []
+        for (base, target), (times, values) in self.series.items():
+            pos = bisect_right(times, start) - 1
+            if base != target and pos >= 0:
+                effective.append((self.index[base], self.index[target], values[pos]))
+        for i, j, rate in effective:
+            rates[j, i], cost[j, i], nxt[j, i] = 1.0 / rate, INVERSE_COST, i
+        for i, j, rate in effective:
+            rates[i, j], cost[i, j], nxt[i, j] = rate, 1.0, j
+        # Floyd-Warshall on hop cost; the rate is the product along the chosen path
+        for k in range(n):
+            via = cost[:, k:k + 1] + cost[k:k + 1, :]
+            better = via < cost
+            cost = np.where(better, via, cost)
+            rates = np.where(better, rates[:, k:k + 1] * rates[k:k + 1, :], rates)
+            nxt = np.where(better, nxt[:, k:k + 1], nxt)
+        return rates, nxt
+
+    def quote(self, base: str, target: str, at: Optional[datetime] = None) -> Optional[Tuple[float, List[str]]]:
+        i, j, s = self.index.get(base), self.index.get(target), self.span(at)
+        if i is None or j is None or s < 0 or self.reach[i, j] > s:
+            return None
+        rates, nxt = self.matrices(s)
+        path = [i]
+        while path[-1] != j:
+            path.append(int(nxt[path[-1], j]))
+        return float(rates[i, j]), [self.currencies[c] for c in path]
+
+    def earliest(self, base: str, target: str) -> Optional[datetime]:
+        i, j = self.index.get(base), self.index.get(target)
+        if i is None or j is None or self.reach[i, j] >= len(self.times):
+            return None
+        return self.times[self.reach[i, j]]
+
+class RateCache:
+    def __init__(self, ttl: float = FX_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._series: Dict[Tuple[str, str], Series] = {}
+            self._closure: Optional[RateClosure] = None
+            self.version = 0
+            self.hits = self.misses = self.reloads = 0
+            self._checked_at = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._closure = None
+
+    def _load(self, db: Session) -> RateClosure:
+        version = read_version(db, FX_VERSION_KEY)
+        series: Dict[Tuple[str, str], Series] = {}
+        R = models.CurrencyRate
+        for base, target, as_of, rate in db.query(R.base, R.target, R.as_of, R.rate).order_by(R.base, R.target, R.as_of):
+            times, values = series.setdefault((base, target), ([], []))
+            times.append(as_of)
+            values.append(rate)
+        closure = RateClosure(series)
+        with self._lock:
+            self._series, self._closure, self.version = series, closure, version
+            self._checked_at = time.monotonic()
+            self.reloads += 1
+        return closure
+
+    def _current(self, db: Session) -> RateClosure:
+        closure = self._closure
+        if closure is None:
+            return self._load(db)
+        if time.monotonic() - self._checked_at >= self.ttl:
+            self._checked_at = time.monotonic()
+            if read_version(db, FX_VERSION_KEY) != self.version:
+                return self._load(db)
+        return closure
+
+    def quote(self, db: Session, base: str, target: str, at: Optional[datetime] = None) -> Tuple[float, List[str]]:
+        closure = self._current(db)
+        found = closure.quote(base, target, at)
+        if found is None and closure.earliest(base, target) is None:
+            self.misses += 1
+            closure = self._load(db)
+            found = closure.quote(base, target, at)
+        else:
+            self.hits += 1
+        if found is None:
+            earliest = closure.earliest(base, target)
+            if earliest is None:
+                raise HTTPException(status_code=400, detail=f"Missing FX rate {base}->{target}. Add via /rates.")
+            raise HTTPException(status_code=400, detail=f"No FX rate {base}->{target} effective at {at.isoformat()}; the earliest is {earliest.isoformat()}.")
+        return found
+
+    def get(self, db: Session, base: str, target: str, at: Optional[datetime] = None) -> float:
+        return self.quote(db, base, target, at)[0]
+
+    def put(self, base: str, target: str, rate: float, as_of: datetime, version: int):
+        with self._lock:
+            if self._closure is None:
+                return
+            if version != self.version + 1:
+                self._closure = None
+                return
+            times, values = self._series.get((base, target), ([], []))
+            times, values = list(times), list(values)
+            i = bisect_left(times, as_of)
+            if i < len(times) and times[i] == as_of:
+                values[i] = rate
+            else:
+                times.insert(i, as_of)
+                values.insert(i, rate)
+            series = dict(self._series)
+            series[(base, target)] = (times, values)
+            self._series, self._closure, self.version = series, RateClosure(series, self._closure, as_of), version
+
+    def stats(self) -> dict:
+        closure = self._closure
+        return {"version": self.version, "loaded": closure is not None, "size": len(self._series), "points": sum(len(t) for t, _ in self._series.values()),
+                "currencies": len(closure.currencies) if closure else 0, "spans": len(closure.times) if closure else 0,
+                "closed_spans": len(closure.spans) if closure else 0,
+                "hits": self.hits, "misses": self.misses, "reloads": self.reloads}
+
+rate_cache = RateCache()
+
+def upsert_rates(db: Session, rows: List[dict]):
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        ins = (sqlite_insert if dialect == "sqlite" else pg_insert)(models.CurrencyRate)
+        for i in range(0, len(rows), RATE_CHUNK):
+            db.execute(ins.on_conflict_do_update(index_elements=["base", "target", "as_of"], set_={"rate": ins.excluded.rate}), rows[i:i + RATE_CHUNK])
+        return
+    R = models.CurrencyRate.__table__
+    for row in rows:
+        res = db.execute(update(R).where(R.c.base == row["base"], R.c.target == row["target"], R.c.as_of == row["as_of"]).values(rate=row["rate"]))
+        if res.rowcount == 0:
+            db.execute(insert(R).values(**row))
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Annotated, Any, Dict, Optional, Tuple
+from fastapi import Header, HTTPException
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from .. import models
+from .lru import LRUCache
+from .writer import Mutation, run_write
+
+IdempotencyKeyHeader = Annotated[Optional[str], Header(max_length=255)]
+
+WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "30"))
+
+response_cache = LRUCache(maxsize=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000")))
+_inflight: Dict[str, threading.Event] = {}
+_lock = threading.Lock()
+
+def request_hash(scope: str, body: Any) -> str:
+    raw = json.dumps([scope, jsonable_encoder(body)], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def stored_response(db: Session, key: str) -> Optional[Tuple[str, Any]]:
+    hit = response_cache.get(key)
+    if hit is None:
+        row = db.get(models.IdempotencyKey, key)
+        if row is None:
+            return None
+        hit = (row.request_hash, row.response)
+        response_cache.put(key, hit)
+    return hit
+
+def _replay(hit: Tuple[str, Any], fingerprint: str) -> Any:
+    if hit[0] != fingerprint:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request.")
+    return hit[1]
+
+def run_idempotent(db: Session, key: Optional[str], scope: str, body: Any, mutation: Mutation) -> Any:
+    if not key:
+        return run_write(db, mutation)
+    fingerprint = request_hash(scope, body)
+    while True:
+        if (hit := stored_response(db, key)) is not None:
+            return _replay(hit, fingerprint)
+        with _lock:
+            first = _inflight.get(key)
+            if first is None:
+                _inflight[key] = mine = threading.Event()
+        if first is None:
+            break
+        # a duplicate in this process waits for the first attempt, then replays its response or retries if it failed
+        first.wait(WAIT_SECONDS)
+
+    def recorded(db: Session) -> Any:
+        result = jsonable_encoder(mutation(db))
+        db.add(models.IdempotencyKey(key=key, request_hash=fingerprint, response=result))
+        db.flush()
+        return result
+
+    try:
+        try:
+            result = run_write(db, recorded)
+        except IntegrityError:
+            # another worker committed the same key first; its transaction won and ours rolled back
+            db.rollback()
+            if (hit := stored_response(db, key)) is None:
+                raise
+            return _replay(hit, fingerprint)
+        response_cache.put(key, (fingerprint, result))
+        return result
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+        mine.set()
+
+def purge_keys(db: Session, older_than: timedelta) -> Dict[str, int]:
+    cutoff = datetime.utcnow() - older_than
+    deleted = db.query(models.IdempotencyKey).filter(models.IdempotencyKey.created_at < cutoff).delete(synchronize_session=False)
+    db.commit()
+    response_cache.clear()
+    return {"deleted": deleted}
@@ -0,0 +1,71 @@
+import csv
+import io
+import json
+from decimal import InvalidOperation
+from itertools import islice
+from typing import BinaryIO, Iterable, Iterator, List, Tuple, TypeVar
+from pydantic import TypeAdapter, ValidationError
+from .. import schemas
+
+T = TypeVar("T")
+
+FORMATS = ("csv", "jsonl")
+ITEM = TypeAdapter(schemas.ExpenseBatchItem)
+SPLIT_VALUE_FIELDS = {"exact": "amounts", "percentage": "percentages", "shares": "shares"}
+
+def guess_format(filename: str | None) -> str:
+    return "jsonl" if filename and filename.lower().endswith((".jsonl", ".ndjson")) else "csv"
+
+def records(stream: BinaryIO, fmt: str) -> Iterator[Tuple[int, object]]:
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_no, line in enumerate(text, start=1):
+        if line.strip():
+            yield line_no, line
+
+def _split_pairs(split: str) -> dict:
+    pairs = {}
+    for part in filter(None, (p.strip() for p in split.split(";"))):
+        uid, sep, value = part.partition(":")
+        if not sep:
+            raise ValueError(f"split entry {part!r} must look like user_id:value")
+        pairs[uid.strip()] = value.strip()
+    return pairs
+
+def csv_fields(row: dict) -> dict:
+    split_type = (row.get("split_type") or "equal").strip().lower()
+    fields = {"split_type": split_type, "payer_id": row.get("payer_id"), "amount": row.get("amount"), "currency": row.get("currency"),
+              "description": row.get("description") or "", "created_at": row.get("created_at") or None}
+    split = row.get("split") or ""
+    if split_type == "equal":
+        fields["user_ids"] = [p.strip() for p in split.split(";") if p.strip()]
+    elif split_type in SPLIT_VALUE_FIELDS:
+        fields[SPLIT_VALUE_FIELDS[split_type]] = _split_pairs(split)
+    return fields
+
+def to_item(fmt: str, raw, base_currency: str, members: Iterable[int]):
+    fields = csv_fields(raw) if fmt == "csv" else json.loads(raw)
+    if not isinstance(fields, dict):
+        raise ValueError("each line must be a JSON object")
+    fields.setdefault("split_type", "equal")
+    if not fields.get("currency"):
+        fields["currency"] = base_currency
+    if fields["split_type"] == "equal" and not fields.get("user_ids"):
+        fields["user_ids"] = sorted(members)
+    return ITEM.validate_python(fields)
+
+def error_detail(exc: Exception):
+    if isinstance(exc, ValidationError):
+        return "; ".join(f"{'.'.join(str(p) for p in e['loc'])}: {e['msg']}" for e in exc.errors(include_url=False))
+    if isinstance(exc, InvalidOperation):
+        return "Invalid number."
+    return getattr(exc, "detail", None) or str(exc)
+
+def chunked(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    it = iter(items)
+    while chunk := list(islice(it, size)):
+        yield chunk
@@ -0,0 +1,34 @@
+from typing import Optional
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from fastapi import HTTPException, Response
+from .. import models
+
+def ledger_version(db: Session, group_id: int) -> Optional[int]:
+    return db.query(models.Group.ledger_version).filter(models.Group.id == group_id).scalar()
+
+def require_ledger_version(db: Session, group_id: int) -> int:
+    version = ledger_version(db, group_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    return version
+
+def bump_ledger_version(db: Session, group_id: int):
+    db.execute(update(models.Group).where(models.Group.id == group_id).values(ledger_version=models.Group.ledger_version + 1))
+
+def etag(group_id: int, version: int) -> str:
+    return f'"g{group_id}-v{version}"'
+
+def etag_matches(header: Optional[str], tag: str) -> bool:
+    if not header:
+        return False
+    return header.strip() == "*" or tag in (t.strip().removeprefix("W/") for t in header.split(","))
+
+def not_modified(group_id: int, version: int, header: Optional[str], response: Optional[Response]) -> Optional[Response]:
+    # callers read the version before the payload, so a racing write can only make the tag older than the body, never newer
+    tag = etag(group_id, version)
+    if etag_matches(header, tag):
+        return Response(status_code=304, headers={"ETag": tag})
+    if response is not None:
+        response.headers["ETag"] = tag
+    return None
@@ -0,0 +1,45 @@
+import threading
+from typing import Dict, Iterable, List, Set
+from sqlalchemy.orm import Session
+from .. import models
+
+class MembershipCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._groups: Dict[int, frozenset] = {}
+            self.hits = self.misses = 0
+
+    def members(self, db: Session, group_id: int) -> frozenset:
+        members = self._groups.get(group_id)
+        if members is None:
+            members = frozenset(uid for (uid,) in db.query(models.GroupMember.user_id).filter_by(group_id=group_id))
+            with self._lock:
+                self._groups[group_id] = members | self._groups.get(group_id, frozenset())
+        return members
+
+    def missing(self, db: Session, group_id: int, user_ids: Iterable[int]) -> List[int]:
+        wanted: Set[int] = set(user_ids)
+        unknown = wanted - self.members(db, group_id)
+        if not unknown:
+            self.hits += 1
+            return []
+        self.misses += 1
+        found = {uid for (uid,) in db.query(models.GroupMember.user_id).filter(models.GroupMember.group_id == group_id, models.GroupMember.user_id.in_(unknown))}
+        for uid in found:
+            self.add(group_id, uid)
+        return sorted(unknown - found)
+
+    def add(self, group_id: int, user_id: int):
+        with self._lock:
+            members = self._groups.get(group_id)
+            if members is not None:
+                self._groups[group_id] = members | {user_id}
+
+    def stats(self) -> dict:
+        return {"groups": len(self._groups), "hits": self.hits, "misses": self.misses}
+
+membership_cache = MembershipCache()
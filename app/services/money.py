@@ -0,0 +1,32 @@
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict
+from fastapi import HTTPException
+
+MINOR_MAX = 2 ** 63 - 1
+DEFAULT_EXPONENT = 2
+CURRENCY_EXPONENTS: Dict[str, int] = {
+    "BIF": 0, "CLP": 0, "DJF": 0, "GNF": 0, "ISK": 0, "JPY": 0, "KMF": 0, "KRW": 0, "PYG": 0,
+    "RWF": 0, "UGX": 0, "UYI": 0, "VND": 0, "VUV": 0, "XAF": 0, "XOF": 0, "XPF": 0,
+    "BHD": 3, "IQD": 3, "JOD": 3, "KWD": 3, "LYD": 3, "OMR": 3, "TND": 3,
+    "CLF": 4, "UYW": 4,
+}
+
+def exponent(currency: str) -> int:
+    return CURRENCY_EXPONENTS.get(currency.upper(), DEFAULT_EXPONENT)
+
+def _minor(value: Decimal) -> int:
+    # balances are signed 64-bit integers, so anything that cannot be stored is rejected before it reaches the database
+    if not value.is_finite():
+        raise HTTPException(status_code=400, detail="Amount must be a finite number.")
+    if abs(value) > MINOR_MAX:
+        raise HTTPException(status_code=400, detail="Amount is too large.")
+    return int(value.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def to_minor(amount: float, currency: str) -> int:
+    return _minor(Decimal(repr(amount)).scaleb(exponent(currency)))
+
+def to_major(minor: int, currency: str) -> float:
+    return float(Decimal(int(minor)).scaleb(-exponent(currency)))
+
+def convert_minor(minor: int, rate: float, src: str, dst: str) -> int:
+    return _minor(Decimal(int(minor)) * Decimal(repr(rate)) * Decimal(10) ** (exponent(dst) - exponent(src)))
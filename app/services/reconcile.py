@@ -0,0 +1,122 @@
+from itertools import chain
+from typing import Dict, List, Optional
+from sqlalchemy import func, update
+from sqlalchemy.orm import Session
+from fastapi import HTTPException
+from .. import models
+from .archive import archived_payloads
+from .events import PENDING_EVENTS, broker
+from .finance import apply_balance_deltas
+from .ledger import ledger_version
+from .money import to_major, to_minor
+
+MAX_ATTEMPTS = 5
+HISTORY_BATCH = 500
+
+def _add(target: Dict[int, int], rows, sign: int = 1):
+    for uid, amount in rows:
+        if amount:
+            target[uid] = target.get(uid, 0) + sign * int(amount)
+
+def _marks(db: Session, model, group_id: int):
+    count, last = db.query(func.count(model.id), func.max(model.id)).filter(model.group_id == group_id).one()
+    return count, last or 0
+
+def _checkpoint_valid(db: Session, cp: models.LedgerCheckpoint) -> bool:
+    # a row committed late with a lower id, or a deleted one, shifts the count below the mark
+    for model, last, count in ((models.Expense, cp.expense_id, cp.expense_count), (models.Settlement, cp.settlement_id, cp.settlement_count)):
+        if db.query(func.count(model.id)).filter(model.group_id == cp.group_id, model.id <= last).scalar() != count:
+            return False
+    return True
+
+def recompute(db: Session, group: models.Group, cp: Optional[models.LedgerCheckpoint]) -> dict:
+    gid = group.id
+    expected = {int(uid): amt for uid, amt in cp.balances.items()} if cp else {}
+    e0, s0, h0 = (cp.expense_id, cp.settlement_id, cp.history_id) if cp else (0, 0, 0)
+    E, S = models.Expense, models.Settlement
+    new_expenses = [E.group_id == gid, E.id > e0]
+
+    unpriced = db.query(func.count(E.id)).filter(*new_expenses, E.amount_base_minor.is_(None)).scalar()
+    _add(expected, db.query(E.payer_id, func.sum(E.amount_base_minor)).filter(*new_expenses).group_by(E.payer_id))
+    _add(expected, db.query(models.ExpenseSplit.user_id, func.sum(models.ExpenseSplit.amount_base_minor))
+         .join(E, E.id == models.ExpenseSplit.expense_id).filter(*new_expenses).group_by(models.ExpenseSplit.user_id), -1)
+    new_settlements = [S.group_id == gid, S.id > s0]
+    _add(expected, db.query(S.debtor_id, func.sum(S.amount_base_minor)).filter(*new_settlements).group_by(S.debtor_id))
+    _add(expected, db.query(S.creditor_id, func.sum(S.amount_base_minor)).filter(*new_settlements).group_by(S.creditor_id), -1)
+
+    # simplifications applied before they wrote settlement rows only exist as history payloads
+    live = (db.query(models.History.payload).filter(models.History.group_id == gid, models.History.type == "settlement", models.History.id > h0)
+            .order_by(models.History.id).execution_options(yield_per=HISTORY_BATCH))
+    for payload in chain(archived_payloads(db, gid, h0, "settlement"), (p for (p,) in live)):
+        if payload.get("auto_simplify") and "settlement_ids" not in payload:
+            for t in payload.get("transfers") or []:
+                amount = to_minor(t["amount"], group.base_currency)
+                _add(expected, [(int(t["from"]), amount), (int(t["to"]), -amount)])
+
+    expense_count, expense_id = _marks(db, E, gid)
+    settlement_count, settlement_id = _marks(db, S, gid)
+    history_id = db.query(func.max(models.History.id)).filter(models.History.group_id == gid).scalar() or 0
+    return {
+        "expected": expected,
+        "unpriced": unpriced,
+        "replayed": {"expenses": expense_count - (cp.expense_count if cp else 0), "settlements": settlement_count - (cp.settlement_count if cp else 0)},
+        "marks": {"expense_id": expense_id, "expense_count": expense_count, "settlement_id": settlement_id, "settlement_count": settlement_count, "history_id": history_id},
+    }
+
+def _lock_version(db: Session, group_id: int, version: int, bump: bool) -> bool:
+    # conditional write on the group row: takes the write lock and proves nothing changed since the reads
+    value = models.Group.ledger_version + 1 if bump else models.Group.ledger_version
+    res = db.execute(update(models.Group).where(models.Group.id == group_id, models.Group.ledger_version == version).values(ledger_version=value))
+    return res.rowcount == 1
+
+def reconcile_group(db: Session, group_id: int, repair: bool = False, full: bool = False) -> dict:
+    group = db.query(models.Group).get(group_id)
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    for _ in range(MAX_ATTEMPTS):
+        version = ledger_version(db, group_id)
+        cp = None if full else db.query(models.LedgerCheckpoint).get(group_id)
+        mode = "incremental" if cp is not None else "full"
+        if cp is not None and not _checkpoint_valid(db, cp):
+            cp, mode = None, "full (checkpoint invalidated)"
+        state = recompute(db, group, cp)
+        actual = dict(db.query(models.Balance.user_id, models.Balance.balance_minor).filter(models.Balance.group_id == group_id))
+        if ledger_version(db, group_id) != version:
+            db.rollback()
+            continue
+
+        expected = state["expected"]
+        drift = sorted((uid, expected.get(uid, 0), actual.get(uid, 0)) for uid in set(expected) | set(actual) if expected.get(uid, 0) != actual.get(uid, 0))
+        fix = repair and bool(drift)
+        if fix and state["unpriced"]:
+            raise HTTPException(status_code=409, detail=f"{state['unpriced']} expenses have no base amount; run backfill-base-amounts before repairing.")
+        write_checkpoint = not state["unpriced"] and (cp is None or any(state["replayed"].values()))
+        if fix or write_checkpoint:
+            if not _lock_version(db, group_id, version, bump=fix):
+                db.rollback()
+                continue
+            if fix:
+                apply_balance_deltas(db, group_id, {uid: exp - act for uid, exp, act in drift})
+            if write_checkpoint:
+                db.merge(models.LedgerCheckpoint(group_id=group_id, balances={str(u): v for u, v in sorted(expected.items()) if v}, **state["marks"]))
+            db.commit()
+            if fix:
+                # repairs write no history, so subscribers rebuild from a snapshot rather than apply a delta
+                db.info.pop(PENDING_EVENTS, None)
+                broker.resync(group_id)
+        ccy = group.base_currency
+        return {
+            "group_id": group_id,
+            "mode": mode,
+            "replayed": state["replayed"],
+            "unpriced_expenses": state["unpriced"],
+            "drift": [{"user_id": uid, "expected": to_major(exp, ccy), "actual": to_major(act, ccy)} for uid, exp, act in drift],
+            "repaired": fix,
+            "checkpoint": {k: state["marks"][k] for k in ("expense_id", "settlement_id", "history_id")} if write_checkpoint else None,
+        }
+    raise HTTPException(status_code=409, detail="Group ledger kept changing during reconciliation; retry later.")
+
+def reconcile(db: Session, group_id: Optional[int] = None, repair: bool = False, full: bool = False) -> dict:
+    ids: List[int] = [group_id] if group_id is not None else [gid for (gid,) in db.query(models.Group.id).order_by(models.Group.id)]
+    groups = [reconcile_group(db, gid, repair=repair, full=full) for gid in ids]
+    return {"groups": groups, "drifted": sum(1 for g in groups if g["drift"]), "repaired": sum(1 for g in groups if g["repaired"])}
@@ -0,0 +1,81 @@
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from .finance import min_cash_flow
+
+STRATEGIES = ("auto", "greedy", "exact")
+EXACT_MAX_PARTIES = int(os.getenv("SIMPLIFY_EXACT_MAX_PARTIES", "20"))
+EXACT_BUDGET_MS = float(os.getenv("SIMPLIFY_EXACT_BUDGET_MS", "250"))
+
+Transfer = Tuple[int, int, int]
+
+@dataclass
+class SimplifyResult:
+    transfers: List[Transfer]
+    strategy: str
+    engine: str
+    elapsed_ms: float
+
+def exact_min_transfers(balances: Dict[int, int], budget_ms: float = EXACT_BUDGET_MS) -> Optional[List[Transfer]]:
+    parties = sorted(u for u, amt in balances.items() if amt)
+    vals = [balances[u] for u in parties]
+    n = len(parties)
+    if n > EXACT_MAX_PARTIES or sum(vals):
+        return None
+    deadline = time.perf_counter() + budget_ms / 1000.0
+    full = (1 << n) - 1
+    # subset sums by doubling: the masks with bit i set are the masks below 1 << i plus vals[i]
+    sums = np.zeros(full + 1, dtype=np.int64)
+    pop = np.zeros(full + 1, dtype=np.int8)
+    for i, v in enumerate(vals):
+        sums[1 << i:2 << i] = sums[:1 << i] + v
+        pop[1 << i:2 << i] = pop[:1 << i] + 1
+    # best[mask] = (mask sums to zero) + max over its bits of best[mask without that bit]; each popcount layer only reads the one below
+    best = np.zeros(full + 1, dtype=np.int8)
+    zero = sums == 0
+    order = np.argsort(pop, kind="stable").astype(np.int32)
+    bounds = np.cumsum(np.bincount(pop, minlength=n + 1))
+    for k in range(1, n + 1):
+        layer = order[bounds[k - 1]:bounds[k]]
+        top, rest = np.zeros(len(layer), dtype=np.int8), layer.copy()
+        for _ in range(k):
+            low = rest & -rest
+            np.maximum(top, best[layer ^ low], out=top)
+            rest ^= low
+        best[layer] = top + zero[layer]
+        if time.perf_counter() > deadline:
+            return None
+
+    # walk back down the dp; every zero-sum mask on the way closes one group
+    groups, current, mask = [], [], full
+    while mask:
+        rest, pick = mask, 0
+        while rest:
+            bit = rest & -rest
+            if not pick or best[mask ^ bit] > best[mask ^ pick]:
+                pick = bit
+            rest ^= bit
+        current.append(pick.bit_length() - 1)
+        mask ^= pick
+        if sums[mask] == 0:
+            groups.append(current)
+            current = []
+
+    transfers = []
+    for group in groups:
+        sub = {parties[i]: vals[i] for i in group}
+        transfers.extend(min_cash_flow(sub))
+    return transfers
+
+def simplify(balances: Dict[int, int], strategy: str = "auto", budget_ms: float = EXACT_BUDGET_MS) -> SimplifyResult:
+    started = time.perf_counter()
+    transfers, engine = None, "greedy"
+    if strategy in ("auto", "exact"):
+        transfers = exact_min_transfers(balances, budget_ms)
+        if transfers is not None:
+            engine = "exact"
+    if transfers is None:
+        transfers = min_cash_flow(balances)
+    return SimplifyResult(transfers, strategy, engine, round((time.perf_counter() - started) * 1000.0, 3))
@@ -0,0 +1,131 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session, sessionmaker
+from .events import PENDING_EVENTS, publish_pending
+from .finance import PENDING_DELTAS, write_balance_deltas
+
+WRITE_COALESCE = os.getenv("WRITE_COALESCE", "0") == "1"
+WINDOW_MS = float(os.getenv("WRITE_COALESCE_WINDOW_MS", "5"))
+MAX_BATCH = int(os.getenv("WRITE_COALESCE_MAX_BATCH", "200"))
+
+Mutation = Callable[[Session], Any]
+
+class WriteCoalescer:
+    def __init__(self, session_factory: sessionmaker, window_ms: float = WINDOW_MS, max_batch: int = MAX_BATCH):
+        self.session_factory = session_factory
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[Optional[Tuple[Mutation, Future]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.batches = self.mutations = 0
+
+    def submit(self, fn: Mutation) -> Future:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-coalescer", daemon=True)
+                self._thread.start()
+        fut: Future = Future()
+        self._queue.put((fn, fut))
+        return fut
+
+    def stop(self):
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            self._process(batch)
+
+    def _process(self, batch: List[Tuple[Mutation, Future]]):
+        outcomes: List[Tuple[Future, Any, Optional[BaseException]]] = []
+        try:
+            with self.session_factory() as db:
+                if db.get_bind().dialect.name == "sqlite":
+                    # take the write lock up front so the savepoints below nest inside one transaction
+                    db.connection().exec_driver_sql("BEGIN IMMEDIATE")
+                pending: Dict[Tuple[int, int], int] = {}
+                db.info[PENDING_DELTAS] = pending
+                events = db.info.setdefault(PENDING_EVENTS, [])
+                for fn, fut in batch:
+                    before, queued = dict(pending), len(events)
+                    savepoint = db.begin_nested()
+                    try:
+                        result = fn(db)
+                        savepoint.commit()
+                        outcomes.append((fut, result, None))
+                    except Exception as exc:
+                        savepoint.rollback()
+                        pending.clear(); pending.update(before)
+                        del events[queued:]
+                        outcomes.append((fut, None, exc))
+                del db.info[PENDING_DELTAS]
+                by_group: Dict[int, Dict[int, int]] = {}
+                for (gid, uid), delta in pending.items():
+                    by_group.setdefault(gid, {})[uid] = delta
+                for gid, deltas in sorted(by_group.items()):
+                    write_balance_deltas(db, gid, deltas)
+                db.commit()
+                publish_pending(db)
+        except Exception as exc:
+            for fn, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+        self.batches += 1
+        self.mutations += len(batch)
+        for fut, result, exc in outcomes:
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(result)
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "mutations": self.mutations, "queued": self._queue.qsize()}
+
+coalescer: Optional[WriteCoalescer] = None
+
+def enable(session_factory: sessionmaker, **kwargs) -> WriteCoalescer:
+    global coalescer
+    coalescer = WriteCoalescer(session_factory, **kwargs)
+    return coalescer
+
+def disable():
+    global coalescer
+    if coalescer is not None:
+        coalescer.stop()
+    coalescer = None
+
+def run_write(db: Session, fn: Mutation) -> Any:
+    if coalescer is not None:
+        return coalescer.submit(fn).result()
+    try:
+        result = fn(db)
+        db.commit()
+    except BaseException:
+        db.info.pop(PENDING_EVENTS, None)
+        raise
+    publish_pending(db)
+    return result
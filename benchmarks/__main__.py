@@ -0,0 +1,30 @@
+import argparse
+import os
+import tempfile
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Time the finance service and API hot paths against a synthetic ledger.")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--groups", type=int, default=5)
+    parser.add_argument("--expenses", type=int, default=2000)
+    parser.add_argument("--group-size", type=int, default=50)
+    parser.add_argument("--ops", type=int, default=200, help="timed operations per benchmark")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--save", metavar="NAME", help="write results to benchmarks/baselines/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help="show the change against benchmarks/baselines/NAME.json")
+    parser.add_argument("--only", nargs="*", help="run only the named benchmarks")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="expense-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    from . import harness, suite
+
+    results = suite.run_all(args, harness)
+    baseline = harness.load_baseline(args.compare) if args.compare else None
+    print(harness.render(results, baseline))
+    if args.save:
+        params = {k: getattr(args, k) for k in ("users", "groups", "expenses", "group_size", "ops", "seed")}
+        print(f"saved {harness.save_baseline(args.save, results, params)}")
+
+if __name__ == "__main__":
+    main()
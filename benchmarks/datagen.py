@@ -0,0 +1,60 @@
+import random
+from dataclasses import dataclass, field
+from typing import Dict, List
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from app import models, schemas
+from app.routers import expenses as expenses_router
+from app.services.money import exponent, to_major
+
+CURRENCIES = ("USD", "EUR", "INR", "GBP", "JPY")
+
+@dataclass
+class Dataset:
+    user_ids: List[int]
+    group_ids: List[int]
+    members: Dict[int, List[int]] = field(default_factory=dict)
+    currencies: tuple = CURRENCIES
+
+def generate(db: Session, users: int = 200, groups: int = 5, expenses: int = 2000, group_size: int = 50,
+             currencies: tuple = CURRENCIES, seed: int = 7, batch: int = 500) -> Dataset:
+    rnd = random.Random(seed)
+    user_ids = list(db.scalars(insert(models.User).returning(models.User.id, sort_by_parameter_order=True),
+                               [{"name": f"user{i}", "email": f"user{i}@bench.example"} for i in range(users)]))
+    group_ids = list(db.scalars(insert(models.Group).returning(models.Group.id, sort_by_parameter_order=True),
+                                [{"name": f"group{i}", "base_currency": rnd.choice(currencies)} for i in range(groups)]))
+    ds = Dataset(user_ids=user_ids, group_ids=group_ids, currencies=currencies)
+    member_rows, balance_rows = [], []
+    for gid in group_ids:
+        ds.members[gid] = rnd.sample(user_ids, min(group_size, len(user_ids)))
+        member_rows.extend({"group_id": gid, "user_id": uid} for uid in ds.members[gid])
+        balance_rows.extend({"group_id": gid, "user_id": uid, "balance_minor": 0} for uid in ds.members[gid])
+    db.execute(insert(models.GroupMember), member_rows)
+    db.execute(insert(models.Balance), balance_rows)
+    db.execute(insert(models.CurrencyRate), [{"base": b, "target": t, "rate": round(rnd.uniform(0.01, 100.0), 6)}
+                                             for b in currencies for t in currencies if b != t])
+    db.commit()
+
+    per_group = [expenses // groups + (1 if i < expenses % groups else 0) for i in range(groups)]
+    for gid, count in zip(group_ids, per_group):
+        items = [random_expense(rnd, ds, gid) for _ in range(count)]
+        for i in range(0, len(items), batch):
+            expenses_router.add_batch(group_id=gid, data=schemas.ExpenseBatchIn(expenses=items[i:i + batch]), db=db)
+    return ds
+
+def random_expense(rnd: random.Random, ds: Dataset, group_id: int) -> dict:
+    members = ds.members[group_id]
+    participants = rnd.sample(members, rnd.randint(2, min(10, len(members))))
+    currency = rnd.choice(ds.currencies)
+    scale = 10 ** exponent(currency)
+    minor = rnd.randint(max(5 * scale, len(participants)), 500 * scale)
+    item = {"payer_id": rnd.choice(members), "amount": to_major(minor, currency), "currency": currency, "description": "bench"}
+    kind = rnd.choice(("equal", "exact", "percentage"))
+    if kind == "equal":
+        return {**item, "split_type": "equal", "user_ids": participants}
+    if kind == "exact":
+        cuts = sorted(rnd.sample(range(1, minor), len(participants) - 1))
+        parts = [b - a for a, b in zip([0] + cuts, cuts + [minor])]
+        return {**item, "split_type": "exact", "amounts": {u: to_major(p, currency) for u, p in zip(participants, parts)}}
+    cuts = sorted(rnd.sample(range(1, 100), len(participants) - 1))
+    return {**item, "split_type": "percentage", "percentages": {u: float(b - a) for u, a, b in zip(participants, [0] + cuts, cuts + [100])}}
@@ -0,0 +1,83 @@
+import json
+import statistics
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BASELINE_DIR = Path(__file__).parent / "baselines"
+METRICS = ("ops_per_sec", "p50_ms", "p99_ms", "statements_per_op")
+
+@dataclass
+class Result:
+    name: str
+    ops: int
+    ops_per_sec: float
+    p50_ms: float
+    p99_ms: float
+    statements_per_op: float
+
+class StatementCounter:
+    def __init__(self, engine: Engine):
+        self.engine, self.count = engine, 0
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self._on_execute)
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+def run(name: str, fn: Callable[[int], None], ops: int, engine: Optional[Engine] = None, warmup: int = 3) -> Result:
+    for i in range(warmup):
+        fn(i)
+    samples = []
+    counter = StatementCounter(engine) if engine is not None else None
+    if counter:
+        counter.__enter__()
+    try:
+        for i in range(ops):
+            started = time.perf_counter()
+            fn(warmup + i)
+            samples.append((time.perf_counter() - started) * 1000.0)
+    finally:
+        if counter:
+            counter.__exit__()
+    total = sum(samples) / 1000.0
+    return Result(name=name, ops=ops, ops_per_sec=round(ops / total, 1) if total else float("inf"),
+                  p50_ms=round(statistics.median(samples), 4), p99_ms=round(percentile(samples, 99), 4),
+                  statements_per_op=round(counter.count / ops, 2) if counter else 0.0)
+
+def save_baseline(name: str, results: List[Result], params: dict) -> Path:
+    BASELINE_DIR.mkdir(exist_ok=True)
+    path = BASELINE_DIR / f"{name}.json"
+    path.write_text(json.dumps({"params": params, "results": [asdict(r) for r in results]}, indent=2) + "\n")
+    return path
+
+def load_baseline(name: str) -> Dict[str, dict]:
+    data = json.loads((BASELINE_DIR / f"{name}.json").read_text())
+    return {r["name"]: r for r in data["results"]}
+
+def render(results: List[Result], baseline: Optional[Dict[str, dict]] = None) -> str:
+    lines = [f"{'benchmark':<28}{'ops/sec':>12}{'p50 ms':>10}{'p99 ms':>10}{'stmts/op':>10}"]
+    for r in results:
+        lines.append(f"{r.name:<28}{r.ops_per_sec:>12}{r.p50_ms:>10}{r.p99_ms:>10}{r.statements_per_op:>10}")
+        base = (baseline or {}).get(r.name)
+        if base:
+            lines.append(f"{'  vs baseline':<28}" + "".join(f"{_delta(getattr(r, m), base[m]):>{w}}" for m, w in zip(METRICS, (12, 10, 10, 10))))
+    return "\n".join(lines)
+
+def _delta(current: float, base: float) -> str:
+    if not base:
+        return "n/a" if current else "="
+    change = (current - base) / base * 100.0
+    return "=" if abs(change) < 0.05 else f"{change:+.1f}%"
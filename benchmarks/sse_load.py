@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def subscribe(port: int, group_id: int):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET /groups/{group_id}/events HTTP/1.1\r\nHost: bench\r\nAccept: text/event-stream\r\n\r\n".encode())
+    await writer.drain()
+    await reader.readuntil(b"event: snapshot")
+    return reader, writer
+
+async def wait_for(reader, marker: bytes) -> float:
+    await reader.readuntil(marker)
+    return time.perf_counter()
+
+async def run(args, port: int, pid: int, group_id: int, users: list):
+    base = rss_mb(pid)
+    started = time.perf_counter()
+    conns = []
+    for i in range(0, args.subscribers, args.batch):
+        conns += await asyncio.gather(*(subscribe(port, group_id) for _ in range(min(args.batch, args.subscribers - i))))
+    connect_s = time.perf_counter() - started
+    await asyncio.sleep(args.idle)
+    held = rss_mb(pid)
+
+    waiters = [asyncio.create_task(wait_for(r, b"event: balances")) for r, _ in conns]
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+        posted = time.perf_counter()
+        resp = await client.post(f"/groups/{group_id}/expenses/equal", json={"payer_id": users[0], "amount": 12, "currency": "USD", "user_ids": users})
+        resp.raise_for_status()
+        write_ms = (time.perf_counter() - posted) * 1000
+    done = sorted(t - posted for t in await asyncio.gather(*waiters))
+    for _, w in conns:
+        w.close()
+    print(f"subscribers        {len(conns)} on one worker (pid {pid})")
+    print(f"connect time       {connect_s:.2f}s")
+    print(f"worker rss         {base:.1f} MB idle, {held:.1f} MB held ({(held - base) * 1024 / len(conns):.1f} KB per subscriber)")
+    print(f"write latency      {write_ms:.1f} ms")
+    print(f"fan-out p50        {done[len(done) // 2] * 1000:.1f} ms")
+    print(f"fan-out last       {done[-1] * 1000:.1f} ms")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.sse_load", description="Hold many idle SSE subscribers on one uvicorn worker and time the fan-out of one write.")
+    parser.add_argument("--subscribers", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=500, help="connections opened concurrently")
+    parser.add_argument("--idle", type=float, default=2.0, help="seconds to hold the idle connections before writing")
+    args = parser.parse_args(argv)
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.subscribers + 256)), hard))
+    workdir = tempfile.mkdtemp(prefix="expense-sse-")
+    env = {**os.environ, "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'sse.db')}"}
+    port = free_port()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning",
+                               "--backlog", str(args.batch * 2), "--timeout-keep-alive", "600"], env=env)
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}") as client:
+            for _ in range(100):
+                try:
+                    client.get("/")
+                    break
+                except httpx.TransportError:
+                    time.sleep(0.1)
+            users = [client.post("/users", json={"name": f"sse{i}", "email": f"sse{i}@example.com"}).json()["id"] for i in range(2)]
+            group_id = client.post("/groups", json={"name": "sse", "base_currency": "USD"}).json()["id"]
+            for uid in users:
+                client.post(f"/groups/{group_id}/members", json={"user_id": uid})
+            client.post("/rates", json={"base": "USD", "target": "USD", "rate": 1.0})
+        asyncio.run(run(args, port, server.pid, group_id, users))
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import random
+from fastapi.testclient import TestClient
+from app.main import app
+from app.database import SessionLocal, engine
+from app import models
+from app.routers import balances as balances_router, history as history_router
+from app.services.finance import split_equal, apply_expense, min_cash_flow
+from app.services.allocation import allocate_weighted
+from .datagen import generate, random_expense
+
+def run_all(args, harness):
+    with SessionLocal() as db:
+        ds = generate(db, users=args.users, groups=args.groups, expenses=args.expenses, group_size=args.group_size, seed=args.seed)
+    rnd = random.Random(args.seed)
+    gid = ds.group_ids[0]
+    members = ds.members[gid]
+    client = TestClient(app)
+    benches = {}
+
+    def bench(fn):
+        benches[fn.__name__] = fn
+        return fn
+
+    @bench
+    def split_equal_50(ops):
+        participants = members[:50]
+        return harness.run("split_equal_50", lambda i: split_equal(10000 + i, participants), ops * 10)
+
+    @bench
+    def split_shares_2000(ops):
+        weights = {u: rnd.choice((1, 1.5, 2)) for u in range(1, 2001)}
+        return harness.run("split_shares_2000", lambda i: allocate_weighted(10 ** 7 + i, weights), ops)
+
+    @bench
+    def apply_expense_10(ops):
+        with SessionLocal() as db:
+            group = db.get(models.Group, gid)
+            shares = split_equal(12000, members[:10])
+            result = harness.run("apply_expense_10", lambda i: apply_expense(db, group, members[0], 12000, group.base_currency, shares), ops, engine)
+            db.rollback()
+        return result
+
+    @bench
+    def min_cash_flow_group(ops):
+        with SessionLocal() as db:
+            bals = {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=gid)}
+        return harness.run("min_cash_flow_group", lambda i: min_cash_flow(bals), ops)
+
+    @bench
+    def min_cash_flow_2000(ops):
+        bals = {u: rnd.randint(-50000, 50000) for u in range(1, 2000)}
+        bals[2000] = -sum(bals.values())
+        return harness.run("min_cash_flow_2000", lambda i: min_cash_flow(bals), max(1, ops // 10))
+
+    @bench
+    def balance_summary(ops):
+        with SessionLocal() as db:
+            return harness.run("balance_summary", lambda i: balances_router.get_balance_summary(group_id=gid, db=db), ops, engine)
+
+    @bench
+    def history_page(ops):
+        with SessionLocal() as db:
+            return harness.run("history_page", lambda i: history_router.get_history(group_id=gid, type=None, limit=100, db=db), ops, engine)
+
+    def post(split_type):
+        item = next(it for it in iter(lambda: random_expense(rnd, ds, gid), None) if it["split_type"] == split_type)
+        body = {k: v for k, v in item.items() if k != "split_type"}
+        def call(i):
+            resp = client.post(f"/groups/{gid}/expenses/{split_type}", json=body)
+            assert resp.status_code == 200, resp.text
+        return call
+
+    @bench
+    def post_equal(ops):
+        return harness.run("post_equal", post("equal"), ops, engine)
+
+    @bench
+    def post_exact(ops):
+        return harness.run("post_exact", post("exact"), ops, engine)
+
+    @bench
+    def post_percentage(ops):
+        return harness.run("post_percentage", post("percentage"), ops, engine)
+
+    selected = args.only or list(benches)
+    unknown = set(selected) - set(benches)
+    if unknown:
+        raise SystemExit(f"unknown benchmarks: {sorted(unknown)}; choose from {list(benches)}")
+    return [benches[name](args.ops) for name in selected]
@@ -1,18 +1,52 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+from datetime import datetime, timedelta, timezone
 import pytest
-from sqlalchemy import create_engine
+from fastapi import HTTPException, Response, UploadFile
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.orm import sessionmaker
-from app.database import Base
+from app.database import Base, configure_sqlite
 from app import models
-from app.services.finance import split_equal, validate_exact, validate_percent, apply_expense, min_cash_flow, convert
-from app.schemas import SettlementIn
+from app.services.finance import split_equal, validate_exact, validate_percent, apply_expense, min_cash_flow, convert, backfill_base_amounts, backfill_history_participants
+from pydantic import TypeAdapter
+from app.schemas import HistoryOut, ExpenseBatchItem, SettlementIn, ExpenseBatchIn, RateUpsert, RateBulkIn, ExpenseEqualIn, ExpenseExactIn, ExpensePercentIn, ExpenseSharesIn
+from app.services.fx import rate_cache
+from app.services.membership import membership_cache
+from app.routers import rates as rates_router
+from app.routers import balances as balances_router
+from app.services.simplification import simplify, exact_min_transfers
+from app.routers import simplify as simplify_router
+from app.metrics import query_budget, Registry, RequestStats
+from app.services import writer
 from app.routers import settlements as settlements_router
+from app.routers import expenses as expenses_router
 from app.routers import history as history_router
+from app.services.money import to_minor
+from app.services.allocation import allocate_percentage, allocate_weighted, largest_remainder
+import numpy as np
+from app.migrations import migrate
+from app.services.reconcile import reconcile
+from app.routers import export as export_router
+from app.services.export import decode_watermark, gzipped, high_water
+from app.routers import events as events_router
+from app.services.events import LedgerEvent, broker
+from app.services import idempotency
+from app.services import archive
 
 @pytest.fixture
 def db():
     engine = create_engine("sqlite://", future=True)
     TestingSessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
     Base.metadata.create_all(bind=engine)
+    rate_cache.clear()
+    membership_cache.clear()
+    simplify_router.preview_cache.clear()
+    idempotency.response_cache.clear()
+    archive.segment_cache.clear()
     db = TestingSessionLocal()
     yield db
     db.close()
@@ -27,7 +61,7 @@ def bootstrap(db):
     db.add(g); db.flush()
     for u in (u1,u2,u3):
         db.add(models.GroupMember(group_id=g.id, user_id=u.id))
-        db.add(models.Balance(group_id=g.id, user_id=u.id, balance_base=0.0))
+        db.add(models.Balance(group_id=g.id, user_id=u.id, balance_minor=0))
                       
     db.add(models.CurrencyRate(base="USD", target="USD", rate=1.0))
     db.commit()
@@ -35,36 +69,36 @@ def bootstrap(db):
 
 def test_equal_split(db):
     g, u1, u2, u3 = bootstrap(db)
-    shares = split_equal(90.0, [u1.id, u2.id, u3.id])
-    assert set(shares.values()) == {30.0}
-    apply_expense(db, g, payer_id=u1.id, amount=90.0, currency="USD", shares=shares)
-    bals = {b.user_id: b.balance_base for b in db.query(models.Balance).filter_by(group_id=g.id).all()}
-    assert round(bals[u1.id],2) == 60.00                           
-    assert round(bals[u2.id],2) == -30.00
-    assert round(bals[u3.id],2) == -30.00
+    shares = split_equal(9000, [u1.id, u2.id, u3.id])
+    assert set(shares.values()) == {3000}
+    apply_expense(db, g, payer_id=u1.id, amount_minor=9000, currency="USD", shares=shares)
+    bals = {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id).all()}
+    assert bals[u1.id] == 6000
+    assert bals[u2.id] == -3000
+    assert bals[u3.id] == -3000
 
 def test_exact_split(db):
     g, u1, u2, _ = bootstrap(db)
-    validate_exact(100.0, {u1.id: 70.0, u2.id: 30.0})
-    apply_expense(db, g, payer_id=u1.id, amount=100.0, currency="USD", shares={u1.id: 70.0, u2.id: 30.0})
-    bals = {b.user_id: b.balance_base for b in db.query(models.Balance).filter_by(group_id=g.id).all()}
-    assert round(bals[u1.id],2) == 30.00
-    assert round(bals[u2.id],2) == -30.00
+    validate_exact(10000, {u1.id: 7000, u2.id: 3000})
+    apply_expense(db, g, payer_id=u1.id, amount_minor=10000, currency="USD", shares={u1.id: 7000, u2.id: 3000})
+    bals = {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id).all()}
+    assert bals[u1.id] == 3000
+    assert bals[u2.id] == -3000
 
 def test_percentage_split(db):
     g, u1, u2, _ = bootstrap(db)
-    validate_percent(200.0, {u1.id: 60.0, u2.id: 40.0})
-    apply_expense(db, g, payer_id=u1.id, amount=200.0, currency="USD", shares={u1.id: 120.0, u2.id: 80.0})
-    bals = {b.user_id: b.balance_base for b in db.query(models.Balance).filter_by(group_id=g.id).all()}
-    assert round(bals[u1.id],2) == 80.00
-    assert round(bals[u2.id],2) == -80.00
+    validate_percent(20000, {u1.id: 60.0, u2.id: 40.0})
+    apply_expense(db, g, payer_id=u1.id, amount_minor=20000, currency="USD", shares={u1.id: 12000, u2.id: 8000})
+    bals = {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id).all()}
+    assert bals[u1.id] == 8000
+    assert bals[u2.id] == -8000
 
 def test_min_cash_flow(db):
     g, u1, u2, u3 = bootstrap(db)
                                       
-    b1 = db.query(models.Balance).filter_by(group_id=g.id, user_id=u1.id).first(); b1.balance_base = 50
-    b2 = db.query(models.Balance).filter_by(group_id=g.id, user_id=u2.id).first(); b2.balance_base = -30
-    b3 = db.query(models.Balance).filter_by(group_id=g.id, user_id=u3.id).first(); b3.balance_base = -20
+    b1 = db.query(models.Balance).filter_by(group_id=g.id, user_id=u1.id).first(); b1.balance_minor = 50
+    b2 = db.query(models.Balance).filter_by(group_id=g.id, user_id=u2.id).first(); b2.balance_minor = -30
+    b3 = db.query(models.Balance).filter_by(group_id=g.id, user_id=u3.id).first(); b3.balance_minor = -20
     db.commit()
     transfers = min_cash_flow({u1.id: 50, u2.id: -30, u3.id: -20})
     assert transfers == [(u2.id, u1.id, 30.0), (u3.id, u1.id, 20.0)]
@@ -75,21 +109,21 @@ def test_fx_conversion_and_balances(db):
     db.add(models.CurrencyRate(base="EUR", target="USD", rate=1.2))
     db.commit()
                                                                                    
-    shares = split_equal(120.0, [u1.id, u2.id])
-    apply_expense(db, g, payer_id=u1.id, amount=120.0, currency="EUR", shares=shares)
-    bals = {b.user_id: b.balance_base for b in db.query(models.Balance).filter_by(group_id=g.id).all()}
-    assert round(bals[u1.id], 2) == 72.00                                    
-    assert round(bals[u2.id], 2) == -72.00
+    shares = split_equal(12000, [u1.id, u2.id])
+    apply_expense(db, g, payer_id=u1.id, amount_minor=12000, currency="EUR", shares=shares)
+    bals = {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id).all()}
+    assert bals[u1.id] == 7200
+    assert bals[u2.id] == -7200
 
 def test_settlement_and_overpay_guard(db):
     g, u1, u2, _ = bootstrap(db)
                                                 
-    apply_expense(db, g, payer_id=u1.id, amount=100.0, currency="USD", shares={u1.id: 50.0, u2.id: 50.0})
+    apply_expense(db, g, payer_id=u1.id, amount_minor=10000, currency="USD", shares={u1.id: 5000, u2.id: 5000})
                                                     
     s = settlements_router.settle(group_id=g.id, data=SettlementIn(debtor_id=u2.id, creditor_id=u1.id, amount_base=30.0), db=db)
     assert s.amount_base == 30.0
-    deb = db.query(models.Balance).filter_by(group_id=g.id, user_id=u2.id).first(); assert round(deb.balance_base,2) == -20.00
-    cred = db.query(models.Balance).filter_by(group_id=g.id, user_id=u1.id).first(); assert round(cred.balance_base,2) == 20.00
+    deb = db.query(models.Balance).filter_by(group_id=g.id, user_id=u2.id).first(); assert deb.balance_minor == -2000
+    cred = db.query(models.Balance).filter_by(group_id=g.id, user_id=u1.id).first(); assert cred.balance_minor == 2000
                           
     import pytest
     with pytest.raises(Exception):
@@ -98,9 +132,9 @@ def test_settlement_and_overpay_guard(db):
 def test_simplify_apply_effect(db):
     g, u1, u2, u3 = bootstrap(db)
                                           
-    db.query(models.Balance).filter_by(group_id=g.id, user_id=u1.id).first().balance_base = 50
-    db.query(models.Balance).filter_by(group_id=g.id, user_id=u2.id).first().balance_base = -30
-    db.query(models.Balance).filter_by(group_id=g.id, user_id=u3.id).first().balance_base = -20
+    db.query(models.Balance).filter_by(group_id=g.id, user_id=u1.id).first().balance_minor = 50
+    db.query(models.Balance).filter_by(group_id=g.id, user_id=u2.id).first().balance_minor = -30
+    db.query(models.Balance).filter_by(group_id=g.id, user_id=u3.id).first().balance_minor = -20
     db.commit()
     from app.services.finance import min_cash_flow, upsert_balance
     transfers = min_cash_flow({u1.id: 50, u2.id: -30, u3.id: -20})
@@ -108,16 +142,14 @@ def test_simplify_apply_effect(db):
         upsert_balance(db, g.id, d, +a)
         upsert_balance(db, g.id, c, -a)
     db.commit()
-    bals = {b.user_id: round(b.balance_base,2) for b in db.query(models.Balance).filter_by(group_id=g.id).all()}
-    assert bals[u1.id] == 0.00
-    assert bals[u2.id] == 0.00
-    assert bals[u3.id] == 0.00
+    bals = {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id).all()}
+    assert bals == {u1.id: 0, u2.id: 0, u3.id: 0}
 
 def test_history_filters(db):
     g, u1, u2, _ = bootstrap(db)
                                                                                         
-    shares = split_equal(90.0, [u1.id, u2.id])
-    apply_expense(db, g, payer_id=u1.id, amount=90.0, currency="USD", shares=shares)
+    shares = split_equal(9000, [u1.id, u2.id])
+    apply_expense(db, g, payer_id=u1.id, amount_minor=9000, currency="USD", shares=shares)
     settlements_router.settle(group_id=g.id, data=SettlementIn(debtor_id=u2.id, creditor_id=u1.id, amount_base=30.0), db=db)
                             
     exps = history_router.get_history(group_id=g.id, type="expense", db=db)
@@ -128,3 +160,674 @@ def test_history_filters(db):
                     
     user_rows = history_router.get_history(group_id=g.id, user_id=u1.id, type=None, db=db)
     assert len(user_rows) >= 1
+
+def test_batch_expenses(db):
+    g, u1, u2, u3 = bootstrap(db)
+    data = ExpenseBatchIn(expenses=[
+        {"split_type": "equal", "payer_id": u1.id, "amount": 90.0, "currency": "USD", "user_ids": [u1.id, u2.id, u3.id]},
+        {"split_type": "exact", "payer_id": u2.id, "amount": 50.0, "currency": "USD", "amounts": {u1.id: 20.0, u3.id: 30.0}},
+        {"split_type": "percentage", "payer_id": u3.id, "amount": 200.0, "currency": "USD", "percentages": {u1.id: 50.0, u2.id: 50.0}},
+    ])
+    out = expenses_router.add_batch(group_id=g.id, data=data, db=db)
+    assert out["count"] == 3
+    assert db.query(models.ExpenseSplit).count() == 7
+    assert db.query(models.History).filter_by(type="expense").count() == 3
+    bals = {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id).all()}
+    assert bals == {u1.id: -6000, u2.id: -8000, u3.id: 14000}
+
+def test_batch_expenses_reports_every_bad_item(db):
+    g, u1, u2, _ = bootstrap(db)
+    data = ExpenseBatchIn(expenses=[
+        {"split_type": "equal", "payer_id": u1.id, "amount": 90.0, "currency": "USD", "user_ids": [u1.id, u2.id]},
+        {"split_type": "exact", "payer_id": u1.id, "amount": 50.0, "currency": "USD", "amounts": {u1.id: 20.0}},
+        {"split_type": "equal", "payer_id": 999, "amount": 10.0, "currency": "USD", "user_ids": [u1.id]},
+    ])
+    with pytest.raises(Exception) as exc:
+        expenses_router.add_batch(group_id=g.id, data=data, db=db)
+    assert [e["index"] for e in exc.value.detail["errors"]] == [1, 2]
+    assert db.query(models.Expense).count() == 0
+
+def test_rate_cache_write_through(db):
+    bootstrap(db)
+    rates_router.upsert_rate(RateUpsert(base="eur", target="usd", rate=1.2), db=db)
+    assert convert(db, 10.0, "EUR", "USD") == 12.0
+    reloads = rate_cache.stats()["reloads"]
+    out = rates_router.upsert_rate(RateUpsert(base="EUR", target="USD", rate=1.5), db=db)
+    for _ in range(40):
+        assert convert(db, 10.0, "EUR", "USD") == 15.0
+    stats = rate_cache.stats()
+    assert stats["version"] == out["version"] == 2
+    assert stats["reloads"] == reloads
+    assert db.query(models.CurrencyRate).filter_by(base="EUR").count() == 1
+    assert stats["hits"] >= 41
+
+def test_membership_validated_in_one_pass(db):
+    g, u1, u2, u3 = bootstrap(db)
+    with pytest.raises(Exception) as exc:
+        apply_expense(db, g, payer_id=u1.id, amount_minor=3000, currency="USD", shares={u1.id: 1000, 41: 1000, 42: 1000})
+    assert "[41, 42]" in exc.value.detail
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(db.get_bind(), "before_cursor_execute", listener)
+    try:
+        apply_expense(db, g, payer_id=u1.id, amount_minor=3000, currency="USD", shares={u1.id: 1000, u2.id: 1000, u3.id: 1000})
+    finally:
+        event.remove(db.get_bind(), "before_cursor_execute", listener)
+    assert not [s for s in statements if "group_members" in s]
+
+def test_concurrent_expenses_keep_balances_zero_sum(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'stress.db'}", future=True, connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    SessionFactory = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+    rate_cache.clear()
+    membership_cache.clear()
+    with SessionFactory() as db:
+        g, u1, u2, u3 = bootstrap(db)
+        gid, uids = g.id, [u1.id, u2.id, u3.id]
+
+    def post(i):
+        with SessionFactory() as session:
+            data = ExpenseEqualIn(payer_id=uids[i % 3], amount=30.0, currency="USD", user_ids=uids)
+            expenses_router.add_equal(group_id=gid, data=data, db=session)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(post, range(120)))
+    with SessionFactory() as db:
+        bals = {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=gid).all()}
+        assert db.query(models.Expense).count() == 120
+    assert all(v == 0 for v in bals.values())
+    engine.dispose()
+
+def test_balance_summary_uses_stored_base_amounts(db):
+    g, u1, u2, u3 = bootstrap(db)
+    db.add(models.CurrencyRate(base="EUR", target="USD", rate=1.2)); db.commit()
+    expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=120.0, currency="EUR", user_ids=[u1.id, u2.id]), db=db)
+    exp = db.query(models.Expense).one()
+    assert (exp.fx_rate, exp.amount_base_minor) == (1.2, 14400)
+    assert sorted(s.amount_base_minor for s in db.query(models.ExpenseSplit).all()) == [7200, 7200]
+    rows = {r["user_id"]: r for r in balances_router.get_balance_summary(group_id=g.id, db=db)["users"]}
+    assert (rows[u1.id]["paid_total"], rows[u1.id]["owed_total"], rows[u1.id]["net"]) == (144.0, 72.0, 72.0)
+    assert (rows[u2.id]["paid_total"], rows[u2.id]["owed_total"], rows[u2.id]["net"]) == (0.0, 72.0, -72.0)
+    assert rows[u3.id]["net"] == 0.0
+
+def test_backfill_base_amounts(db):
+    g, u1, u2, _ = bootstrap(db)
+    db.add(models.CurrencyRate(base="EUR", target="USD", rate=2.0))
+    legacy = models.Expense(group_id=g.id, payer_id=u1.id, amount_minor=1000, currency="EUR", split_type="equal")
+    db.add(legacy); db.flush()
+    db.add_all([models.ExpenseSplit(expense_id=legacy.id, user_id=u, amount_minor=500, amount_base_minor=0) for u in (u1.id, u2.id)])
+    db.commit()
+    assert backfill_base_amounts(db)["backfilled"] == 1
+    assert (legacy.amount_base_minor, legacy.fx_rate) == (2000, 2.0)
+    assert [s.amount_base_minor for s in db.query(models.ExpenseSplit).all()] == [1000, 1000]
+
+def test_history_user_filter_uses_participant_index(db):
+    g, u1, u2, u3 = bootstrap(db)
+    expenses_router.add_percentage(group_id=g.id, data=ExpensePercentIn(payer_id=u1.id, amount=100.0, currency="USD", percentages={u1.id: 50.0, u2.id: 50.0}), db=db)
+    settlements_router.settle(group_id=g.id, data=SettlementIn(debtor_id=u2.id, creditor_id=u1.id, amount_base=10.0), db=db)
+    assert [r.type for r in history_router.get_history(group_id=g.id, user_id=u2.id, type=None, db=db)] == ["settlement", "expense"]
+    assert history_router.get_history(group_id=g.id, user_id=u3.id, type=None, db=db) == []
+
+def test_backfill_history_participants(db):
+    g, u1, u2, _ = bootstrap(db)
+    db.add(models.History(group_id=g.id, type="expense", payload={"payer_id": u1.id, "amounts": {str(u2.id): 5.0}}))
+    db.commit()
+    assert history_router.get_history(group_id=g.id, user_id=u2.id, type=None, db=db) == []
+    assert backfill_history_participants(db) == {"history_rows": 1}
+    assert len(history_router.get_history(group_id=g.id, user_id=u2.id, type=None, db=db)) == 1
+
+def test_history_keyset_pagination_and_ndjson(db):
+    g, u1, u2, _ = bootstrap(db)
+    apply_expense(db, g, payer_id=u1.id, amount_minor=10000, currency="USD", shares={u1.id: 5000, u2.id: 5000})
+    for _ in range(5):
+        settlements_router.settle(group_id=g.id, data=SettlementIn(debtor_id=u2.id, creditor_id=u1.id, amount_base=1.0), db=db)
+    pages, cursor = [], None
+    while True:
+        resp = Response()
+        rows = history_router.get_history(group_id=g.id, type=None, limit=2, cursor=cursor, response=resp, db=db)
+        pages.append([r.id for r in rows])
+        cursor = resp.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert [len(p) for p in pages] == [2, 2, 1]
+    all_ids = [r.id for r in history_router.get_history(group_id=g.id, type=None, db=db)]
+    assert [i for p in pages for i in p] == all_ids
+    lines = list(history_router.stream_history(db.get_bind(), None, group_id=g.id, user_id=u2.id, type="settlement", start=None, end=None, cursor=None))
+    assert [json.loads(line)["id"] for line in lines] == all_ids
+
+def test_exact_simplifier_beats_greedy():
+    bals = {1: 400, 2: 300, 3: 300, 4: -600, 5: -400}
+    assert len(min_cash_flow(bals)) == 4
+    transfers = exact_min_transfers(bals)
+    assert len(transfers) == 3
+    net = dict(bals)
+    for d, c, a in transfers:
+        net[d] += a; net[c] -= a
+    assert all(v == 0 for v in net.values())
+    result = simplify(bals, "auto")
+    assert (result.engine, len(result.transfers)) == ("exact", 3)
+    assert simplify(bals, "greedy").engine == "greedy"
+
+def test_exact_simplifier_falls_back_on_budget():
+    bals = {u: u * 100 for u in range(1, 20)}
+    bals[20] = -sum(bals.values())
+    result = simplify(bals, "exact", budget_ms=1)
+    assert result.engine == "greedy"
+    assert len(result.transfers) == 19
+
+def test_exact_simplifier_finishes_18_parties_within_budget():
+    # three scaled copies of the 5-party case above plus a 3-party group: 11 transfers, where the greedy needs 15
+    parties = [v * scale for scale in (1, 3, 7) for v in (400, 300, 300, -600, -400)] + [5500, -2750, -2750]
+    bals = dict(enumerate(parties, start=1))
+    result = simplify(bals, "auto")
+    assert result.engine == "exact" and result.elapsed_ms < 250
+    assert (len(result.transfers), len(min_cash_flow(bals))) == (11, 15)
+    net = dict(bals)
+    for d, c, a in result.transfers:
+        net[d] += a; net[c] -= a
+    assert all(v == 0 for v in net.values())
+
+def test_simplify_preview_cached_per_ledger_version(db):
+    g, u1, u2, u3 = bootstrap(db)
+    expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=90.0, currency="USD", user_ids=[u1.id, u2.id, u3.id]), db=db)
+    first = simplify_router.preview(group_id=g.id, strategy="auto", db=db)
+    assert simplify_router.preview(group_id=g.id, strategy="auto", db=db) is first
+    assert simplify_router.preview_cache.stats()["hits"] == 1
+    settlements_router.settle(group_id=g.id, data=SettlementIn(debtor_id=u2.id, creditor_id=u1.id, amount_base=30.0), db=db)
+    second = simplify_router.preview(group_id=g.id, strategy="auto", db=db)
+    assert second["transfers"] == [{"from": u3.id, "to": u1.id, "amount": 30.0}]
+    simplify_router.apply(group_id=g.id, strategy="auto", db=db)
+    assert db.get(models.Group, g.id).ledger_version == 3
+    assert simplify_router.preview(group_id=g.id, strategy="auto", db=db)["transfers"] == []
+
+def test_equal_expense_for_50_users_query_budget(db):
+    g, u1, _, _ = bootstrap(db)
+    users = [models.User(name=f"m{i}", email=f"m{i}@example.com") for i in range(47)]
+    db.add_all(users); db.flush()
+    db.add_all([models.GroupMember(group_id=g.id, user_id=u.id) for u in users])
+    db.commit()
+    uids = [m.user_id for m in db.query(models.GroupMember).filter_by(group_id=g.id)]
+    assert len(uids) == 50
+    data = ExpenseEqualIn(payer_id=u1.id, amount=500.0, currency="USD", user_ids=uids)
+    expenses_router.add_equal(group_id=g.id, data=data, db=db)
+    with query_budget(db.get_bind(), 10) as statements:
+        expenses_router.add_equal(group_id=g.id, data=data, db=db)
+    assert not [s for s in statements if "group_members" in s or "currency_rates" in s]
+
+def test_metrics_registry_renders_prometheus_text():
+    reg = Registry()
+    reg.record("POST", "/groups/{group_id}/expenses/equal", 200, 0.02, RequestStats(statements=9, db_seconds=0.004, rows=3))
+    text = reg.render([("cache_hits_total", "counter", "cache", {"fx": 5})])
+    assert 'http_requests_total{method="POST",route="/groups/{group_id}/expenses/equal",status="200"} 1' in text
+    assert 'http_request_duration_seconds_bucket{method="POST",route="/groups/{group_id}/expenses/equal",le="0.025"} 1' in text
+    assert 'db_statements_per_request_bucket{method="POST",route="/groups/{group_id}/expenses/equal",le="5"} 0' in text
+    assert 'db_rows_returned_total{method="POST",route="/groups/{group_id}/expenses/equal"} 3' in text
+    assert 'cache_hits_total{cache="fx"} 5' in text
+
+def test_write_coalescer_groups_concurrent_writes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'coalesce.db'}", future=True, connect_args={"check_same_thread": False})
+    configure_sqlite(engine)
+    Base.metadata.create_all(bind=engine)
+    SessionFactory = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+    rate_cache.clear()
+    membership_cache.clear()
+    with SessionFactory() as db:
+        g, u1, u2, u3 = bootstrap(db)
+        gid, uids = g.id, [u1.id, u2.id, u3.id]
+
+    def post(i):
+        with SessionFactory() as session:
+            if i % 10 == 9:
+                with pytest.raises(Exception):
+                    settlements_router.settle(group_id=gid, data=SettlementIn(debtor_id=uids[1], creditor_id=uids[0], amount_base=1e9), db=session)
+                return
+            if i % 10 == 8:
+                with pytest.raises(Exception):
+                    expenses_router.add_equal(group_id=gid, data=ExpenseEqualIn(payer_id=uids[0], amount=30.0, currency="USD", user_ids=[uids[0], 999]), db=session)
+                return
+            data = ExpenseEqualIn(payer_id=uids[i % 3], amount=30.0, currency="USD", user_ids=uids)
+            assert expenses_router.add_equal(group_id=gid, data=data, db=session).id
+
+    coalescer = writer.enable(SessionFactory, window_ms=20)
+    try:
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(post, range(100)))
+    finally:
+        writer.disable()
+    assert coalescer.mutations == 100
+    assert coalescer.batches < 100
+    with SessionFactory() as db:
+        assert db.query(models.Expense).count() == 80
+        assert db.query(models.Settlement).count() == 0
+        bals = {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=gid).all()}
+        assert db.get(models.Group, gid).ledger_version == 80
+    assert sum(bals.values()) == 0
+    engine.dispose()
+
+def test_minor_unit_allocation_is_exact(db):
+    g, u1, u2, u3 = bootstrap(db)
+    assert split_equal(10000, [u1.id, u2.id, u3.id]) == {u1.id: 3334, u2.id: 3333, u3.id: 3333}
+    assert largest_remainder(-100, np.array([1, 1, 1])).tolist() == [-34, -33, -33]
+    assert (to_minor(0.1 + 0.2, "USD"), to_minor(1234, "JPY"), to_minor(1.2345, "KWD")) == (30, 1234, 1235)
+    db.add(models.CurrencyRate(base="JPY", target="USD", rate=0.0067)); db.commit()
+    for _ in range(3):
+        expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=1000, currency="JPY", user_ids=[u1.id, u2.id, u3.id]), db=db)
+        expenses_router.add_percentage(group_id=g.id, data=ExpensePercentIn(payer_id=u2.id, amount=0.1, currency="USD", percentages={u1.id: 33.3, u2.id: 33.3, u3.id: 33.4}), db=db)
+    bals = {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id).all()}
+    assert sum(bals.values()) == 0
+    for exp in db.query(models.Expense).all():
+        splits = db.query(models.ExpenseSplit).filter_by(expense_id=exp.id).all()
+        assert sum(s.amount_minor for s in splits) == exp.amount_minor
+        assert sum(s.amount_base_minor for s in splits) == exp.amount_base_minor
+
+def test_decimal_weights_are_quantized_like_the_float_checks(db):
+    third = 100 / 3
+    assert allocate_percentage(10000, {1: third, 2: third, 3: 100 - 2 * third}).as_dict() == {1: 3334, 2: 3333, 3: 3333}
+    assert allocate_percentage(10000, {1: 1e-300, 2: 100.0}).as_dict() == {1: 0, 2: 10000}
+    assert allocate_weighted(10000, {1: 0.1, 2: 1e-20}).as_dict() == {1: 10000, 2: 0}
+    for bad, detail in ((lambda: allocate_percentage(100, {1: 50, 2: 49.99}), "Percentages must sum to 100, got 99.99."),
+                        (lambda: allocate_weighted(100, {1: 1e30, 2: 1}), "Split weights are too large.")):
+        with pytest.raises(HTTPException) as exc:
+            bad()
+        assert (exc.value.status_code, exc.value.detail) == (400, detail)
+
+def test_migrate_float_columns_to_minor_units(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}", future=True)
+    with engine.begin() as conn:
+        for ddl in [
+            "CREATE TABLE groups (id INTEGER PRIMARY KEY, name VARCHAR, base_currency VARCHAR(3), created_at DATETIME)",
+            "CREATE TABLE expenses (id INTEGER PRIMARY KEY, group_id INTEGER, payer_id INTEGER, amount FLOAT NOT NULL, currency VARCHAR(3), split_type VARCHAR, description VARCHAR, created_at DATETIME)",
+            "CREATE TABLE expense_splits (id INTEGER PRIMARY KEY, expense_id INTEGER, user_id INTEGER, amount_expense_ccy FLOAT NOT NULL, amount_base_ccy FLOAT NOT NULL)",
+            "CREATE TABLE balances (id INTEGER PRIMARY KEY, group_id INTEGER, user_id INTEGER, balance_base FLOAT)",
+            "CREATE TABLE currency_rates (id INTEGER PRIMARY KEY, base VARCHAR(3), target VARCHAR(3), rate FLOAT NOT NULL, as_of DATETIME, CONSTRAINT uq_fx_pair UNIQUE (base, target))",
+            "CREATE INDEX ix_currency_rates_base ON currency_rates (base)",
+            "INSERT INTO currency_rates VALUES (1, 'USD', 'JPY', 150.0, '2024-05-01 00:00:00')",
+            "INSERT INTO groups VALUES (1, 'Trip', 'JPY', NULL)",
+            "INSERT INTO expenses VALUES (1, 1, 1, 10.005, 'USD', 'equal', '', NULL)",
+            "INSERT INTO expense_splits VALUES (1, 1, 2, 10.005, 1500.4)",
+            "INSERT INTO balances VALUES (1, 1, 2, -1500.4)",
+        ]:
+            conn.exec_driver_sql(ddl)
+    migrate(engine)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT amount_minor, amount_base_minor, fx_rate FROM expenses").one() == (1001, None, None)
+        assert conn.exec_driver_sql("SELECT amount_minor, amount_base_minor FROM expense_splits").one() == (1001, 1500)
+        assert conn.exec_driver_sql("SELECT balance_minor FROM balances").scalar() == -1500
+    assert "balance_base" not in {c["name"] for c in inspect(engine).get_columns("balances")}
+    assert [u["name"] for u in inspect(engine).get_unique_constraints("currency_rates")] == ["uq_fx_pair_as_of"]
+    with sessionmaker(bind=engine)() as db:
+        assert db.query(models.CurrencyRate.as_of).scalar() == datetime(1970, 1, 1)
+    engine.dispose()
+
+def test_vectorized_shares_split_for_large_group(db):
+    g, u1, _, _ = bootstrap(db)
+    users = [models.User(name=f"U{i}", email=f"bulk{i}@example.com") for i in range(2500)]
+    db.add_all(users); db.flush()
+    db.add_all([models.GroupMember(group_id=g.id, user_id=u.id) for u in users]); db.commit()
+    weights = {u.id: (1.5 if i % 3 == 0 else 1) for i, u in enumerate(users)}
+    alloc = allocate_weighted(100001, weights)
+    assert alloc.total() == 100001 and alloc.amounts.max() - alloc.amounts.min() <= 21
+    assert largest_remainder(10 ** 15, np.array([2 ** 62, 1])).sum() == 10 ** 15
+    out = expenses_router.add_shares(group_id=g.id, data=ExpenseSharesIn(payer_id=u1.id, amount=1000.01, currency="USD", shares=weights), db=db)
+    assert db.query(models.ExpenseSplit).filter_by(expense_id=out.id).count() == 2500
+    assert sum(b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id)) == 0
+    with pytest.raises(Exception):
+        allocate_weighted(100, {u1.id: -1.0, users[0].id: 2.0})
+
+def test_reconcile_reports_repairs_and_checkpoints(db):
+    g, u1, u2, u3 = bootstrap(db)
+    expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=90.0, currency="USD", user_ids=[u1.id, u2.id, u3.id]), db=db)
+    settlements_router.settle(group_id=g.id, data=SettlementIn(debtor_id=u2.id, creditor_id=u1.id, amount_base=10.0), db=db)
+    simplify_router.apply(group_id=g.id, strategy="auto", db=db)
+    db.add(models.History(group_id=g.id, type="settlement", payload={"auto_simplify": True, "transfers": [{"from": u1.id, "to": u2.id, "amount": 1.5}]}))
+    db.query(models.Balance).filter_by(group_id=g.id, user_id=u1.id).first().balance_minor += 150
+    db.query(models.Balance).filter_by(group_id=g.id, user_id=u2.id).first().balance_minor -= 150
+    db.commit()
+    first = reconcile(db)["groups"][0]
+    assert (first["mode"], first["drift"], first["replayed"]) == ("full", [], {"expenses": 1, "settlements": 3})
+
+    db.query(models.Balance).filter_by(group_id=g.id, user_id=u3.id).first().balance_minor += 7
+    db.commit()
+    version = db.get(models.Group, g.id).ledger_version
+    report = reconcile(db, g.id)["groups"][0]
+    assert (report["mode"], report["replayed"], report["checkpoint"]) == ("incremental", {"expenses": 0, "settlements": 0}, None)
+    assert report["drift"] == [{"user_id": u3.id, "expected": 0.0, "actual": 0.07}]
+    assert reconcile(db, g.id, repair=True)["repaired"] == 1
+    assert db.get(models.Group, g.id).ledger_version == version + 1
+    assert reconcile(db, g.id)["drifted"] == 0
+
+    expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u2.id, amount=30.0, currency="USD", user_ids=[u1.id, u2.id, u3.id]), db=db)
+    report = reconcile(db, g.id)["groups"][0]
+    assert (report["mode"], report["replayed"], report["drift"]) == ("incremental", {"expenses": 1, "settlements": 0}, [])
+    db.query(models.Expense).filter_by(id=1).delete(); db.commit()
+    assert reconcile(db, g.id)["groups"][0]["mode"] == "full (checkpoint invalidated)"
+
+def test_point_in_time_rates_and_backdated_expenses(db):
+    g, u1, u2, _ = bootstrap(db)
+    day = datetime(2024, 3, 1)
+    out = rates_router.load_rates(RateBulkIn(as_of=day, rates=[RateUpsert(base="eur", target="usd", rate=1.1), RateUpsert(base="GBP", target="USD", rate=1.3)]), db=db)
+    assert (out["count"], out["pairs"]) == (2, 2)
+    rates_router.load_rates(RateBulkIn(rates=[RateUpsert(base="EUR", target="USD", rate=1.2, as_of=day + timedelta(days=1)),
+                                              RateUpsert(base="EUR", target="USD", rate=1.25, as_of=(day + timedelta(days=1, hours=9)).replace(tzinfo=timezone(timedelta(hours=9))))]), db=db)
+    assert convert(db, 10.0, "EUR", "USD", at=day + timedelta(hours=12)) == 11.0
+    assert convert(db, 10.0, "EUR", "USD", at=day + timedelta(days=1)) == 12.5
+    assert convert(db, 10.0, "EUR", "USD") == 12.5
+    with pytest.raises(Exception) as exc:
+        convert(db, 10.0, "EUR", "USD", at=day - timedelta(seconds=1))
+    assert "earliest" in exc.value.detail
+    rates_router.upsert_rate(RateUpsert(base="EUR", target="USD", rate=2.0), db=db)
+    assert rate_cache.stats()["points"] == 5
+    exp = expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=100.0, currency="EUR", user_ids=[u1.id, u2.id], created_at=day + timedelta(hours=1)), db=db)
+    assert exp.created_at == day + timedelta(hours=1)
+    assert db.get(models.Expense, exp.id).amount_base_minor == 11000
+
+def test_cross_rates_are_triangulated_with_path(db):
+    g, u1, u2, _ = bootstrap(db)
+    g.base_currency = "INR"; db.commit()
+    day = datetime(2024, 3, 1)
+    rates_router.load_rates(RateBulkIn(as_of=day, rates=[RateUpsert(base="EUR", target="USD", rate=1.1), RateUpsert(base="USD", target="INR", rate=80.0),
+                                                         RateUpsert(base="GBP", target="USD", rate=1.25), RateUpsert(base="JPY", target="EUR", rate=0.0062)]), db=db)
+    assert rates_router.quote(base="eur", target="inr", db=db)["path"] == ["EUR", "USD", "INR"]
+    assert rates_router.quote(base="INR", target="USD", db=db)["rate"] == 1 / 80.0
+    q = rates_router.quote(base="JPY", target="GBP", db=db)
+    assert q["path"] == ["JPY", "EUR", "USD", "GBP"] and abs(q["rate"] - 0.0062 * 1.1 / 1.25) < 1e-12
+    assert rates_router.quote(base="EUR", target="INR", at=day + timedelta(hours=1), db=db)["rate"] == 1.1 * 80.0
+    assert rate_cache.stats()["closed_spans"] == 2
+    # only the span starting after the new rate is recomputed
+    rates_router.upsert_rate(RateUpsert(base="EUR", target="INR", rate=90.0, as_of=day + timedelta(days=1)), db=db)
+    assert rate_cache.stats()["closed_spans"] == 1
+    assert rates_router.quote(base="EUR", target="INR", at=day + timedelta(hours=1), db=db)["rate"] == 1.1 * 80.0
+    assert rate_cache.stats()["closed_spans"] == 1
+    assert rates_router.quote(base="EUR", target="INR", db=db)["path"] == ["EUR", "INR"]
+    exp = expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=10.0, currency="GBP", user_ids=[u1.id, u2.id]), db=db)
+    assert (exp.fx_path, exp.fx_rate) == ("GBP>USD>INR", 100.0)
+    with pytest.raises(Exception) as exc:
+        rates_router.quote(base="CHF", target="USD", db=db)
+    assert "Missing FX rate" in exc.value.detail
+    assert rate_cache.stats()["currencies"] == 5
+
+def test_import_csv_and_jsonl_in_chunks(db):
+    g, u1, u2, u3 = bootstrap(db)
+    db.add(models.CurrencyRate(base="EUR", target="USD", rate=1.2)); db.commit()
+    lines = ["payer_id,amount,currency,description,split_type,split"]
+    lines += [f"{u1.id},30,,row {i},equal," for i in range(7)]
+    lines += [f"{u2.id},10,EUR,lunch,exact,{u1.id}:4;{u2.id}:6", f"{u2.id},10,EUR,bad,exact,{u1.id}:4", f"999,5,,ghost,equal,", f"{u3.id},abc,,nan,equal,"]
+    upload = UploadFile(io.BytesIO("\n".join(lines).encode()), filename="statement.csv")
+    out = expenses_router.import_expenses(group_id=g.id, file=upload, chunk_size=3, db=db)
+    assert {k: out[k] for k in ("rows", "imported", "failed", "chunks")} == {"rows": 11, "imported": 8, "failed": 3, "chunks": 3}
+    assert [e["line"] for e in out["errors"]] == [10, 11, 12]
+    assert "must equal total" in out["errors"][0]["detail"] and "amount" in out["errors"][2]["detail"]
+    bals = {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id)}
+    assert bals == {u1.id: 14000 - 480, u2.id: -7000 + 480, u3.id: -7000}
+    jsonl = "\n".join([json.dumps({"payer_id": u3.id, "amount": 9, "split_type": "shares", "shares": {str(u1.id): 2, str(u3.id): 1}}), "", "not json"])
+    out = expenses_router.import_expenses(group_id=g.id, file=UploadFile(io.BytesIO(jsonl.encode()), filename="rows.jsonl"), db=db)
+    assert (out["imported"], out["failed"], out["errors"][0]["line"]) == (1, 1, 3)
+
+def test_non_finite_and_oversized_amounts_are_rejected(db):
+    g, u1, u2, _ = bootstrap(db)
+    for amount in (1e20, float("nan"), float("inf")):
+        with pytest.raises(HTTPException) as exc:
+            expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=amount, currency="USD", user_ids=[u1.id, u2.id]), db=db)
+        assert exc.value.status_code == 400
+    lines = ["payer_id,amount", f"{u1.id},1e20", f"{u1.id},nan", f"{u2.id},-inf", f"{u2.id},12"]
+    out = expenses_router.import_expenses(group_id=g.id, file=UploadFile(io.BytesIO("\n".join(lines).encode()), filename="a.csv"), db=db)
+    assert (out["imported"], out["failed"]) == (1, 3)
+    assert [e["detail"] for e in out["errors"]] == ["Amount is too large.", "Amount must be a finite number.", "Amount must be a finite number."]
+    assert sum(b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id)) == 0
+
+def test_export_ledger_streams_incrementally(db):
+    g, u1, u2, u3 = bootstrap(db)
+    expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=90, currency="USD", user_ids=[u1.id, u2.id, u3.id]), db=db)
+    expenses_router.add_shares(group_id=g.id, data=ExpenseSharesIn(payer_id=u2.id, amount=10, currency="USD", shares={u1.id: 1}), db=db)
+    settlements_router.settle(group_id=g.id, data=SettlementIn(debtor_id=u3.id, creditor_id=u1.id, amount_base=25), db=db)
+    resp = export_router.export_ledger(group_id=g.id, format="csv", db=db)
+    mark = resp.headers["X-Export-Watermark"]
+    rows = list(csv.DictReader(io.StringIO("".join(export_router.export_chunks(db.get_bind(), g.id, "csv", (0, 0), decode_watermark(mark))))))
+    assert [r["record"] for r in rows] == ["expense", "split", "split", "split", "expense", "split", "settlement"]
+    assert rows[5]["expense_id"] == rows[4]["id"] and rows[5]["amount_base"] == "10.0" and rows[6]["amount"] == "25.0"
+    expenses_router.add_shares(group_id=g.id, data=ExpenseSharesIn(payer_id=u3.id, amount=6, currency="USD", shares={u2.id: 1}), db=db)
+    chunks = gzipped(export_router.export_chunks(db.get_bind(), g.id, "jsonl", decode_watermark(mark), high_water(db, g.id)))
+    records = [json.loads(line) for line in gzip.decompress(b"".join(chunks)).decode().splitlines()]
+    assert [(r["record"], r["amount"]) for r in records] == [("expense", 6.0), ("split", 6.0)]
+
+# tables read in full on purpose: the FX cache loads every rate, reconcile walks every group
+FULL_SCAN_ALLOWED = {"currency_rates", "groups"}
+
+def plan_regressions(db, statements):
+    found = []
+    for statement, params in statements:
+        if not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            continue
+        for row in db.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + statement, params).fetchall():
+            detail = row[-1]
+            full_scan = detail.startswith("SCAN ") and detail.split()[1] not in FULL_SCAN_ALLOWED and "USING" not in detail
+            if full_scan or detail == "USE TEMP B-TREE FOR ORDER BY":
+                found.append((detail, statement))
+    return found
+
+def test_router_queries_use_indexes(db):
+    statements = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters[0] if executemany else parameters))
+    event.listen(db.get_bind(), "before_cursor_execute", capture)
+    try:
+        g, u1, u2, u3 = bootstrap(db)
+        rates_router.upsert_rate(RateUpsert(base="EUR", target="USD", rate=1.1), db=db)
+        rates_router.load_rates(RateBulkIn(rates=[RateUpsert(base="GBP", target="USD", rate=1.3)]), db=db)
+        rates_router.quote(base="EUR", target="GBP", db=db)
+        expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=30, currency="EUR", user_ids=[u1.id, u2.id, u3.id]), db=db)
+        expenses_router.add_percentage(group_id=g.id, data=ExpensePercentIn(payer_id=u2.id, amount=10, currency="USD", percentages={u1.id: 40, u3.id: 60}), db=db)
+        expenses_router.add_shares(group_id=g.id, data=ExpenseSharesIn(payer_id=u3.id, amount=12, currency="GBP", shares={u1.id: 1, u2.id: 2}), db=db)
+        expenses_router.add_batch(group_id=g.id, data=ExpenseBatchIn(expenses=[{"split_type": "exact", "payer_id": u1.id, "amount": 5, "currency": "USD", "amounts": {u2.id: 5}}]), db=db)
+        expenses_router.import_expenses(group_id=g.id, file=UploadFile(io.BytesIO(f"payer_id,amount\n{u2.id},9\n".encode()), filename="a.csv"), db=db)
+        settlements_router.settle(group_id=g.id, data=SettlementIn(debtor_id=u2.id, creditor_id=u1.id, amount_base=1), db=db)
+        simplify_router.preview(group_id=g.id, db=db)
+        simplify_router.apply(group_id=g.id, db=db)
+        balances_router.get_balances(group_id=g.id, db=db)
+        balances_router.get_balance_summary(group_id=g.id, db=db)
+        resp = Response()
+        history_router.get_history(group_id=g.id, type="expense", start=datetime(2000, 1, 1), end=datetime(2100, 1, 1), limit=2, response=resp, db=db)
+        history_router.get_history(group_id=g.id, type=None, limit=2, cursor=resp.headers["X-Next-Cursor"], db=db)
+        history_router.get_history(group_id=g.id, user_id=u2.id, type=None, db=db)
+        list(history_router.stream_history(db.get_bind(), 10, group_id=g.id, user_id=None, type=None, start=None, end=None, cursor=None))
+        list(export_router.export_chunks(db.get_bind(), g.id, "csv", (0, 0), high_water(db, g.id)))
+        reconcile(db, g.id, full=True)
+        reconcile(db, g.id)
+    finally:
+        event.remove(db.get_bind(), "before_cursor_execute", capture)
+    assert len(statements) > 50
+    assert plan_regressions(db, statements) == []
+
+def test_migrate_replaces_superseded_indexes():
+    engine = create_engine("sqlite://", future=True)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX ix_history_group_created")
+        conn.exec_driver_sql("DROP INDEX ix_expense_splits_expense_user")
+        conn.exec_driver_sql("CREATE INDEX ix_balances_group_id ON balances (group_id)")
+        conn.exec_driver_sql("CREATE INDEX ix_expense_splits_expense_id ON expense_splits (expense_id)")
+    migrate(engine)
+    insp = inspect(engine)
+    assert "ix_history_group_created" in {ix["name"] for ix in insp.get_indexes("history")}
+    assert {ix["name"] for ix in insp.get_indexes("expense_splits")} == {"ix_expense_splits_expense_user"}
+    assert "ix_balances_group_id" not in {ix["name"] for ix in insp.get_indexes("balances")}
+
+def test_conditional_get_uses_ledger_version(db):
+    g, u1, u2, _ = bootstrap(db)
+    first = Response()
+    balances_router.get_balances(group_id=g.id, response=first, db=db)
+    tag = first.headers["ETag"]
+    with query_budget(db.get_bind(), 4):
+        for call in (balances_router.get_balances, balances_router.get_balance_summary, history_router.get_history, simplify_router.preview):
+            kwargs = {"type": None} if call is history_router.get_history else {}
+            assert call(group_id=g.id, if_none_match=f'W/"x", {tag}', db=db, **kwargs).status_code == 304
+    expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=10, currency="USD", user_ids=[u1.id, u2.id]), db=db)
+    fresh = Response()
+    rows = balances_router.get_balances(group_id=g.id, if_none_match=tag, response=fresh, db=db)
+    assert len(rows) == 3 and fresh.headers["ETag"] != tag
+
+def test_group_events_stream_live_resume_and_overflow(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'events.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    rate_cache.clear(); membership_cache.clear()
+    db = sessionmaker(bind=engine, autoflush=False)()
+    g, u1, u2, _ = bootstrap(db)
+    add = lambda amount: expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=amount, currency="USD", user_ids=[u1.id, u2.id]), db=db)
+    add(10)
+
+    async def read(stream):
+        messages = []
+        for message in (await anext(stream)).strip().split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in message.splitlines())
+            messages.append((fields.get("id"), fields["event"], json.loads(fields["data"])))
+        return messages
+
+    async def scenario():
+        stream = events_router.event_stream(engine, g.id, "USD", None)
+        [(_, kind, snap)] = await read(stream)
+        assert (kind, snap["balances"][str(u1.id)]) == ("snapshot", 5.0)
+        await asyncio.to_thread(add, 4)
+        (eid, kind, data), (_, kind2, data2) = await read(stream)
+        assert (kind, data["payload"]["amount"]) == ("expense", 4.0) and int(eid) > snap["history_id"]
+        assert (kind2, data2["deltas"]) == ("balances", {str(u1.id): 2.0, str(u2.id): -2.0})
+        # commits publish from their own threads, so a later history id can reach the broker first
+        late = lambda hid: LedgerEvent(g.id, "history", hid, {"type": "settlement", "created_at": "2024-01-01T00:00:00", "payload": {}})
+        for hid in (int(eid) + 2, int(eid) + 1, int(eid) + 1, int(eid)):
+            broker.publish([late(hid)])
+        assert [m[0] for m in await read(stream)] == [str(int(eid) + 2), str(int(eid) + 1)]
+        await stream.aclose()
+        assert broker.stats()["subscribers"] == 0
+
+        resumed = events_router.event_stream(engine, g.id, "USD", snap["history_id"])
+        assert [m[:2] for m in await read(resumed) + await read(resumed)] == [(eid, "expense"), (eid, "snapshot")]
+        await resumed.aclose()
+
+        sub = broker.subscribe(g.id)
+        sub.queue = asyncio.Queue(2)
+        broker.publish([LedgerEvent(g.id, "history", i, {}) for i in range(5)])
+        await asyncio.sleep(0)
+        broker.unsubscribe(sub)
+        assert [e.kind for e in [sub.queue.get_nowait() for _ in range(sub.queue.qsize())]] == ["resync"] and sub.dropped == 2
+
+    asyncio.run(scenario())
+
+def test_idempotency_key_replays_and_serializes_duplicates(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'idem.db'}", connect_args={"check_same_thread": False})
+    configure_sqlite(engine)
+    Base.metadata.create_all(bind=engine)
+    rate_cache.clear(); membership_cache.clear(); idempotency.response_cache.clear()
+    Local = sessionmaker(bind=engine, autoflush=False)
+    db = Local()
+    g, u1, u2, _ = bootstrap(db)
+    data = ExpenseEqualIn(payer_id=u1.id, amount=10, currency="USD", user_ids=[u1.id, u2.id])
+
+    def post(key):
+        with Local() as s:
+            return expenses_router.add_equal(group_id=g.id, data=data, idempotency_key=key, db=s)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(pool.map(post, ["retry-1"] * 8))
+    assert len({r["id"] for r in responses}) == 1
+    assert db.query(models.Expense).count() == 1
+    with query_budget(engine, 0):
+        assert post("retry-1") == responses[0]
+    batch = ExpenseBatchIn(expenses=[{"split_type": "equal", "payer_id": u1.id, "amount": 4, "currency": "USD", "user_ids": [u1.id, u2.id]}])
+    with Local() as s:
+        stored = expenses_router.add_batch(group_id=g.id, data=batch, idempotency_key="batch-1", db=s)
+    with query_budget(engine, 0), Local() as s:
+        assert expenses_router.add_batch(group_id=g.id, data=batch, idempotency_key="batch-1", db=s) == stored
+    with pytest.raises(HTTPException) as exc:
+        with Local() as s:
+            expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=11, currency="USD", user_ids=[u1.id]), idempotency_key="retry-1", db=s)
+    assert exc.value.status_code == 422
+    with Local() as s:
+        settled = settlements_router.settle(group_id=g.id, data=SettlementIn(debtor_id=u2.id, creditor_id=u1.id, amount_base=2), idempotency_key="pay-1", db=s)
+    # another worker committed the key after this one looked it up: the unique key rolls the duplicate back
+    idempotency.response_cache.clear()
+    lookups, real = [], idempotency.stored_response
+    monkeypatch.setattr(idempotency, "stored_response", lambda db, key: real(db, key) if lookups.append(key) or len(lookups) > 1 else None)
+    with Local() as s:
+        again = settlements_router.settle(group_id=g.id, data=SettlementIn(debtor_id=u2.id, creditor_id=u1.id, amount_base=2), idempotency_key="pay-1", db=s)
+    assert again == settled and db.query(models.Settlement).count() == 1
+    db.expire_all()
+    assert {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id)}[u2.id] == -500
+
+def test_update_and_delete_expense_apply_net_deltas(db):
+    g, u1, u2, u3 = bootstrap(db)
+    kept = expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u2.id, amount=6, currency="USD", user_ids=[u1.id, u2.id, u3.id]), db=db)
+    exp = expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=30, currency="USD", user_ids=[u1.id, u2.id, u3.id]), db=db)
+    assert reconcile(db, g.id)["groups"][0]["checkpoint"] is not None
+    bals = lambda: {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id).populate_existing()}
+    item = {"split_type": "exact", "payer_id": u1.id, "amount": 20, "currency": "USD", "amounts": {u1.id: 5, u2.id: 15}}
+    out = expenses_router.update_expense(group_id=g.id, expense_id=exp.id, data=TypeAdapter(ExpenseBatchItem).validate_python(item), db=db)
+    assert (out.amount, out.split_type, out.created_at) == (20.0, "exact", exp.created_at)
+    assert bals() == {u1.id: 1500 - 200, u2.id: -1500 + 400, u3.id: -200}
+    assert db.query(models.LedgerCheckpoint).get(g.id) is None
+    report = reconcile(db, g.id)["groups"][0]
+    assert (report["mode"], report["drift"]) == ("full", [])
+    assert history_router.get_history(group_id=g.id, user_id=u3.id, type="expense", db=db)[0].payload["action"] == "updated"
+    assert expenses_router.delete_expense(group_id=g.id, expense_id=exp.id, db=db)["expense_id"] == exp.id
+    assert bals() == {u1.id: -200, u2.id: 400, u3.id: -200}
+    assert db.query(models.ExpenseSplit).count() == 3 and reconcile(db, g.id, full=True)["groups"][0]["drift"] == []
+    with pytest.raises(HTTPException) as exc:
+        expenses_router.delete_expense(group_id=g.id, expense_id=exp.id, db=db)
+    assert exc.value.status_code == 404 and kept.id != exp.id
+
+def test_compact_history_into_archive_segments(db):
+    g, u1, u2, u3 = bootstrap(db)
+    for amount in (30, 60, 90, 120):
+        expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=amount, currency="USD", user_ids=[u1.id, u2.id]), db=db)
+    settlements_router.settle(group_id=g.id, data=SettlementIn(debtor_id=u2.id, creditor_id=u1.id, amount_base=10.0), db=db)
+    db.add(models.History(group_id=g.id, type="settlement", payload={"auto_simplify": True, "transfers": [{"from": u1.id, "to": u2.id, "amount": 1.5}]}))
+    db.query(models.Balance).filter_by(group_id=g.id, user_id=u1.id).first().balance_minor += 150
+    db.query(models.Balance).filter_by(group_id=g.id, user_id=u2.id).first().balance_minor -= 150
+    expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u3.id, amount=9, currency="USD", user_ids=[u2.id, u3.id]), db=db)
+    old, recent = datetime.utcnow() - timedelta(days=400), datetime.utcnow() - timedelta(days=1)
+    for i, h in enumerate(db.query(models.History).order_by(models.History.id)):
+        h.created_at = old + timedelta(minutes=i) if i < 6 else recent
+    for p in db.query(models.HistoryParticipant):
+        p.created_at = db.get(models.History, p.history_id).created_at
+    db.commit()
+    before = [r.model_dump() for r in map(HistoryOut.model_validate, history_router.get_history(group_id=g.id, type=None, db=db))]
+    version = db.get(models.Group, g.id).ledger_version
+
+    assert archive.compact_history(db, timedelta(days=365), segment_rows=4)["rows"] == 6
+    segments = db.query(models.HistoryArchive).order_by(models.HistoryArchive.id).all()
+    assert [(s.row_count, s.type_counts) for s in segments] == [(4, {"expense": 4}), (2, {"settlement": 2})]
+    assert db.query(models.History).count() == 1 and db.get(models.Group, g.id).ledger_version == version
+    assert archive.compact_history(db, timedelta(days=365))["rows"] == 0
+
+    assert [r.model_dump() for r in map(HistoryOut.model_validate, history_router.get_history(group_id=g.id, type=None, db=db))] == before
+    archive.segment_cache.clear()
+    assert len(history_router.get_history(group_id=g.id, type=None, start=recent - timedelta(hours=1), db=db)) == 1
+    assert archive.segment_cache.stats()["misses"] == 0
+    pages, cursor = [], None
+    while True:
+        resp = Response()
+        pages.append([r.id for r in history_router.get_history(group_id=g.id, type=None, limit=3, cursor=cursor, response=resp, db=db)])
+        if not (cursor := resp.headers.get("X-Next-Cursor")):
+            break
+    assert pages == [[b["id"] for b in before[i:i + 3]] for i in range(0, 7, 3)]
+    assert len(archive.segment_cache) == 2
+    only_u3 = history_router.get_history(group_id=g.id, user_id=u3.id, type=None, db=db)
+    assert [r.id for r in only_u3] == [before[0]["id"]]
+    assert [r.id for r in history_router.get_history(group_id=g.id, type="settlement", end=old + timedelta(minutes=4), db=db)] == [before[2]["id"]]
+    lines = list(history_router.stream_history(db.get_bind(), 5, group_id=g.id, user_id=None, type=None, start=None, end=None, cursor=None))
+    assert [json.loads(l)["id"] for l in lines] == [b["id"] for b in before[:5]]
+    report = reconcile(db, g.id, full=True)["groups"][0]
+    assert report["drift"] == [] and report["checkpoint"]["history_id"] == before[0]["id"]
+
+
+def test_refunds_and_zero_sum_splits_keep_balances_netting_to_zero(db):
+    g, u1, u2, u3 = bootstrap(db)
+    db.add(models.CurrencyRate(base="EUR", target="USD", rate=1.1)); db.commit()
+    bals = lambda: {b.user_id: b.balance_minor for b in db.query(models.Balance).filter_by(group_id=g.id).populate_existing()}
+    expenses_router.add_equal(group_id=g.id, data=ExpenseEqualIn(payer_id=u1.id, amount=-30, currency="USD", user_ids=[u1.id, u2.id, u3.id]), db=db)
+    assert bals() == {u1.id: -2000, u2.id: 1000, u3.id: 1000}
+    expenses_router.add_exact(group_id=g.id, data=ExpenseExactIn(payer_id=u1.id, amount=0, currency="EUR", amounts={u2.id: 10, u3.id: -10}), db=db)
+    assert bals() == {u1.id: -2000, u2.id: -100, u3.id: 2100}
+    expenses_router.add_exact(group_id=g.id, data=ExpenseExactIn(payer_id=u2.id, amount=-5, currency="EUR", amounts={u1.id: 5, u3.id: -10}), db=db)
+    assert sum(bals().values()) == 0
+    for exp in db.query(models.Expense).all():
+        assert sum(s.amount_base_minor for s in db.query(models.ExpenseSplit).filter_by(expense_id=exp.id)) == exp.amount_base_minor
+    assert reconcile(db, g.id, full=True)["groups"][0]["drift"] == []